@@ -0,0 +1,198 @@
+"""
+Benchmarks the IPN view and the GloBee api client against the fake GloBee api and writes the results as JSON.
+
+    python benchmarks/run.py --requests 500 --output bench.json
+    python benchmarks/run.py --postgres globee_bench   # also on PostgreSQL, connection settings from PGHOST, PGUSER, ...
+
+IPN scenarios: GLOBEE_AUTO_VERIFY on/off x GLOBEE_PARANOID_MODE on/off x new rows, updated rows and invalid IPNs.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+from datetime import datetime
+from itertools import product
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+AUTH_KEY = 'BENCHMARK_AUTH_KEY'
+
+
+def configure(postgres: str = None):
+    databases = {'sqlite': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'globee_benchmark.sqlite3'}}
+    if postgres:
+        databases['postgres'] = {'ENGINE': 'django.db.backends.postgresql', 'NAME': postgres}
+    databases['default'] = databases['sqlite']
+    settings.configure(
+        SECRET_KEY='benchmark',
+        INSTALLED_APPS=['globee'],
+        ROOT_URLCONF='globee.urls',
+        DATABASES=databases,
+        USE_TZ=True,
+        GLOBEE_AUTH_KEY=AUTH_KEY,
+        LOGGING_CONFIG=None,
+    )
+    django.setup()
+
+
+def summarize(timings, elapsed):
+    from globee.metrics import percentile
+    return {
+        'requests': len(timings),
+        'throughput_rps': round(len(timings) / elapsed, 2),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 4),
+        'p50_ms': round(percentile(timings, 50) * 1000, 4),
+        'p99_ms': round(percentile(timings, 99) * 1000, 4),
+    }
+
+
+def ipn_payloads(api, kind: str, count: int, offset: int):
+    payloads = []
+    for i in range(count):
+        payment_id = 'bench-%s-%s' % (offset, i)
+        payment = {
+            'id': payment_id,
+            'status': 'paid',
+            'total': '10.50',
+            'currency': 'USD',
+            'custom_payment_id': payment_id,
+            'callback_data': 'benchmark',
+            'customer': {'name': 'Benchmark', 'email': 'benchmark@example.com'},
+            'confirmation_speed': 'medium',
+            'expires_at': '2030-01-01 12:15:00',
+            'created_at': '2030-01-01 12:00:00',
+        }
+        if kind == 'invalid':
+            # unknown to the fake api as well, so the verification fails too
+            payment = {'id': payment_id}
+        else:
+            api.payments[payment_id] = payment
+        payloads.append(json.dumps(payment).encode('utf-8'))
+    return payloads
+
+
+def bench_ipn(api, database: str, verify: bool, paranoid: bool, kind: str, count: int, offset: int):
+    from django.db import connections
+    from django.test import Client, override_settings
+    from django.urls import reverse
+    from globee.models import GlobeeIPN
+
+    payloads = ipn_payloads(api, kind, count, offset)
+    # a failed verification raises in the view, count it as 500 like a real server
+    client = Client(raise_request_exception=False)
+    url = reverse('globee-ipn')
+    with override_settings(GLOBEE_AUTO_VERIFY=verify, GLOBEE_PARANOID_MODE=paranoid, DATABASE_ROUTERS=[]):
+        connections['default'] = connections[database]
+        if kind == 'update':
+            for payload in payloads:
+                client.generic('POST', url, payload)
+            payloads = [payload.replace(b'"paid"', b'"confirmed"') for payload in payloads]
+        if verify and kind == 'update':
+            for payload in payloads:
+                api.payments[json.loads(payload.decode('utf-8'))['id']]['status'] = 'confirmed'
+
+        timings = []
+        status_codes = {}
+        start = perf_counter()
+        for payload in payloads:
+            request_start = perf_counter()
+            response = client.generic('POST', url, payload)
+            timings.append(perf_counter() - request_start)
+            status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+        elapsed = perf_counter() - start
+        GlobeeIPN.objects.all().delete()
+
+    result = {'database': database, 'verify': verify, 'paranoid': paranoid, 'rows': kind}
+    result.update(summarize(timings, elapsed))
+    result['status_codes'] = {str(code): count for code, count in status_codes.items()}
+    return result
+
+
+def bench_client(count: int):
+    from globee.core import GlobeePayment
+
+    payment = GlobeePayment(payment_data={'total': 10.5, 'currency': 'USD', 'customer': {'name': 'Benchmark', 'email': 'benchmark@example.com'}})
+    payment.create_request()
+    calls = [
+        ('ping', payment.ping),
+        ('create_request', payment.create_request),
+        ('get_payment_by_id', lambda: payment.get_payment_by_id(cached=False)),
+        ('update_payment_request', lambda: payment.update_payment_request(payment_data={'customer': {'email': 'benchmark@example.com'}, 'callback_data': 'x'})),
+        ('get_payment_details', payment.get_payment_details),
+        ('get_payment_currency_details', lambda: payment.get_payment_currency_details('BTC')),
+        ('get_payment_methods', payment.get_payment_methods),
+    ]
+    results = []
+    for name, call in calls:
+        timings = []
+        start = perf_counter()
+        for i in range(count):
+            call_start = perf_counter()
+            call()
+            timings.append(perf_counter() - call_start)
+        result = {'method': name}
+        result.update(summarize(timings, perf_counter() - start))
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario (default: 200)')
+    parser.add_argument('--latency', type=float, default=0, help='latency of the fake GloBee api in seconds (default: 0)')
+    parser.add_argument('--postgres', default=None, help='name of a PostgreSQL database to benchmark as well')
+    parser.add_argument('--output', default=None, help='JSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    configure(args.postgres)
+    from django.db import connections
+    from django.test.utils import override_settings, setup_test_environment
+    from globee.testing import FakeGlobeeAPI, FakeGlobeeServer
+
+    setup_test_environment()
+    logging.disable(logging.CRITICAL)
+    databases = ['sqlite'] + (['postgres'] if args.postgres else [])
+    for database in databases:
+        connections[database].creation.create_test_db(verbosity=0, keepdb=False)
+
+    api = FakeGlobeeAPI(auth_key=AUTH_KEY, latency=args.latency)
+    results = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'requests_per_scenario': args.requests,
+            'api_latency': args.latency,
+        },
+        'ipn': [],
+        'client': [],
+    }
+    default_connection = connections['default']
+    try:
+        with FakeGlobeeServer(api) as server, override_settings(GLOBEE_API_URL=server.api_url):
+            for offset, (database, verify, paranoid, kind) in enumerate(product(databases, (False, True), (False, True), ('new', 'update', 'invalid'))):
+                results['ipn'].append(bench_ipn(api, database, verify, paranoid, kind, args.requests, offset))
+            connections['default'] = default_connection
+            results['client'] = bench_client(args.requests)
+    finally:
+        connections['default'] = default_connection
+        for database in databases:
+            connections[database].creation.destroy_test_db(connections[database].settings_dict['NAME'], verbosity=0)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
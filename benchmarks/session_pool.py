@@ -0,0 +1,77 @@
+"""
+Compares a bare ``requests.get`` per call with the pooled GlobeePayment session
+against a local stub of the GloBee ping endpoint.
+
+    python benchmarks/session_pool.py --calls 500
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({'success': True, 'data': {'name': 'stub', 'url': 'http://localhost'}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def timed(func, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=500)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = 'http://127.0.0.1:%s/payment-api/v1' % server.server_port
+
+    settings.GLOBEE_AUTH_KEY = 'benchmark'
+    django.setup()
+    from globee.core import GlobeePayment, get_session
+
+    payment = GlobeePayment()
+    payment.api_url = api_url
+    payment.session = get_session(payment.auth_key, api_url)
+
+    bare = timed(lambda: requests.get('%s/ping' % api_url, headers=payment.headers).json(), args.calls)
+    pooled = timed(payment.ping, args.calls)
+    server.shutdown()
+
+    print(json.dumps({
+        'calls': args.calls,
+        'bare_ms_per_call': round(bare, 4),
+        'pooled_ms_per_call': round(pooled, 4),
+        'saved_ms_per_call': round(bare - pooled, 4),
+    }, indent=4))
+
+
+if __name__ == '__main__':
+    main()
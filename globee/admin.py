@@ -1,6 +1,103 @@
+import json
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+from globee.models import GlobeeIPN, GlobeeIPNInbox
+
+# GET parameter with the (created_at, pk) of the last row of the previous page
+KEYSET_VAR = 'after'
+
+
+def estimate_count(queryset):
+    """
+    Returns the row count estimated by the PostgreSQL planner. Small results, unsupported backends and
+    tables without statistics are counted exactly.
+    :param queryset: queryset to count
+    :return: number of rows
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            if not queryset.query.where:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+                estimate = row[0] if row else -1
+            else:
+                sql, params = queryset.order_by().query.sql_with_params()
+                cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                estimate = plan[0]['Plan']['Plan Rows']
+        if estimate >= getattr(settings, 'GLOBEE_ADMIN_EXACT_COUNT_LIMIT', 10000):
+            return int(estimate)
+    return queryset.count()
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that uses estimate_count() instead of COUNT(*).
+    """
+
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Change list ordered by (-created_at, -pk) that seeks to the next page with WHERE instead of OFFSET.
+    Only next and first page links are available.
+    """
 
-from globee.models import GlobeeIPN
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(KEYSET_VAR, None)
+        return lookup_params
+
+    def get_ordering(self, request, queryset):
+        return ['-created_at', '-pk']
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        queryset = self.queryset
+        self.after = request.GET.get(KEYSET_VAR)
+        if self.after:
+            try:
+                created_at, pk = self.after.rsplit(',', 1)
+                created_at = parse_datetime(created_at)
+                pk = int(pk)
+            except ValueError:
+                raise IncorrectLookupParameters
+            if created_at is None:
+                raise IncorrectLookupParameters
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+        result_list = list(queryset[:self.list_per_page + 1])
+        self.has_next = len(result_list) > self.list_per_page
+        result_list = result_list[:self.list_per_page]
+
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = self.has_next or bool(self.after)
+        self.paginator = paginator
+        self.keyset = True
+        self.next_url = None
+        if self.has_next:
+            last = result_list[-1]
+            self.next_url = self.get_query_string({KEYSET_VAR: '%s,%s' % (last.created_at.isoformat(), last.pk)})
+        self.first_url = self.get_query_string(remove=[KEYSET_VAR]) if self.after else None
 
 
 class GlobeeIPNAdmin(admin.ModelAdmin):
@@ -9,4 +106,36 @@ class GlobeeIPNAdmin(admin.ModelAdmin):
     search_fields = ('payment_id', 'custom_payment_id')
 
 
-admin.site.register(GlobeeIPN, GlobeeIPNAdmin)
+class LargeTableGlobeeIPNAdmin(GlobeeIPNAdmin):
+    """
+    GlobeeIPNAdmin for tables with millions of payments (GLOBEE_ADMIN_LARGE_TABLE): estimated counts,
+    keyset pagination, fixed date ranges instead of date_hierarchy and indexed search only.
+    """
+    date_hierarchy = None
+    list_filter = ('payment_status', ('created_at', admin.DateFieldListFilter))
+    # exact payment id or custom payment id prefix, see get_search_results()
+    search_fields = ('=payment_id', '^custom_payment_id')
+    sortable_by = ()
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        # case-sensitive lookups, so the unique indexes can be used
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.filter(Q(payment_id=search_term) | Q(custom_payment_id__startswith=search_term)), False
+
+
+class GlobeeIPNInboxAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'received_at', 'attempts', 'locked_until', 'signal_pending', 'last_error')
+
+
+if getattr(settings, 'GLOBEE_ADMIN_LARGE_TABLE', False):
+    admin.site.register(GlobeeIPN, LargeTableGlobeeIPNAdmin)
+else:
+    admin.site.register(GlobeeIPN, GlobeeIPNAdmin)
+admin.site.register(GlobeeIPNInbox, GlobeeIPNInboxAdmin)
@@ -0,0 +1,198 @@
+from hashlib import sha1
+from inspect import isawaitable
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from globee.metrics import registry
+from globee.models import GlobeeIPN
+from globee.singleflight import SingleFlight
+
+
+DEFAULT_TTLS = {
+    'payment_methods': 3600,
+    'payment_details': 300,
+    'payment_currency_details': 300,
+}
+
+DEFAULT_STATUS_TTLS = {
+    'unpaid': 10,
+    'paid': 10,
+    'underpaid': 60,
+    'overpaid': 300,
+    'paid_late': 300,
+    'confirmed': 300,
+    'completed': 86400,
+}
+
+cache_flight = SingleFlight('cache')
+cache_hits = registry.counter('globee_cache_hits_total', 'GloBee api responses served from the cache')
+cache_misses = registry.counter('globee_cache_misses_total', 'GloBee api responses not found in the cache')
+
+
+def get_cache_alias():
+    """
+    Returns the name of the cache set in GLOBEE_CACHE or None if caching is disabled.
+    """
+    return getattr(settings, 'GLOBEE_CACHE', None)
+
+
+def get_ttl(endpoint: str):
+    """
+    Returns the cache timeout of an endpoint, see GLOBEE_CACHE_TTLS.
+    :param endpoint: endpoint name, e.g. payment_methods
+    :return: seconds
+    """
+    return getattr(settings, 'GLOBEE_CACHE_TTLS', {}).get(endpoint, DEFAULT_TTLS.get(endpoint, 0))
+
+
+def get_status_ttl(payment_data: dict):
+    """
+    Returns the cache timeout of a payment depending on its status, see GLOBEE_CACHE_STATUS_TTLS.
+    :param payment_data: payment data fetched from GloBee
+    :return: seconds
+    """
+    ttls = dict(DEFAULT_STATUS_TTLS, **getattr(settings, 'GLOBEE_CACHE_STATUS_TTLS', {}))
+    return ttls.get(payment_data.get('status'), DEFAULT_STATUS_TTLS['unpaid'])
+
+
+def get_key_prefix(auth_key: str, api_url: str):
+    return 'globee:%s' % sha1(('%s:%s' % (auth_key, api_url)).encode('utf-8')).hexdigest()[:16]
+
+
+def _get_payment_version_key(prefix: str, payment_id: str):
+    return '%s:payment:%s:version' % (prefix, payment_id)
+
+
+def get_payment_ttl(endpoint: str, payment_id: str):
+    """
+    Returns the cache timeout of a payment-scoped endpoint, at most until the payment expires.
+    :param endpoint: endpoint name
+    :param payment_id: the payment id that identifies the payment request
+    :return: seconds
+    """
+    ttl = get_ttl(endpoint)
+    expires_at = GlobeeIPN.objects.filter(payment_id=payment_id).values_list('expires_at', flat=True).first()
+    if expires_at is not None:
+        ttl = min(ttl, int((expires_at - timezone.now()).total_seconds()))
+    return max(ttl, 0)
+
+
+async def aget_payment_ttl(endpoint: str, payment_id: str):
+    """
+    Async variant of get_payment_ttl().
+    """
+    ttl = get_ttl(endpoint)
+    expires_at = await GlobeeIPN.objects.filter(payment_id=payment_id).values_list('expires_at', flat=True).afirst()
+    if expires_at is not None:
+        ttl = min(ttl, int((expires_at - timezone.now()).total_seconds()))
+    return max(ttl, 0)
+
+
+def get_or_fetch(cache_alias: str, key: str, ttl, fetch, version_key: str = None):
+    """
+    Returns the cached value or calls fetch() and caches its result.
+    Concurrent misses of the same key are coalesced, across processes through the cache.
+    :param cache_alias: name of the cache
+    :param key: cache key
+    :param ttl: cache timeout in seconds or a function returning the timeout for a value, nothing is cached if it is 0
+    :param fetch: function returning the value
+    :param version_key: key of the payment's cache version, see get_payment_keys()
+    :return: value
+    """
+    cache = caches[cache_alias]
+    if version_key is None:
+        version = None
+        value = cache.get(key)
+    else:
+        # the value and the payment's cache version in one round trip
+        version, value = _get_versioned(cache.get_many([key, version_key]), key, version_key)
+    if value is not None:
+        cache_hits.inc()
+        return value
+
+    cache_misses.inc()
+    if not callable(ttl) and ttl <= 0:
+        return fetch()
+
+    def load():
+        value = fetch()
+        timeout = ttl(value) if callable(ttl) else ttl
+        if timeout > 0:
+            cache.set(key, value if version is None else (version, value), timeout)
+        return value
+
+    return cache_flight.do(key if version is None else '%s:%s' % (key, version), load, cache_alias=cache_alias)
+
+
+async def aget_or_fetch(cache_alias: str, key: str, ttl, fetch, version_key: str = None):
+    """
+    Async variant of get_or_fetch(), fetch is a coroutine function and ttl may return an awaitable.
+    Concurrent misses of the same key are coalesced within the event loop.
+    """
+    cache = caches[cache_alias]
+    if version_key is None:
+        version = None
+        value = await cache.aget(key)
+    else:
+        version, value = _get_versioned(await cache.aget_many([key, version_key]), key, version_key)
+    if value is not None:
+        cache_hits.inc()
+        return value
+
+    cache_misses.inc()
+    if not callable(ttl) and ttl <= 0:
+        return await fetch()
+
+    async def load():
+        value = await fetch()
+        timeout = ttl(value) if callable(ttl) else ttl
+        if isawaitable(timeout):
+            timeout = await timeout
+        if timeout > 0:
+            await cache.aset(key, value if version is None else (version, value), timeout)
+        return value
+
+    return await cache_flight.ado(key if version is None else '%s:%s' % (key, version), load)
+
+
+def _get_versioned(values: dict, key: str, version_key: str):
+    """
+    :return: tuple of (current version, cached value or None if it is missing or outdated)
+    """
+    version = values.get(version_key, 1)
+    entry = values.get(key)
+    return version, entry[1] if entry is not None and entry[0] == version else None
+
+
+def get_payment_keys(prefix: str, endpoint: str, payment_id: str, *parts):
+    """
+    Returns the cache key of a payment-scoped endpoint and the key of the payment's cache version.
+    Cached responses store the version they were fetched with, so invalidate_payment() invalidates
+    every cached response of the payment at once.
+    :return: tuple of (key, version key)
+    """
+    key = ':'.join([prefix, endpoint, payment_id] + [str(part) for part in parts])
+    return key, _get_payment_version_key(prefix, payment_id)
+
+
+def set_payment(cache_alias: str, prefix: str, endpoint: str, payment_id: str, value, timeout: int):
+    """
+    Caches the response of a payment-scoped endpoint with the payment's current cache version.
+    """
+    cache = caches[cache_alias]
+    key, version_key = get_payment_keys(prefix, endpoint, payment_id)
+    cache.set(key, (cache.get(version_key, 1), value), timeout)
+
+
+def invalidate_payment(cache_alias: str, prefix: str, payment_id: str):
+    """
+    Invalidates all cached responses of a payment.
+    """
+    cache = caches[cache_alias]
+    key = _get_payment_version_key(prefix, payment_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, None)
@@ -1,8 +1,211 @@
+import asyncio
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from logging import getLogger
+from threading import Lock, local
+from time import perf_counter
+from weakref import WeakKeyDictionary
+
+from asgiref.sync import sync_to_async
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 
 from django.conf import settings
-from django.core.exceptions import ValidationError
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.validators import validate_email
+from django.utils.module_loading import import_string
+
+from globee import cache as globee_cache
+from globee import metrics, resilience
+from globee.ratelimit import PRIORITY_INTERACTIVE, get_rate_limiter
+from globee.signals import globee_api_request
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+logger = getLogger(__name__)
+
+PaymentResult = namedtuple('PaymentResult', ('payment_id', 'data', 'error'))
+CreatedPayment = namedtuple('CreatedPayment', ('index', 'payment_id', 'redirect_url', 'data', 'error'))
+ApiRequest = namedtuple('ApiRequest', (
+    'method', 'endpoint', 'status_code', 'elapsed', 'request_bytes', 'response_bytes', 'new_connections', 'retries', 'exception'
+))
+
+_sessions = {}
+_sessions_lock = Lock()
+_async_clients = WeakKeyDictionary()
+_connection_stats = local()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _connection_stats.new_connections = getattr(_connection_stats, 'new_connections', 0) + 1
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _connection_stats.new_connections = getattr(_connection_stats, 'new_connections', 0) + 1
+        return super()._new_conn()
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """
+    Counts the connections opened by the current thread to tell new and reused connections apart.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool, 'https': CountingHTTPSConnectionPool}
+
+
+def get_api_collector():
+    """
+    Returns the collector set in GLOBEE_API_METRICS.
+    :return: callable(ApiRequest) or None
+    """
+    collector = getattr(settings, 'GLOBEE_API_METRICS', False)
+    if not collector:
+        return None
+    return observe_api_request if collector is True else import_string(collector)
+
+
+def observe_api_request(api_request: ApiRequest):
+    """
+    Default GLOBEE_API_METRICS collector, records the request in globee.metrics.registry.
+    :param api_request: the finished api request
+    """
+    endpoint = api_request.endpoint
+    metrics.api_request_seconds.observe(api_request.elapsed, endpoint=endpoint)
+    if api_request.exception is None:
+        metrics.api_responses.inc(endpoint=endpoint, status=api_request.status_code)
+    else:
+        metrics.api_exceptions.inc(endpoint=endpoint, exception=api_request.exception)
+    metrics.api_request_bytes.inc(api_request.request_bytes, endpoint=endpoint)
+    metrics.api_response_bytes.inc(api_request.response_bytes, endpoint=endpoint)
+    if api_request.new_connections:
+        metrics.api_new_connections.inc(api_request.new_connections, endpoint=endpoint)
+    if api_request.retries:
+        metrics.api_retries.inc(api_request.retries, endpoint=endpoint)
+
+
+def record_api_request(collector, sender, api_request: ApiRequest):
+    """
+    Passes a finished api request to the collector and sends the globee_api_request signal.
+    """
+    if collector is not None:
+        try:
+            collector(api_request)
+        except Exception:
+            logger.exception('Api metrics collector %r failed' % collector)
+    for receiver, response in globee_api_request.send_robust(sender=sender, api_request=api_request):
+        if isinstance(response, Exception):
+            logger.error('globee_api_request receiver %r failed: %r' % (receiver, response), exc_info=response)
+
+
+def get_session(auth_key: str, api_url: str):
+    """
+    Returns the process-wide pooled session for the given auth key and api url.
+    Connections are kept alive and reused by every GlobeePayment using the same credentials.
+    :param auth_key: the GloBee X-AUTH-KEY
+    :param api_url: the base url of the GloBee payment api (testnet or live)
+    :return: requests session
+    """
+    key = (auth_key, api_url)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({
+                'Accept': 'application/json',
+                'X-AUTH-KEY': auth_key,
+            })
+            adapter = CountingHTTPAdapter(
+                pool_connections=getattr(settings, 'GLOBEE_POOL_CONNECTIONS', 10),
+                pool_maxsize=getattr(settings, 'GLOBEE_POOL_MAXSIZE', 10),
+                max_retries=Retry(
+                    total=getattr(settings, 'GLOBEE_MAX_RETRIES', 0),
+                    # read timeouts are raised as requests.ReadTimeout and not retried
+                    read=False,
+                    backoff_factor=getattr(settings, 'GLOBEE_RETRY_BACKOFF', 0.5),
+                    status_forcelist=(502, 503, 504),
+                    raise_on_status=False,
+                ),
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            if not getattr(settings, 'GLOBEE_KEEP_ALIVE', True):
+                session.headers['Connection'] = 'close'
+            _sessions[key] = session
+    return session
+
+
+def close_sessions():
+    """
+    Closes all pooled sessions, e.g. after forking or when the settings have changed.
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_async_client(auth_key: str, api_url: str):
+    """
+    Returns the pooled async http client of the running event loop for the given auth key and api url.
+    :param auth_key: the GloBee X-AUTH-KEY
+    :param api_url: the base url of the GloBee payment api (testnet or live)
+    :return: httpx async client
+    """
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (auth_key, api_url)
+    client = clients.get(key)
+    if client is None or client.is_closed:
+        pool_maxsize = getattr(settings, 'GLOBEE_POOL_MAXSIZE', 10)
+        client = httpx.AsyncClient(
+            headers={
+                'Accept': 'application/json',
+                'X-AUTH-KEY': auth_key,
+            },
+            limits=httpx.Limits(
+                max_connections=pool_maxsize,
+                max_keepalive_connections=pool_maxsize if getattr(settings, 'GLOBEE_KEEP_ALIVE', True) else 0,
+            ),
+            transport=httpx.AsyncHTTPTransport(retries=getattr(settings, 'GLOBEE_MAX_RETRIES', 0)),
+        )
+        clients[key] = client
+    return client
+
+
+def get_async_timeout():
+    """
+    Returns GLOBEE_TIMEOUT as httpx timeout.
+    :return: httpx.Timeout
+    """
+    timeout = resilience.get_timeout()
+    if isinstance(timeout, (tuple, list)):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+
+async def close_async_clients():
+    """
+    Closes all pooled async clients of the running event loop.
+    """
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose()
 
 
 class GlobeePayment:
@@ -10,14 +213,16 @@ class GlobeePayment:
     Globee Payment
     """
 
-    def __init__(self, payment_data: dict = None, payment_id: str = None):
+    def __init__(self, payment_data: dict = None, payment_id: str = None, priority: str = PRIORITY_INTERACTIVE):
         """
         Init Globee payment
         :param payment_data: dict with payment data
         :param payment_id: the payment id that identifies the payment request
+        :param priority: rate limiter priority, PRIORITY_INTERACTIVE or PRIORITY_BATCH
         """
         self.payment_data = payment_data or dict()
         self.payment_id = payment_id
+        self.priority = priority
         self.redirect_url = None
 
         self.auth_key = getattr(settings, 'GLOBEE_AUTH_KEY', None)
@@ -30,24 +235,246 @@ class GlobeePayment:
             raise ValidationError('GLOBEE_AUTH_KEY is empty!')
 
         self.testnet = getattr(settings, 'GLOBEE_TESTNET', True)
-        self.api_url = 'https://%sglobee.com/payment-api/v1' % ('test.' if self.testnet else '')
+        self.api_url = getattr(settings, 'GLOBEE_API_URL', None) or 'https://%sglobee.com/payment-api/v1' % ('test.' if self.testnet else '')
 
         self.headers = {
             'Accept': 'application/json',
             'X-AUTH-KEY': self.auth_key
         }
+        self.session = get_session(self.auth_key, self.api_url)
 
-    def ping(self):
+    def _request(self, method: str, url: str, endpoint: str = None, **kwargs):
         """
-        Sends a ping to verify that the integration and authentication is done correctly.
-        :return: response with the merchant name and url
+        Sends a request to the GloBee payment api using the pooled session.
+        Applies GLOBEE_TIMEOUT, the circuit breaker (GLOBEE_CIRCUIT_BREAKER), the rate limiter (GLOBEE_RATE_LIMIT)
+        and the bulkhead (GLOBEE_BULKHEAD_SIZE).
+        :param method: http method
+        :param url: absolute api url
+        :param endpoint: endpoint name for the metrics
+        :return: response
+        """
+        kwargs.setdefault('timeout', resilience.get_timeout())
+        breaker = resilience.get_circuit_breaker(self.api_url)
+        limiter = get_rate_limiter(globee_cache.get_key_prefix(self.auth_key, self.api_url))
+        bulkhead = resilience.get_bulkhead(self.api_url)
+        if breaker is None and limiter is None and bulkhead is None:
+            return self._send(method, url, endpoint, **kwargs)
+
+        trial = breaker.before_request() if breaker is not None else False
+        try:
+            if limiter is not None:
+                limiter.acquire(self.priority)
+            if bulkhead is None:
+                r = self._send(method, url, endpoint, **kwargs)
+            else:
+                with bulkhead:
+                    r = self._send(method, url, endpoint, **kwargs)
+        except requests.RequestException:
+            if breaker is not None:
+                breaker.record_failure(trial)
+            raise
+        except resilience.GlobeeUnavailableError:
+            # rate limited or bulkhead full, give the next request the chance to be the trial
+            if trial:
+                breaker.cache.delete(breaker.trial_key)
+            raise
+        if breaker is not None:
+            if r.status_code >= 500:
+                breaker.record_failure(trial)
+            else:
+                breaker.record_success(trial)
+        return r
+
+    def _send(self, method: str, url: str, endpoint: str = None, **kwargs):
+        """
+        Sends a request using the pooled session, measured if GLOBEE_API_METRICS is set or globee_api_request has receivers.
+        """
+        collector = get_api_collector()
+        if collector is None and not globee_api_request.has_listeners(self.__class__):
+            return self.session.request(method, url, headers=self.headers, **kwargs)
+
+        connections = getattr(_connection_stats, 'new_connections', 0)
+        start = perf_counter()
+        try:
+            r = self.session.request(method, url, headers=self.headers, **kwargs)
+        except requests.RequestException as e:
+            request_body = e.request.body if e.request is not None else None
+            record_api_request(collector, self.__class__, ApiRequest(
+                method.upper(), endpoint, None, perf_counter() - start, len(request_body or b''), 0,
+                getattr(_connection_stats, 'new_connections', 0) - connections, None, e.__class__.__name__,
+            ))
+            raise
+        retries = getattr(r.raw, 'retries', None)
+        record_api_request(collector, self.__class__, ApiRequest(
+            method.upper(), endpoint, r.status_code, perf_counter() - start, len(r.request.body or b''), len(r.content),
+            getattr(_connection_stats, 'new_connections', 0) - connections, len(retries.history) if retries is not None else None, None,
+        ))
+        return r
+
+    def _get_cached(self, endpoint: str, fetch, payment_id: str = None, *key_parts, ttl=None):
+        """
+        Returns the response of an endpoint from the cache set in GLOBEE_CACHE or calls fetch().
+        """
+        cache_alias = globee_cache.get_cache_alias()
+        if not cache_alias:
+            return fetch()
+        prefix = globee_cache.get_key_prefix(self.auth_key, self.api_url)
+        if payment_id is None:
+            key = ':'.join([prefix, endpoint] + list(key_parts))
+            return globee_cache.get_or_fetch(cache_alias, key, ttl or globee_cache.get_ttl(endpoint), fetch)
+        key, version_key = globee_cache.get_payment_keys(prefix, endpoint, payment_id, *key_parts)
+        # the payment's expiry is only looked up on a miss
+        ttl = ttl or (lambda value: globee_cache.get_payment_ttl(endpoint, payment_id))
+        return globee_cache.get_or_fetch(cache_alias, key, ttl, fetch, version_key)
+
+    @staticmethod
+    def _validate_payments_data(payments_data: list):
+        """
+        Checks the required fields of every payment.
+        :return: tuple of (results with a CreatedPayment for every invalid payment, list of (index, payment data) to create)
+        """
+        results = [None] * len(payments_data)
+        valid = []
+        for index, payment_data in enumerate(payments_data):
+            try:
+                GlobeePayment(payment_data=payment_data).check_required_fields()
+            except ValidationError as e:
+                results[index] = CreatedPayment(index, None, None, None, e)
+            else:
+                valid.append((index, payment_data))
+        return results, valid
+
+    def _create_payment_result(self, index: int, payment_data: dict):
+        try:
+            r = self._request('post', '%s/payment-request' % self.api_url, endpoint='create_request', json=payment_data)
+        except Exception as e:
+            return CreatedPayment(index, None, None, None, e)
+        return self._get_created_payment(index, r)
+
+    def _get_created_payment(self, index: int, r):
+        """
+        :param index: index of the payment data
+        :param r: response of the create request
+        :return: CreatedPayment, with the error if the response is an error or lacks the id or redirect url
+        """
+        try:
+            data = self._get_response_data(r)
+            return CreatedPayment(index, data['id'], data['redirect_url'], data, None)
+        except Exception as e:
+            return CreatedPayment(index, None, None, None, e)
+
+    @staticmethod
+    def _create_ipns(results: list, batch_size: int = 500):
+        """
+        Inserts a GlobeeIPN for every created payment, existing payments are skipped.
+        """
+        from globee.ipn import get_ipn_defaults
+        from globee.models import GlobeeIPN
+
+        payments = []
+        for result in results:
+            if result.error is None:
+                try:
+                    payments.append(GlobeeIPN(payment_id=result.payment_id, **get_ipn_defaults(result.data)))
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning('Could not save created payment %s: %r' % (result.payment_id, e))
+        GlobeeIPN.objects.bulk_create(payments, batch_size=batch_size, ignore_conflicts=True)
+
+    def update_payment_cache(self, payment_data: dict):
+        """
+        Stores payment data fetched from GloBee in the get_payment_by_id() cache (GLOBEE_CACHE_PAYMENTS).
+        :param payment_data: payment data fetched from GloBee
+        """
+        cache_alias = globee_cache.get_cache_alias()
+        if cache_alias and getattr(settings, 'GLOBEE_CACHE_PAYMENTS', False):
+            prefix = globee_cache.get_key_prefix(self.auth_key, self.api_url)
+            globee_cache.set_payment(cache_alias, prefix, 'payment', payment_data['id'], payment_data, globee_cache.get_status_ttl(payment_data))
+
+    def invalidate_payment_cache(self, payment_id: str = None):
+        """
+        Removes the cached details of a payment request.
+        :param payment_id: the payment id that identifies the payment request
+        """
+        cache_alias = globee_cache.get_cache_alias()
+        if cache_alias:
+            prefix = globee_cache.get_key_prefix(self.auth_key, self.api_url)
+            globee_cache.invalidate_payment(cache_alias, prefix, self._get_payment_id(payment_id))
+
+    def invalidate_payment_methods_cache(self):
+        """
+        Removes the cached payment methods of the merchant account.
         """
-        r = requests.get('%s/ping' % self.api_url, headers=self.headers)
+        cache_alias = globee_cache.get_cache_alias()
+        if cache_alias:
+            caches[cache_alias].delete('%s:payment_methods' % globee_cache.get_key_prefix(self.auth_key, self.api_url))
+
+    def _get_payment_id(self, payment_id: str = None):
+        """
+        Returns the given payment id or the payment id set in init.
+        :param payment_id: the payment id that identifies the payment request
+        :return: payment id
+        """
+        payment_id = payment_id or self.payment_id
+        if not payment_id:
+            raise ValidationError('payment_id is None/empty')
+        return payment_id
+
+    def _get_update_data(self, payment_id: str = None, payment_data: dict = None):
+        """
+        Validates the payment id and data for a payment request update.
+        :param payment_id: the payment id that identifies the payment request
+        :param payment_data: dict with payment data
+        :return: payment id and payment data
+        """
+        payment_id = payment_id or self.payment_id
+        payment_data = payment_data or self.payment_data
+
+        if not payment_id:
+            raise ValidationError('payment_id is None/empty')
+        elif not payment_data:
+            raise ValidationError('payment_data is None/empty')
+
+        try:
+            email = self.payment_data['customer']['email']
+        except KeyError as e:
+            raise ValidationError("%s not set" % e)
+
+        validate_email(payment_data['customer']['email'])
+        return payment_id, payment_data
+
+    def _get_currency_details_url(self, currency_id: str, payment_id: str = None, address_id: str = None):
+        url = '%s/payment-request/%s/addresses/%s' % (self.api_url, self._get_payment_id(payment_id), currency_id)
+        if address_id:
+            url += '/%s' % address_id
+        return url
+
+    @staticmethod
+    def _get_ping_response(r):
         response = r.json()
         if r.status_code == 200 and response.get('success'):
             return response
         raise ValidationError("status code %s: %s" % (r.status_code, response['message']))
 
+    @staticmethod
+    def _get_response_data(r):
+        response = r.json()
+        if r.status_code == 200 and response.get('success'):
+            return response['data']
+        raise ValidationError('status code: %s - %s' % (r.status_code, response), code=r.status_code)
+
+    def _set_created_request(self, data: dict):
+        self.redirect_url = data['redirect_url']
+        self.payment_id = data['id']
+        return self.redirect_url
+
+    def ping(self):
+        """
+        Sends a ping to verify that the integration and authentication is done correctly.
+        :return: response with the merchant name and url
+        """
+        r = self._request('get', '%s/ping' % self.api_url, endpoint='ping')
+        return self._get_ping_response(r)
+
     def check_required_fields(self):
         """
         Checks all required fields.
@@ -69,13 +496,26 @@ class GlobeePayment:
         Creates a new payment request.
         :return: payment url
         """
-        r = requests.post('%s/payment-request' % self.api_url, headers=self.headers, json=self.payment_data)
-        response = r.json()
-        if r.status_code == 200 and response.get('success'):
-            self.redirect_url = response['data']['redirect_url']
-            self.payment_id = response['data']['id']
-            return response['data']['redirect_url']
-        raise ValidationError('status code: %s - %s' % (r.status_code, response))
+        r = self._request('post', '%s/payment-request' % self.api_url, endpoint='create_request', json=self.payment_data)
+        return self._set_created_request(self._get_response_data(r))
+
+    def create_requests(self, payments_data, max_workers: int = None, create_ipns: bool = False):
+        """
+        Creates many payment requests concurrently. All payments are validated with check_required_fields() first,
+        invalid payments are not sent. Failed requests are not retried because GloBee may have created the payment.
+        :param payments_data: iterable of dicts with payment data
+        :param max_workers: number of concurrent requests (default: GLOBEE_MAX_WORKERS)
+        :param create_ipns: True to insert a GlobeeIPN for every created payment with one bulk insert
+        :return: list of CreatedPayment(index, payment_id, redirect_url, data, error) in order of the payments data
+        """
+        results, valid = self._validate_payments_data(list(payments_data))
+        if valid:
+            with ThreadPoolExecutor(max_workers=max_workers or getattr(settings, 'GLOBEE_MAX_WORKERS', 8)) as executor:
+                for result in executor.map(lambda item: self._create_payment_result(*item), valid):
+                    results[result.index] = result
+        if create_ipns:
+            self._create_ipns(results)
+        return results
 
     def get_payment_url(self):
         """
@@ -84,21 +524,49 @@ class GlobeePayment:
         """
         return self.redirect_url
 
-    def get_payment_by_id(self, payment_id: str = None):
+    def get_payment_by_id(self, payment_id: str = None, cached: bool = True):
         """
         Fetches a previously created payment request by payment_id.
         :param payment_id: the payment id that identifies the payment request
+        :param cached: False to bypass the cache if GLOBEE_CACHE_PAYMENTS is enabled
         :return: payment data
         """
-        payment_id = payment_id or self.payment_id
-        if not payment_id:
-            raise ValidationError('payment_id is None/empty')
+        payment_id = self._get_payment_id(payment_id)
 
-        r = requests.get('%s/payment-request/%s' % (self.api_url, payment_id), headers=self.headers)
-        response = r.json()
-        if r.status_code == 200 and response.get('success'):
-            return response['data']
-        raise ValidationError('status code: %s - %s' % (r.status_code, response))
+        def fetch():
+            return self._get_response_data(self._request('get', '%s/payment-request/%s' % (self.api_url, payment_id), endpoint='get_payment_by_id'))
+
+        if not cached or not getattr(settings, 'GLOBEE_CACHE_PAYMENTS', False):
+            return fetch()
+        return self._get_cached('payment', fetch, payment_id, ttl=globee_cache.get_status_ttl)
+
+    def _get_payment_result(self, payment_id: str):
+        try:
+            return PaymentResult(payment_id, self.get_payment_by_id(payment_id, cached=False), None)
+        except Exception as e:
+            return PaymentResult(payment_id, None, e)
+
+    def get_payments_by_ids(self, payment_ids, max_workers: int = None):
+        """
+        Fetches many payment requests concurrently, bypassing the cache. At most 2 * max_workers requests
+        are pending at once, so the payment ids can be a generator of any length.
+        :param payment_ids: iterable of payment ids
+        :param max_workers: number of concurrent requests (default: GLOBEE_MAX_WORKERS)
+        :return: generator of PaymentResult(payment_id, data, error) in order of completion
+        """
+        max_workers = max_workers or getattr(settings, 'GLOBEE_MAX_WORKERS', 8)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = set()
+            for payment_id in payment_ids:
+                pending.add(executor.submit(self._get_payment_result, payment_id))
+                if len(pending) >= 2 * max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
 
     def update_payment_request(self, payment_id: str = None, payment_data: dict = None):
         """
@@ -107,44 +575,235 @@ class GlobeePayment:
         :param payment_data: dict with payment data
         :return: response data
         """
-        payment_id = payment_id or self.payment_id
-        payment_data = payment_data or self.payment_data
+        payment_id, payment_data = self._get_update_data(payment_id, payment_data)
+        r = self._request('put', '%s/payment-request/%s' % (self.api_url, payment_id), endpoint='update_payment_request', json=payment_data)
+        data = self._get_response_data(r)
+        self.invalidate_payment_cache(payment_id)
+        return data
 
-        if not payment_id:
-            raise ValidationError('payment_id is None/empty')
-        elif not payment_data:
-            raise ValidationError('payment_data is None/empty')
+    def get_payment_details(self, payment_id: str = None):
+        """
+        Returns the accepted crypto-currencies and associated address information for the payment-request associated with the given id.
+        :param payment_id: the payment id that identifies the payment request
+        :return: return payment details like accepted crypto-currencies and associated address information
+        """
+        payment_id = self._get_payment_id(payment_id)
+        return self._get_cached('payment_details', lambda: self._get_response_data(
+            self._request('get', '%s/payment-request/%s/payment-methods' % (self.api_url, payment_id), endpoint='get_payment_details')
+        ), payment_id)
 
+    def get_payment_currency_details(self, currency_id: str, payment_id: str = None, address_id: str = None):
+        """
+        Generates and returns the payment details for a given payment request and payment currency.
+        :param currency_id: one of the currency id's: BTC, XMR, LTC, DOGE, ETH, XRP etc.
+        :param payment_id: the payment id that identifies the payment request
+        :param address_id: the address id if it has been assigned. Examples: default, lightning_address
+        :return: returns the payment details for a given payment request and payment currency
+        """
+        url = self._get_currency_details_url(currency_id, payment_id, address_id)
+        return self._get_cached('payment_currency_details', lambda: self._get_response_data(
+            self._request('get', url, endpoint='get_payment_currency_details')
+        ), self._get_payment_id(payment_id), currency_id, address_id or '')
+
+    def get_payment_methods(self):
+        """
+        This returns the merchant account's accepted crypto-currencies.
+        :return: returns accepted crypto-currencies
+        """
+        return self._get_cached('payment_methods', lambda: self._get_response_data(
+            self._request('get', '%s/account/payment-methods' % self.api_url, endpoint='get_payment_methods')
+        ))
+
+
+class AsyncGlobeePayment(GlobeePayment):
+    """
+    Globee Payment using a non-blocking http client. All api calls are coroutines.
+    """
+
+    def __init__(self, payment_data: dict = None, payment_id: str = None, priority: str = PRIORITY_INTERACTIVE):
+        """
+        Init async Globee payment
+        :param payment_data: dict with payment data
+        :param payment_id: the payment id that identifies the payment request
+        :param priority: rate limiter priority, PRIORITY_INTERACTIVE or PRIORITY_BATCH
+        """
+        if httpx is None:
+            raise ImproperlyConfigured('AsyncGlobeePayment requires httpx. Install it with "pip install django-globee[async]".')
+        super().__init__(payment_data=payment_data, payment_id=payment_id, priority=priority)
+
+    @property
+    def client(self):
+        return get_async_client(self.auth_key, self.api_url)
+
+    async def _request(self, method: str, url: str, endpoint: str = None, **kwargs):
+        """
+        Sends a request to the GloBee payment api using the pooled async client of the running event loop.
+        Applies GLOBEE_TIMEOUT, the circuit breaker (GLOBEE_CIRCUIT_BREAKER), the rate limiter (GLOBEE_RATE_LIMIT)
+        and the bulkhead (GLOBEE_BULKHEAD_SIZE), their cache accesses run in worker threads.
+        :param method: http method
+        :param url: absolute api url
+        :param endpoint: endpoint name for the metrics
+        :return: response
+        """
+        kwargs.setdefault('timeout', get_async_timeout())
+        breaker = resilience.get_circuit_breaker(self.api_url)
+        limiter = get_rate_limiter(globee_cache.get_key_prefix(self.auth_key, self.api_url))
+        bulkhead = resilience.get_bulkhead(self.api_url)
+        if breaker is None and limiter is None and bulkhead is None:
+            return await self._send(method, url, endpoint, **kwargs)
+
+        trial = await sync_to_async(breaker.before_request, thread_sensitive=False)() if breaker is not None else False
         try:
-            email = self.payment_data['customer']['email']
-        except KeyError as e:
-            raise ValidationError("%s not set" % e)
+            if limiter is not None:
+                await limiter.aacquire(self.priority)
+            if bulkhead is None:
+                r = await self._send(method, url, endpoint, **kwargs)
+            else:
+                async with bulkhead:
+                    r = await self._send(method, url, endpoint, **kwargs)
+        except httpx.HTTPError:
+            if breaker is not None:
+                await sync_to_async(breaker.record_failure, thread_sensitive=False)(trial)
+            raise
+        except resilience.GlobeeUnavailableError:
+            # rate limited or bulkhead full, give the next request the chance to be the trial
+            if trial:
+                await breaker.cache.adelete(breaker.trial_key)
+            raise
+        if breaker is not None:
+            if r.status_code >= 500:
+                await sync_to_async(breaker.record_failure, thread_sensitive=False)(trial)
+            else:
+                await sync_to_async(breaker.record_success, thread_sensitive=False)(trial)
+        return r
 
-        validate_email(payment_data['customer']['email'])
+    async def _send(self, method: str, url: str, endpoint: str = None, **kwargs):
+        """
+        Sends a request using the pooled async client, measured if GLOBEE_API_METRICS is set or globee_api_request
+        has receivers. New connections and retries are not reported (None).
+        """
+        collector = get_api_collector()
+        if collector is None and not globee_api_request.has_listeners(self.__class__):
+            return await self.client.request(method, url, headers=self.headers, **kwargs)
 
-        r = requests.put('%s/payment-request/%s' % (self.api_url, payment_id), headers=self.headers, json=payment_data)
-        response = r.json()
-        if r.status_code == 200 and response.get('success'):
-            return response['data']
-        raise ValidationError('status code: %s - %s' % (r.status_code, response))
+        start = perf_counter()
+        try:
+            r = await self.client.request(method, url, headers=self.headers, **kwargs)
+        except httpx.HTTPError as e:
+            record_api_request(collector, self.__class__, ApiRequest(
+                method.upper(), endpoint, None, perf_counter() - start, 0, 0, None, None, e.__class__.__name__,
+            ))
+            raise
+        record_api_request(collector, self.__class__, ApiRequest(
+            method.upper(), endpoint, r.status_code, perf_counter() - start, len(r.request.content), len(r.content), None, None, None,
+        ))
+        return r
 
-    def get_payment_details(self, payment_id: str = None):
+    async def ping(self):
+        """
+        Sends a ping to verify that the integration and authentication is done correctly.
+        :return: response with the merchant name and url
+        """
+        r = await self._request('get', '%s/ping' % self.api_url, endpoint='ping')
+        return self._get_ping_response(r)
+
+    async def create_request(self):
+        """
+        Creates a new payment request.
+        :return: payment url
+        """
+        r = await self._request('post', '%s/payment-request' % self.api_url, endpoint='create_request', json=self.payment_data)
+        return self._set_created_request(self._get_response_data(r))
+
+    async def create_requests(self, payments_data, max_workers: int = None, create_ipns: bool = False):
+        """
+        See GlobeePayment.create_requests(), max_workers limits the requests in flight instead of threads.
+        """
+        results, valid = self._validate_payments_data(list(payments_data))
+        semaphore = asyncio.Semaphore(max_workers or getattr(settings, 'GLOBEE_MAX_WORKERS', 8))
+
+        async def create(index, payment_data):
+            async with semaphore:
+                return await self._create_payment_result(index, payment_data)
+
+        for result in await asyncio.gather(*[create(index, payment_data) for index, payment_data in valid]):
+            results[result.index] = result
+        if create_ipns:
+            await sync_to_async(self._create_ipns)(results)
+        return results
+
+    async def _create_payment_result(self, index: int, payment_data: dict):
+        try:
+            r = await self._request('post', '%s/payment-request' % self.api_url, endpoint='create_request', json=payment_data)
+        except Exception as e:
+            return CreatedPayment(index, None, None, None, e)
+        return self._get_created_payment(index, r)
+
+    async def get_payment_by_id(self, payment_id: str = None, cached: bool = True):
+        """
+        Fetches a previously created payment request by payment_id.
+        :param payment_id: the payment id that identifies the payment request
+        :param cached: False to bypass the cache if GLOBEE_CACHE_PAYMENTS is enabled
+        :return: payment data
+        """
+        payment_id = self._get_payment_id(payment_id)
+
+        async def fetch():
+            r = await self._request('get', '%s/payment-request/%s' % (self.api_url, payment_id), endpoint='get_payment_by_id')
+            return self._get_response_data(r)
+
+        cache_alias = globee_cache.get_cache_alias()
+        if not cached or not cache_alias or not getattr(settings, 'GLOBEE_CACHE_PAYMENTS', False):
+            return await fetch()
+        prefix = globee_cache.get_key_prefix(self.auth_key, self.api_url)
+        key, version_key = globee_cache.get_payment_keys(prefix, 'payment', payment_id)
+        return await globee_cache.aget_or_fetch(cache_alias, key, globee_cache.get_status_ttl, fetch, version_key)
+
+    async def _get_payment_result(self, payment_id: str):
+        try:
+            return PaymentResult(payment_id, await self.get_payment_by_id(payment_id, cached=False), None)
+        except Exception as e:
+            return PaymentResult(payment_id, None, e)
+
+    def get_payments_by_ids(self, payment_ids, max_workers: int = None):
+        """
+        Fetches many payment requests concurrently. At most max_workers requests are pending at once,
+        so the payment ids can be a generator of any length.
+        :param payment_ids: iterable of payment ids
+        :param max_workers: number of concurrent requests (default: GLOBEE_MAX_WORKERS)
+        :return: async iterator of PaymentResult(payment_id, data, error) in order of completion, cancels the pending
+            requests on aclose() or when used as async context manager
+        """
+        return _AsyncPaymentResults(self, payment_ids, max_workers or getattr(settings, 'GLOBEE_MAX_WORKERS', 8))
+
+    async def update_payment_request(self, payment_id: str = None, payment_data: dict = None):
+        """
+        Updates an existing payment request.
+        :param payment_id: the payment id that identifies the payment request
+        :param payment_data: dict with payment data
+        :return: response data
+        """
+        payment_id, payment_data = self._get_update_data(payment_id, payment_data)
+        r = await self._request('put', '%s/payment-request/%s' % (self.api_url, payment_id), endpoint='update_payment_request', json=payment_data)
+        data = self._get_response_data(r)
+        await sync_to_async(self.invalidate_payment_cache)(payment_id)
+        return data
+
+    async def get_payment_details(self, payment_id: str = None):
         """
         Returns the accepted crypto-currencies and associated address information for the payment-request associated with the given id.
         :param payment_id: the payment id that identifies the payment request
         :return: return payment details like accepted crypto-currencies and associated address information
         """
-        payment_id = payment_id or self.payment_id
-        if not payment_id:
-            raise ValidationError('payment_id is None/empty')
+        payment_id = self._get_payment_id(payment_id)
 
-        r = requests.get('%s/payment-request/%s/payment-methods' % (self.api_url, payment_id), headers=self.headers)
-        response = r.json()
-        if r.status_code == 200 and response.get('success'):
-            return response['data']
-        raise ValidationError('status code: %s - %s' % (r.status_code, response))
+        async def fetch():
+            r = await self._request('get', '%s/payment-request/%s/payment-methods' % (self.api_url, payment_id), endpoint='get_payment_details')
+            return self._get_response_data(r)
 
-    def get_payment_currency_details(self, currency_id: str, payment_id: str = None, address_id: str = None):
+        return await self._aget_cached('payment_details', fetch, payment_id)
+
+    async def get_payment_currency_details(self, currency_id: str, payment_id: str = None, address_id: str = None):
         """
         Generates and returns the payment details for a given payment request and payment currency.
         :param currency_id: one of the currency id's: BTC, XMR, LTC, DOGE, ETH, XRP etc.
@@ -152,28 +811,84 @@ class GlobeePayment:
         :param address_id: the address id if it has been assigned. Examples: default, lightning_address
         :return: returns the payment details for a given payment request and payment currency
         """
-        payment_id = payment_id or self.payment_id
-        if not payment_id:
-            raise ValidationError('payment_id is None/empty')
+        url = self._get_currency_details_url(currency_id, payment_id, address_id)
 
-        url = '%s/payment-request/%s/addresses/%s' % (self.api_url, payment_id, currency_id)
-        if address_id:
-            url += '/%s' % address_id
+        async def fetch():
+            r = await self._request('get', url, endpoint='get_payment_currency_details')
+            return self._get_response_data(r)
 
-        r = requests.get(url, headers=self.headers)
-        response = r.json()
-        if r.status_code == 200 and response.get('success'):
-            return response['data']
-        raise ValidationError('status code: %s - %s' % (r.status_code, response))
+        return await self._aget_cached('payment_currency_details', fetch, self._get_payment_id(payment_id), currency_id, address_id or '')
 
-    def get_payment_methods(self):
+    async def get_payment_methods(self):
         """
         This returns the merchant account's accepted crypto-currencies.
         :return: returns accepted crypto-currencies
         """
-        r = requests.get('%s/account/payment-methods' % self.api_url, headers=self.headers)
-        response = r.json()
-        if r.status_code == 200 and response.get('success'):
-            return response['data']
-        raise ValidationError('status code: %s - %s' % (r.status_code, response))
+        async def fetch():
+            r = await self._request('get', '%s/account/payment-methods' % self.api_url, endpoint='get_payment_methods')
+            return self._get_response_data(r)
+
+        return await self._aget_cached('payment_methods', fetch)
+
+    async def _aget_cached(self, endpoint: str, fetch, payment_id: str = None, *key_parts):
+        """
+        Async variant of _get_cached(), fetch is a coroutine function.
+        """
+        cache_alias = globee_cache.get_cache_alias()
+        if not cache_alias:
+            return await fetch()
+        prefix = globee_cache.get_key_prefix(self.auth_key, self.api_url)
+        if payment_id is None:
+            key = ':'.join([prefix, endpoint] + list(key_parts))
+            return await globee_cache.aget_or_fetch(cache_alias, key, globee_cache.get_ttl(endpoint), fetch)
+        key, version_key = globee_cache.get_payment_keys(prefix, endpoint, payment_id, *key_parts)
+        # the payment's expiry is only looked up on a miss
+        ttl = lambda value: globee_cache.aget_payment_ttl(endpoint, payment_id)
+        return await globee_cache.aget_or_fetch(cache_alias, key, ttl, fetch, version_key)
+
+
+class _AsyncPaymentResults:
+    """
+    Async iterator behind AsyncGlobeePayment.get_payments_by_ids. Use it as async context manager or call aclose()
+    if you stop iterating early, so the requests still in flight are cancelled.
+    """
+
+    def __init__(self, globee_payment: AsyncGlobeePayment, payment_ids, max_workers: int):
+        self.globee_payment = globee_payment
+        self.payment_ids = iter(payment_ids)
+        self.max_workers = max_workers
+        self.pending = set()
+        self.done = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.done:
+            for payment_id in self.payment_ids:
+                self.pending.add(asyncio.ensure_future(self.globee_payment._get_payment_result(payment_id)))
+                if len(self.pending) >= self.max_workers:
+                    break
+            if not self.pending:
+                raise StopAsyncIteration
+            done, self.pending = await asyncio.wait(self.pending, return_when=asyncio.FIRST_COMPLETED)
+            self.done.extend(done)
+        return self.done.pop().result()
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Cancels the pending requests and ends the iteration.
+        """
+        self.payment_ids = iter(())
+        self.done = []
+        pending, self.pending = self.pending, set()
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from logging import getLogger
+from threading import BoundedSemaphore, Lock
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+
+from globee.metrics import registry
+
+
+logger = getLogger(__name__)
+
+_executors = {}
+_executors_lock = Lock()
+_queue_slots = None
+
+signals_dropped = registry.counter('globee_signals_dropped_total', 'Deferred signals dropped because the signal queue was full')
+
+
+def _get_executor(name: str):
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'GLOBEE_SIGNAL_WORKERS', 4),
+                    thread_name_prefix='globee-signal-%s' % name,
+                )
+                _executors[name] = executor
+    return executor
+
+
+def _get_queue_slots():
+    global _queue_slots
+    slots = _queue_slots
+    if slots is None:
+        with _executors_lock:
+            if _queue_slots is None:
+                _queue_slots = BoundedSemaphore(getattr(settings, 'GLOBEE_SIGNAL_QUEUE_SIZE', 1000))
+            slots = _queue_slots
+    return slots
+
+
+def _get_receivers(signal, sender):
+    # Signal has no public api to list the receivers, send_robust() would run them one after another
+    receivers = signal._live_receivers(sender)
+    if isinstance(receivers, tuple):
+        # Django >= 5.0 returns sync and async receivers separately
+        from asgiref.sync import async_to_sync
+        sync_receivers, async_receivers = receivers
+        receivers = list(sync_receivers) + [async_to_sync(receiver) for receiver in async_receivers]
+    return receivers
+
+
+def _run_receiver(signal, receiver, sender, kwargs):
+    close_old_connections()
+    try:
+        receiver(signal=signal, sender=sender, **kwargs)
+    except Exception:
+        logger.exception('Receiver %r of %r failed for %s' % (receiver, signal, sender))
+    finally:
+        close_old_connections()
+
+
+def _dispatch(signal, sender, kwargs, slots):
+    """
+    Runs every receiver as its own task on the receivers pool and logs every receiver that didn't finish within
+    GLOBEE_SIGNAL_TIMEOUT. The receivers keep running after the timeout, the queue slot is freed once all finished.
+    """
+    timeout = getattr(settings, 'GLOBEE_SIGNAL_TIMEOUT', 30)
+    try:
+        receivers = _get_receivers(signal, sender)
+    except Exception:
+        slots.release()
+        raise
+    if not receivers:
+        slots.release()
+        return
+    pending = [len(receivers)]
+    pending_lock = Lock()
+
+    def release(future=None):
+        with pending_lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        slots.release()
+
+    executor = _get_executor('receivers')
+    futures = {}
+    for receiver in receivers:
+        try:
+            future = executor.submit(_run_receiver, signal, receiver, sender, kwargs)
+        except RuntimeError as e:
+            # the pool was shut down
+            logger.error('Receiver %r of %r was not run for %s: %r' % (receiver, signal, sender, e))
+            release()
+            continue
+        futures[future] = receiver
+        future.add_done_callback(release)
+    done, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        logger.warning('Receiver %r of %r did not finish within %ss for %s' % (futures[future], signal, timeout, sender))
+
+
+def _submit(signal, sender, kwargs):
+    """
+    Queues the signal for the thread pools. If GLOBEE_SIGNAL_QUEUE_SIZE signals are already queued or running,
+    the signal is dropped and logged, so neither the queue grows nor the committing request runs the receivers.
+    """
+    slots = _get_queue_slots()
+    if not slots.acquire(blocking=False):
+        signals_dropped.inc()
+        logger.error('Signal queue is full, dropped %r for %s' % (signal, sender))
+        return
+    try:
+        _get_executor('dispatch').submit(_dispatch, signal, sender, kwargs, slots)
+    except Exception:
+        slots.release()
+        raise
+
+
+def send_signal(signal, sender, **kwargs):
+    """
+    Sends a signal according to GLOBEE_SIGNAL_DISPATCH:
+    'sync' runs the receivers immediately,
+    'deferred' runs every receiver as its own task on a thread pool after the current transaction was committed,
+    a dotted path to a callable(signal, sender, **kwargs) hands the signal to a task queue after the commit.
+    :param signal: signal
+    :param sender: sender, usually a GlobeeIPN
+    :param kwargs: additional arguments for the receivers
+    """
+    mode = getattr(settings, 'GLOBEE_SIGNAL_DISPATCH', 'sync')
+    if mode == 'sync':
+        signal.send(sender=sender, **kwargs)
+    elif mode == 'deferred':
+        transaction.on_commit(lambda: _submit(signal, sender, kwargs))
+    else:
+        dispatcher = import_string(mode)
+        transaction.on_commit(lambda: dispatcher(signal, sender, **kwargs))
+
+
+def shutdown(wait: bool = True):
+    """
+    Stops the thread pools, e.g. before the process exits.
+    :param wait: wait for the pending receivers
+    """
+    global _queue_slots
+    with _executors_lock:
+        _queue_slots = None
+        for name in ('dispatch', 'receivers'):
+            executor = _executors.pop(name, None)
+            if executor is not None:
+                executor.shutdown(wait=wait)
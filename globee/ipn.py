@@ -0,0 +1,470 @@
+from datetime import datetime, timedelta
+from time import monotonic
+from json import loads as json_loads
+from logging import getLogger
+
+from pytz import utc as pytz_utc
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from globee.cache import get_cache_alias
+from globee.core import AsyncGlobeePayment, GlobeePayment
+from globee.metrics import StageTimer, ipn_duplicates, ipn_seconds, ipn_stage_seconds, null_timer
+from globee.models import (
+    GlobeeIPN, PAYMENT_STATUS_EXPIRED, PAYMENT_STATUS_GLOBEE_UNPAID, SPEED_STATUS_GLOBEE_MEDIUM, VERIFICATION_STATUS_FAILED,
+    VERIFICATION_STATUS_PENDING, VERIFICATION_STATUS_VERIFIED,
+)
+from globee.ratelimit import PRIORITY_BATCH
+from globee.singleflight import SingleFlight
+
+
+logger = getLogger(__name__)
+
+VERIFY_SYNC = 'sync'
+VERIFY_DEFERRED = 'deferred'
+
+# status codes of GloBee responses that reject a payment for good
+REJECTED_STATUS_CODES = (404, 422)
+
+# GlobeeIPN fields set from the GloBee payment data, see get_ipn_defaults()
+GLOBEE_FIELDS = ('payment_status', 'total', 'currency', 'custom_payment_id', 'callback_data', 'customer_email',
+                 'customer_name', 'confirmation_speed', 'created_at', 'expires_at')
+
+verification_flight = SingleFlight('verification')
+
+
+def get_verify_mode():
+    """
+    Returns the verification mode set in GLOBEE_AUTO_VERIFY.
+    :return: VERIFY_SYNC, VERIFY_DEFERRED or None
+    """
+    auto_verify = getattr(settings, 'GLOBEE_AUTO_VERIFY', False)
+    if auto_verify == VERIFY_DEFERRED:
+        return VERIFY_DEFERRED
+    return VERIFY_SYNC if auto_verify else None
+
+
+def get_ipn_timer():
+    """
+    Returns a stage timer if GLOBEE_IPN_TIMING or GLOBEE_IPN_SLOW_THRESHOLD is set.
+    :return: StageTimer or the no-op null_timer
+    """
+    if getattr(settings, 'GLOBEE_IPN_TIMING', False) or getattr(settings, 'GLOBEE_IPN_SLOW_THRESHOLD', None) is not None:
+        return StageTimer()
+    return null_timer
+
+
+def observe_ipn_timings(timings: list, payment_id: str = None):
+    """
+    Default GLOBEE_IPN_TIMING hook, records the timings in globee.metrics.registry.
+    :param timings: list of (stage, seconds)
+    :param payment_id: payment id or None if the IPN could not be decoded
+    """
+    for stage, seconds in timings:
+        ipn_stage_seconds.observe(seconds, stage=stage)
+    ipn_seconds.observe(sum(seconds for stage, seconds in timings))
+
+
+def record_ipn_timings(timer: StageTimer):
+    """
+    Passes the stage timings to the GLOBEE_IPN_TIMING hook and logs IPNs slower than GLOBEE_IPN_SLOW_THRESHOLD.
+    :param timer: stage timer of the IPN
+    """
+    if not timer.enabled:
+        return
+    hook = getattr(settings, 'GLOBEE_IPN_TIMING', False)
+    if hook:
+        # runs after the response was built, a wrong hook path must not fail the IPN
+        try:
+            (observe_ipn_timings if hook is True else import_string(hook))(timer.timings, timer.payment_id)
+        except Exception:
+            logger.exception('IPN timing hook %r failed' % hook)
+    threshold = getattr(settings, 'GLOBEE_IPN_SLOW_THRESHOLD', None)
+    if threshold is not None and timer.total >= threshold:
+        logger.warning('Slow IPN %s: %.3fs (%s)' % (
+            timer.payment_id, timer.total, ', '.join('%s %.3fs' % timing for timing in timer.timings)
+        ))
+
+
+def get_verified_payment_data(payment_id: str):
+    """
+    Fetches the payment data from GloBee. Concurrent verifications of the same payment share one request
+    (GLOBEE_VERIFY_COALESCE), across processes if GLOBEE_VERIFY_COALESCE_CACHE is set.
+    :param payment_id: the payment id that identifies the payment request
+    :return: payment data
+    """
+    globee_payment = GlobeePayment()
+    if not getattr(settings, 'GLOBEE_VERIFY_COALESCE', True):
+        return globee_payment.get_payment_by_id(payment_id, cached=False)
+    return verification_flight.do(
+        payment_id, globee_payment.get_payment_by_id, payment_id, False,
+        cache_alias=getattr(settings, 'GLOBEE_VERIFY_COALESCE_CACHE', None),
+    )
+
+
+async def aget_verified_payment_data(payment_id: str):
+    """
+    Async variant of get_verified_payment_data, requests are shared within the event loop.
+    :param payment_id: the payment id that identifies the payment request
+    :return: payment data
+    """
+    globee_payment = AsyncGlobeePayment()
+    if not getattr(settings, 'GLOBEE_VERIFY_COALESCE', True):
+        return await globee_payment.get_payment_by_id(payment_id, cached=False)
+    return await verification_flight.ado(payment_id, globee_payment.get_payment_by_id, payment_id, False)
+
+
+def get_ipn_defaults(payment_data: dict):
+    """
+    Maps the GloBee payment data to GlobeeIPN fields.
+    :param payment_data: payment data sent to the IPN view or fetched from GloBee
+    :return: dict with GlobeeIPN field values, without the payment id
+    """
+    created_at = datetime.strptime(payment_data['created_at'], '%Y-%m-%d %H:%M:%S')
+    expires_at = datetime.strptime(payment_data['expires_at'], '%Y-%m-%d %H:%M:%S')
+
+    return {
+        'payment_status': payment_data['status'],
+        'total': float(payment_data['total']),
+        'currency': payment_data['currency'],
+        'custom_payment_id': payment_data['custom_payment_id'],
+        'callback_data': payment_data['callback_data'],
+        'customer_email': payment_data['customer']['email'],
+        'customer_name': payment_data['customer']['name'],
+        'confirmation_speed': payment_data.get('confirmation_speed') or SPEED_STATUS_GLOBEE_MEDIUM,
+        'created_at': pytz_utc.localize(created_at),
+        'expires_at': pytz_utc.localize(expires_at),
+    }
+
+
+def send_ipn_signal(payment, created: bool, changed: bool):
+    """
+    Sends globee_valid_ipn for new or changed payments. Unchanged re-deliveries are counted and,
+    if GLOBEE_DUPLICATE_SIGNAL is set, announced with globee_duplicate_ipn instead.
+    :param payment: the saved GlobeeIPN
+    :param created: True if the payment was created
+    :param changed: True if the payment was created or updated
+    """
+    if created or changed or not getattr(settings, 'GLOBEE_SKIP_DUPLICATE_IPN', True):
+        payment.send_valid_signal()
+        return
+    ipn_duplicates.inc()
+    if getattr(settings, 'GLOBEE_DUPLICATE_SIGNAL', False):
+        payment.send_duplicate_signal()
+
+
+def save_ipn(payment_data: dict, verify_mode: str = None, timer: StageTimer = null_timer):
+    """
+    Saves the payment data and sends the signal. With deferred verification new or changed payments
+    are marked as pending instead and the signal is sent by verify_pending_ipns().
+    :param payment_data: payment data sent to the IPN view or fetched from GloBee
+    :param verify_mode: VERIFY_SYNC if the payment data was fetched from GloBee, VERIFY_DEFERRED or None
+    :param timer: stage timer, marks the stages upsert, cache and signals
+    :return: tuple of (payment, created, changed)
+    """
+    defaults = get_ipn_defaults(payment_data)
+    if verify_mode == VERIFY_DEFERRED:
+        payment, created, changed = save_pending_ipns({payment_data['id']: defaults})[0]
+    else:
+        if verify_mode == VERIFY_SYNC:
+            defaults['verification_status'] = VERIFICATION_STATUS_VERIFIED
+        payment, created, changed = GlobeeIPN.objects.upsert(payment_id=payment_data['id'], defaults=defaults)
+    timer.mark('upsert')
+    if created or changed:
+        refresh_payment_cache(payment_data, verify_mode == VERIFY_SYNC)
+        timer.mark('cache')
+    if verify_mode != VERIFY_DEFERRED:
+        send_ipn_signal(payment, created, changed)
+    timer.mark('signals')
+    return payment, created, changed
+
+
+def save_pending_ipns(payments: dict):
+    """
+    Saves unverified payments for the deferred verification, see GlobeeIPN.objects.bulk_save_pending().
+    :param payments: dict of payment id -> dict with field values
+    :return: list of (payment, created, changed) tuples
+    """
+    try:
+        return GlobeeIPN.objects.bulk_save_pending(payments)
+    except IntegrityError:
+        # a payment was inserted concurrently and exists now
+        return GlobeeIPN.objects.bulk_save_pending(payments)
+
+
+def refresh_payment_cache(payment_data: dict, verified: bool):
+    """
+    Updates the cached payment with verified payment data, unverified IPN data only invalidates the cache.
+    :param payment_data: payment data
+    :param verified: True if the payment data was fetched from GloBee
+    """
+    if not get_cache_alias():
+        return
+    globee_payment = GlobeePayment()
+    if verified:
+        globee_payment.update_payment_cache(payment_data)
+    else:
+        globee_payment.invalidate_payment_cache(payment_data['id'])
+
+
+def get_verification_retry_delay(attempts: int):
+    """
+    :param attempts: failed verifications of the payment
+    :return: seconds until the next verification, doubles with every attempt up to GLOBEE_VERIFY_RETRY_MAX_DELAY
+    """
+    delay = getattr(settings, 'GLOBEE_VERIFY_RETRY_DELAY', 60)
+    return min(delay * 2 ** (attempts - 1), getattr(settings, 'GLOBEE_VERIFY_RETRY_MAX_DELAY', 3600))
+
+
+def is_rejected(error: Exception):
+    """
+    :param error: error of a GloBee request
+    :return: True if GloBee rejected the payment for good, False if the request can be retried
+    """
+    return isinstance(error, ValidationError) and getattr(error, 'code', None) in REJECTED_STATUS_CODES
+
+
+def verify_pending_ipns(batch_size: int = 100, max_workers: int = None):
+    """
+    Fetches a batch of pending payments concurrently from GloBee and saves the verified payment data.
+    globee_valid_ipn is sent for payments inserted by an IPN and for payments whose GloBee data changed. Payments that GloBee rejects (404, 422) or whose data is invalid are flagged
+    as failed. Payments that could not be fetched because of connection errors, 5xx responses, the circuit breaker,
+    the bulkhead or the rate limiter stay pending and are retried after get_verification_retry_delay(),
+    so they don't block the batch.
+    :param batch_size: max number of payments
+    :param max_workers: number of concurrent requests (default: GLOBEE_MAX_WORKERS)
+    :return: tuple of (verified, failed) counts
+    """
+    now = timezone.now()
+    pending = {
+        payment.payment_id: payment for payment in GlobeeIPN.objects.filter(verification_status=VERIFICATION_STATUS_PENDING)
+        .filter(Q(next_verification_at__isnull=True) | Q(next_verification_at__lte=now)).order_by('pk')[:batch_size]
+    }
+    verified = failed = 0
+    for result in GlobeePayment(priority=PRIORITY_BATCH).get_payments_by_ids(list(pending), max_workers=max_workers):
+        invalid = False
+        if result.error is None:
+            try:
+                defaults = get_ipn_defaults(result.data)
+            except (KeyError, TypeError, ValueError) as e:
+                result = result._replace(error=ValidationError(repr(e)))
+                invalid = True
+            else:
+                stored = pending[result.payment_id]
+                # a spurious IPN only changed the verification status
+                changed = stored.signal_pending or any(getattr(stored, name) != defaults[name] for name in GLOBEE_FIELDS)
+                defaults.update(
+                    verification_status=VERIFICATION_STATUS_VERIFIED, verification_attempts=0, next_verification_at=None, signal_pending=False,
+                )
+                payment = GlobeeIPN.objects.upsert(result.payment_id, defaults)[0]
+                refresh_payment_cache(result.data, True)
+                if changed:
+                    payment.send_valid_signal()
+                verified += 1
+                continue
+
+        logger.error('Verification of payment %s failed: %r' % (result.payment_id, result.error))
+        if invalid or is_rejected(result.error):
+            GlobeeIPN.objects.filter(payment_id=result.payment_id).update(verification_status=VERIFICATION_STATUS_FAILED)
+            failed += 1
+        else:
+            attempt = pending[result.payment_id].verification_attempts + 1
+            GlobeeIPN.objects.filter(payment_id=result.payment_id, verification_status=VERIFICATION_STATUS_PENDING).update(
+                verification_attempts=attempt, next_verification_at=now + timedelta(seconds=get_verification_retry_delay(attempt)),
+            )
+    return verified, failed
+
+
+def reconcile_ipns(chunk_size: int = 500, max_workers: int = None, start_after: tuple = None, on_chunk=None):
+    """
+    Refreshes all open payments (unpaid, paid, underpaid) from GloBee to catch lost IPNs. The payments are read
+    in chunks ordered by expires_at and id (keyset pagination), so memory stays bounded and the run can be resumed.
+    Changes are saved with one bulk_update per chunk of the rows locked with SELECT ... FOR UPDATE, payments whose
+    status was changed by an IPN meanwhile are skipped. globee_valid_ipn is only sent if the status changed.
+    :param chunk_size: number of payments per chunk
+    :param max_workers: number of concurrent requests (default: GLOBEE_MAX_WORKERS)
+    :param start_after: checkpoint (expires_at, id) of the last reconciled payment
+    :param on_chunk: called with the checkpoint (expires_at, id) after every chunk
+    :return: tuple of (checked, updated, failed) counts
+    """
+    fields = ['payment_status', 'total', 'currency', 'custom_payment_id', 'callback_data', 'customer_email',
+              'customer_name', 'confirmation_speed', 'created_at', 'expires_at', 'verification_status', 'signal_pending']
+    queryset = GlobeeIPN.objects.open().order_by('expires_at', 'id')
+    globee_payment = GlobeePayment(priority=PRIORITY_BATCH)
+    checked = updated = failed = 0
+    while True:
+        chunk = queryset
+        if start_after is not None:
+            expires_at, pk = start_after
+            chunk = chunk.filter(Q(expires_at__gt=expires_at) | Q(expires_at=expires_at, id__gt=pk))
+        payments = {payment.payment_id: payment for payment in chunk[:chunk_size]}
+        if not payments:
+            break
+        last = list(payments.values())[-1]
+        start_after = (last.expires_at, last.id)
+
+        candidates = {}
+        for result in globee_payment.get_payments_by_ids(list(payments), max_workers=max_workers):
+            if result.error is None:
+                try:
+                    defaults = get_ipn_defaults(result.data)
+                except (KeyError, TypeError, ValueError) as e:
+                    result = result._replace(error=ValidationError(repr(e)))
+            if result.error is not None:
+                logger.error('Reconciliation of payment %s failed: %r' % (result.payment_id, result.error))
+                failed += 1
+                continue
+            payment = payments[result.payment_id]
+            if any(getattr(payment, name) != value for name, value in defaults.items()):
+                candidates[result.payment_id] = (defaults, result.data)
+
+        changed = []
+        with transaction.atomic():
+            locked = GlobeeIPN.objects.select_for_update().in_bulk(list(candidates), field_name='payment_id')
+            for payment_id, (defaults, payment_data) in candidates.items():
+                payment = locked.get(payment_id)
+                # an IPN updated the payment since it was read, its data is at least as new as ours
+                if payment is None or payment.payment_status != payments[payment_id].payment_status:
+                    continue
+                if not any(getattr(payment, name) != value for name, value in defaults.items()):
+                    continue
+                defaults.update(verification_status=VERIFICATION_STATUS_VERIFIED, signal_pending=False)
+                # payments inserted by an unverified IPN weren't announced yet
+                status_changed = payment.signal_pending or payment.payment_status != defaults['payment_status']
+                for name, value in defaults.items():
+                    setattr(payment, name, value)
+                changed.append((payment, payment_data, status_changed))
+            GlobeeIPN.objects.bulk_update([payment for payment, payment_data, status_changed in changed], fields, batch_size=chunk_size)
+
+        for payment, payment_data, status_changed in changed:
+            refresh_payment_cache(payment_data, True)
+            if status_changed:
+                payment.send_valid_signal()
+        checked += len(payments)
+        updated += len(changed)
+        if on_chunk is not None:
+            on_chunk(start_after)
+    return checked, updated, failed
+
+
+def expire_ipns(chunk_size: int = 1000, now: datetime = None, on_chunk=None):
+    """
+    Marks unpaid payments whose expires_at has passed as expired. Every chunk is one SELECT ... FOR UPDATE SKIP LOCKED
+    of the primary keys and one UPDATE, rows locked by a concurrent IPN are left for the next run.
+    globee_expired_ipns is sent once per chunk with the payment ids of the chunk.
+    :param chunk_size: max number of payments per UPDATE
+    :param now: payments that expired before now are expired (default: timezone.now())
+    :param on_chunk: called with (expired, elapsed seconds) after every chunk
+    :return: tuple of (expired, elapsed seconds)
+    """
+    now = now or timezone.now()
+    start = monotonic()
+    expired = 0
+    queryset = GlobeeIPN.objects.expiring_before(now).filter(payment_status=PAYMENT_STATUS_GLOBEE_UNPAID)
+    while True:
+        with transaction.atomic():
+            rows = dict(queryset.select_for_update(skip_locked=True).order_by('pk').values_list('pk', 'payment_id')[:chunk_size])
+            if not rows:
+                break
+            GlobeeIPN.objects.filter(pk__in=list(rows)).update(payment_status=PAYMENT_STATUS_EXPIRED)
+        GlobeeIPN.send_expired_signal(list(rows.values()))
+        expired += len(rows)
+        if on_chunk is not None:
+            on_chunk(expired, monotonic() - start)
+        if len(rows) < chunk_size:
+            break
+    return expired, monotonic() - start
+
+
+def process_ipn_queue(queue, batch_size: int = 100, lease: int = 60):
+    """
+    Claims a batch of raw IPNs from the queue, optionally verifies them with GloBee,
+    saves them with one bulk upsert and sends the signals. The IPNs of saved payments are marked as signal pending
+    in the same transaction, so the signals of a worker that crashed before acknowledging them are sent on the next claim.
+    :param queue: IPN queue backend
+    :param batch_size: max number of IPNs
+    :param lease: seconds until unacknowledged IPNs are claimed again
+    :return: number of claimed IPNs
+    """
+    messages = queue.claim(batch_size, lease)
+    signal_pending = queue.get_signal_pending([message_id for message_id, body in messages]) if messages else set()
+    payment_data = {}
+    message_ids = {}
+    for message_id, body in messages:
+        try:
+            data = json_loads(body)
+            payment_id = data['id']
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error('Invalid IPN %s: %r' % (message_id, e))
+            queue.fail(message_id, repr(e), retry=False)
+            continue
+        payment_data[payment_id] = data
+        message_ids.setdefault(payment_id, []).append(message_id)
+
+    verify_mode = get_verify_mode()
+    if verify_mode == VERIFY_SYNC and payment_data:
+        for result in GlobeePayment(priority=PRIORITY_BATCH).get_payments_by_ids(list(payment_data)):
+            if result.error:
+                logger.error('Verification of payment %s failed: %r' % (result.payment_id, result.error))
+                del payment_data[result.payment_id]
+                for message_id in message_ids.pop(result.payment_id):
+                    queue.fail(message_id, repr(result.error))
+            else:
+                payment_data[result.payment_id] = result.data
+
+    payments = {}
+    for payment_id, data in payment_data.items():
+        try:
+            payments[payment_id] = get_ipn_defaults(data)
+            if verify_mode == VERIFY_SYNC:
+                payments[payment_id]['verification_status'] = VERIFICATION_STATUS_VERIFIED
+        except (KeyError, TypeError, ValueError, ValidationError) as e:
+            logger.error('Invalid IPN for payment %s: %r' % (payment_id, e))
+            for message_id in message_ids.pop(payment_id):
+                queue.fail(message_id, repr(e), retry=False)
+
+    with transaction.atomic():
+        try:
+            if verify_mode == VERIFY_DEFERRED:
+                results = GlobeeIPN.objects.bulk_save_pending(payments)
+            else:
+                results = GlobeeIPN.objects.bulk_upsert(payments)
+        except IntegrityError:
+            results = []
+            for payment_id, defaults in payments.items():
+                try:
+                    # savepoint, on PostgreSQL a failed statement would abort the whole transaction
+                    with transaction.atomic():
+                        if verify_mode == VERIFY_DEFERRED:
+                            results.extend(save_pending_ipns({payment_id: defaults}))
+                        else:
+                            results.append(GlobeeIPN.objects.upsert(payment_id, defaults))
+                except IntegrityError as e:
+                    logger.error('Payment %s could not be saved: %r' % (payment_id, e))
+                    for message_id in message_ids.pop(payment_id):
+                        queue.fail(message_id, repr(e), retry=False)
+        if verify_mode != VERIFY_DEFERRED:
+            # verify_pending_ipns() sends the signals of deferred verifications
+            queue.mark_signal_pending([
+                message_id for payment, created, changed in results if created or changed for message_id in message_ids[payment.payment_id]
+            ])
+
+    for payment, created, changed in results:
+        if created or changed:
+            refresh_payment_cache(payment_data[payment.payment_id], verify_mode == VERIFY_SYNC)
+    if verify_mode == VERIFY_DEFERRED:
+        results = []
+    for payment, created, changed in results:
+        # saved by a worker that crashed before acknowledging the IPN
+        changed = changed or any(message_id in signal_pending for message_id in message_ids[payment.payment_id])
+        try:
+            send_ipn_signal(payment, created, changed)
+        except Exception:
+            logger.exception('globee_valid_ipn receiver failed for payment %s' % payment.payment_id)
+    queue.ack([message_id for ids in message_ids.values() for message_id in ids])
+    return len(messages)
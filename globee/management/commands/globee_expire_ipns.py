@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from globee.ipn import expire_ipns
+
+
+class Command(BaseCommand):
+    help = 'Marks unpaid payments whose expires_at has passed as expired.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='max number of payments per UPDATE (default: 1000)')
+
+    def handle(self, *args, **options):
+        verbosity = options['verbosity']
+
+        def on_chunk(expired, elapsed):
+            if verbosity > 1:
+                self.stdout.write('expired %s payments in %.2fs' % (expired, elapsed))
+
+        expired, elapsed = expire_ipns(options['chunk_size'], on_chunk=on_chunk)
+        self.stdout.write('expired %s payments in %.2fs' % (expired, elapsed))
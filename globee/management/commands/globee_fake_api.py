@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from globee.testing import FakeGlobeeAPI, FakeGlobeeServer
+
+
+class Command(BaseCommand):
+    help = 'Runs a fake GloBee payment api on localhost. Set GLOBEE_API_URL to the printed url.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--auth-key', default=None, help='accepted X-AUTH-KEY (default: GLOBEE_AUTH_KEY)')
+        parser.add_argument('--latency', type=float, nargs='+', default=[0], help='seconds, or min and max seconds')
+        parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered with --error-status')
+        parser.add_argument('--error-status', type=int, default=503)
+
+    def handle(self, *args, **options):
+        latency = options['latency']
+        api = FakeGlobeeAPI(
+            auth_key=options['auth_key'] or getattr(settings, 'GLOBEE_AUTH_KEY', None),
+            latency=tuple(latency) if len(latency) > 1 else latency[0],
+            error_rate=options['error_rate'],
+            error_status=options['error_status'],
+        )
+        server = FakeGlobeeServer(api, options['host'], options['port'])
+        self.stdout.write('fake GloBee api running at %s' % server.api_url)
+        try:
+            server.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.httpd.server_close()
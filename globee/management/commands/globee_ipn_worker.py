@@ -0,0 +1,31 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from globee.ipn import process_ipn_queue
+from globee.queue import get_ipn_queue
+
+
+class Command(BaseCommand):
+    help = 'Processes the IPNs queued by the IPN view in GLOBEE_IPN_DEFERRED mode.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='max number of IPNs per batch (default: 100)')
+        parser.add_argument('--lease', type=int, default=60, help='seconds until unacknowledged IPNs are claimed again (default: 60)')
+        parser.add_argument('--sleep', type=float, default=1.0, help='seconds to wait if the queue is empty (default: 1)')
+        parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        queue = get_ipn_queue()
+        processed = 0
+        try:
+            while True:
+                count = process_ipn_queue(queue, options['batch_size'], options['lease'])
+                processed += count
+                if not count:
+                    if options['once']:
+                        break
+                    sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('processed %s IPNs' % processed)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from globee.polling import PollingScheduler
+
+
+class Command(BaseCommand):
+    help = 'Polls GloBee for payments that can still change with an adaptive interval per payment.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='max number of payments per poll (default: 100)')
+        parser.add_argument('--max-workers', type=int, default=None, help='number of concurrent requests (default: GLOBEE_MAX_WORKERS)')
+        parser.add_argument('--reload', type=float, default=60, help='seconds between two loads of new payments from the database (default: 60)')
+        parser.add_argument('--once', action='store_true', help='check every payment once and exit')
+
+    def handle(self, *args, **options):
+        scheduler = PollingScheduler(options['batch_size'], options['max_workers'])
+        try:
+            scheduler.run(reload_interval=options['reload'], once=options['once'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('checked %s payments, %s changed' % (scheduler.checked, scheduler.changed))
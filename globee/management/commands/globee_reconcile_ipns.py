@@ -0,0 +1,53 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from globee.ipn import reconcile_ipns
+
+
+class Command(BaseCommand):
+    help = 'Refreshes all unpaid, paid and underpaid payments from GloBee to catch lost IPNs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='number of payments per chunk (default: 500)')
+        parser.add_argument('--max-workers', type=int, default=None, help='number of concurrent requests (default: GLOBEE_MAX_WORKERS)')
+        parser.add_argument('--checkpoint', default=None, help='file to resume an interrupted run from, removed after a complete run')
+
+    def handle(self, *args, **options):
+        checkpoint = options['checkpoint']
+        start_after = self.read_checkpoint(checkpoint) if checkpoint else None
+        if start_after is not None:
+            self.stdout.write('resuming after payment #%s (expires at %s)' % (start_after[1], start_after[0]))
+
+        def on_chunk(position):
+            if checkpoint:
+                self.write_checkpoint(checkpoint, position)
+
+        checked, updated, failed = reconcile_ipns(options['chunk_size'], options['max_workers'], start_after, on_chunk)
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write('checked %s payments, %s updated, %s failed' % (checked, updated, failed))
+
+    @staticmethod
+    def read_checkpoint(path: str):
+        """
+        :param path: checkpoint file
+        :return: tuple of (expires_at, id) or None if the file doesn't exist
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return parse_datetime(data['expires_at']), int(data['id'])
+        except (ValueError, KeyError, TypeError) as e:
+            raise CommandError('Invalid checkpoint %s: %r' % (path, e))
+
+    @staticmethod
+    def write_checkpoint(path: str, position: tuple):
+        expires_at, pk = position
+        with open('%s.tmp' % path, 'w') as f:
+            json.dump({'expires_at': expires_at.isoformat(), 'id': pk}, f)
+        os.replace('%s.tmp' % path, path)
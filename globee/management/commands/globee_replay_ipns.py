@@ -0,0 +1,137 @@
+import json
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter, sleep
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.urls import reverse
+
+from globee.metrics import percentile
+
+
+class Command(BaseCommand):
+    help = 'Replays the IPN bodies of a JSONL file (one IPN per line) against the globee-ipn url or any IPN url.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='JSONL file with one IPN body per line')
+        parser.add_argument('--url', default=None, help='POST over HTTP to this url instead of using the Django test client')
+        parser.add_argument('--concurrency', type=int, default=1, help='number of concurrent senders (default: 1)')
+        parser.add_argument('--rate', type=float, default=0, help='max requests per second over all senders, 0 = unlimited (default: 0)')
+        parser.add_argument('--shuffle', action='store_true', help='replay the IPNs in random order')
+        parser.add_argument('--seed', type=int, default=None, help='random seed for --shuffle')
+        parser.add_argument('--timeout', type=float, default=10, help='HTTP timeout in seconds (default: 10)')
+        parser.add_argument('--json', action='store_true', help='print the report as JSON')
+
+    def handle(self, *args, **options):
+        bodies = self.read_bodies(options['file'])
+        if options['shuffle']:
+            random.Random(options['seed']).shuffle(bodies)
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        jobs = enumerate(bodies)
+        lock = Lock()
+        timings = []
+        status_codes = Counter()
+        rate = options['rate']
+        start = perf_counter()
+
+        def send_all(close_connections):
+            send = self.get_sender(options['url'], options['timeout'])
+            try:
+                while True:
+                    with lock:
+                        try:
+                            index, body = next(jobs)
+                        except StopIteration:
+                            return
+                    if rate:
+                        delay = start + index / rate - perf_counter()
+                        if delay > 0:
+                            sleep(delay)
+                    request_start = perf_counter()
+                    try:
+                        status = send(body)
+                    except Exception as e:
+                        # one broken request must not stop the replay, count it as failed
+                        status = e.__class__.__name__
+                    elapsed = perf_counter() - request_start
+                    with lock:
+                        timings.append(elapsed)
+                        status_codes[str(status)] += 1
+            finally:
+                if close_connections:
+                    connections.close_all()
+
+        if options['concurrency'] == 1:
+            send_all(close_connections=False)
+        else:
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                for future in [executor.submit(send_all, True) for i in range(options['concurrency'])]:
+                    future.result()
+
+        report = self.get_report(timings, perf_counter() - start, status_codes)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=4))
+        else:
+            self.write_report(report)
+
+    @staticmethod
+    def read_bodies(path: str):
+        """
+        :param path: path of the JSONL file
+        :return: list of IPN bodies as bytes
+        """
+        try:
+            with open(path, 'rb') as f:
+                return [line.strip() for line in f if line.strip()]
+        except IOError as e:
+            raise CommandError('Could not read %s: %s' % (path, e))
+
+    @staticmethod
+    def get_sender(url: str, timeout: float):
+        """
+        :param url: IPN url or None to use the Django test client
+        :param timeout: HTTP timeout in seconds
+        :return: function that posts one IPN body and returns the status code
+        """
+        if url:
+            session = requests.Session()
+            return lambda body: session.post(url, data=body, headers={'Content-Type': 'application/json'}, timeout=timeout).status_code
+        # respond with 500 like a real server instead of raising exceptions of the view
+        client = Client(raise_request_exception=False)
+        path = reverse('globee-ipn')
+        return lambda body: client.generic('POST', path, body, content_type='application/json').status_code
+
+    @staticmethod
+    def get_report(timings: list, elapsed: float, status_codes: Counter):
+        """
+        :param timings: latency of every request in seconds
+        :param elapsed: total seconds
+        :param status_codes: number of responses per status code or exception name
+        :return: report dict
+        """
+        report = {
+            'requests': len(timings),
+            'failures': sum(count for status, count in status_codes.items() if not status.startswith('2')),
+            'elapsed': round(elapsed, 4),
+            'throughput_rps': round(len(timings) / elapsed, 2) if elapsed else None,
+            'status_codes': dict(sorted(status_codes.items())),
+        }
+        for name, value in (('min', min(timings, default=None)), ('p50', percentile(timings, 50)), ('p90', percentile(timings, 90)),
+                            ('p99', percentile(timings, 99)), ('max', max(timings, default=None))):
+            report['%s_ms' % name] = round(value * 1000, 3) if value is not None else None
+        return report
+
+    def write_report(self, report: dict):
+        self.stdout.write('replayed %s IPNs in %.2fs (%s/s)' % (report['requests'], report['elapsed'], report['throughput_rps']))
+        if report['requests']:
+            self.stdout.write('latency ms: min %s, p50 %s, p90 %s, p99 %s, max %s' % (
+                report['min_ms'], report['p50_ms'], report['p90_ms'], report['p99_ms'], report['max_ms']))
+        self.stdout.write('status codes: %s' % ', '.join('%s: %s' % item for item in report['status_codes'].items()))
+        self.stdout.write('failures: %s' % report['failures'])
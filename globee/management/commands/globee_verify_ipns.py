@@ -0,0 +1,30 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from globee.ipn import verify_pending_ipns
+
+
+class Command(BaseCommand):
+    help = 'Verifies the IPNs saved with GLOBEE_AUTO_VERIFY = "deferred" and sends the globee_valid_ipn signal.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='max number of payments per batch (default: 100)')
+        parser.add_argument('--max-workers', type=int, default=None, help='number of concurrent requests (default: GLOBEE_MAX_WORKERS)')
+        parser.add_argument('--sleep', type=float, default=5.0, help='seconds to wait if no payment is pending (default: 5)')
+        parser.add_argument('--once', action='store_true', help='exit when no payment is pending')
+
+    def handle(self, *args, **options):
+        total_verified = total_failed = 0
+        try:
+            while True:
+                verified, failed = verify_pending_ipns(options['batch_size'], options['max_workers'])
+                total_verified += verified
+                total_failed += failed
+                if verified + failed < options['batch_size']:
+                    if options['once']:
+                        break
+                    sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('verified %s payments, %s failed' % (total_verified, total_failed))
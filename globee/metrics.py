@@ -0,0 +1,268 @@
+from bisect import bisect_left
+from math import ceil
+from threading import Lock
+from time import perf_counter
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def percentile(values, q: float):
+    """
+    Returns the q-th percentile of the values (nearest-rank method).
+    :param values: list of numbers
+    :param q: percentile between 0 and 100
+    :return: value or None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(ceil(q / 100.0 * len(values))) - 1, 0)]
+
+
+def _escape(value: str):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(str(value))) for name, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Thread-safe, monotonically increasing counter with optional labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str = '', labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, amount: int = 1, **labels):
+        """
+        :param amount: increment
+        :param labels: a value for every label name
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """
+        :param labels: a value for every label name
+        :return: value of the labelled counter
+        """
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    @property
+    def value(self):
+        return sum(list(self._values.values()))
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        if not self.labelnames:
+            yield self.name, (), self.value
+            return
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """
+    Thread-safe histogram with cumulative buckets and optional labels.
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str = '', labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels):
+        """
+        :param value: observed value, e.g. seconds
+        :param labels: a value for every label name
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def get(self, **labels):
+        """
+        :param labels: a value for every label name
+        :return: tuple of (count, sum)
+        """
+        series = self._series.get(tuple(str(labels[name]) for name in self.labelnames))
+        return (series[2], series[1]) if series is not None else (0, 0.0)
+
+    @property
+    def value(self):
+        return sum(series[2] for series in list(self._series.values()))
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def samples(self):
+        with self._lock:
+            series = sorted((key, [list(counts), total, count]) for key, (counts, total, count) in self._series.items())
+        for key, (counts, total, count) in series:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '%s_bucket' % self.name, labels + (('le', _format_value(float(bound))),), cumulative
+            yield '%s_sum' % self.name, labels, total
+            yield '%s_count' % self.name, labels, count
+
+
+class StageTimer:
+    """
+    Measures consecutive stages, every mark() ends the current stage.
+    """
+    __slots__ = ('timings', 'payment_id', '_start', '_last')
+    enabled = True
+
+    def __init__(self):
+        self.timings = []
+        self.payment_id = None
+        self._start = self._last = perf_counter()
+
+    def mark(self, stage: str):
+        """
+        :param stage: name of the stage that just ended
+        """
+        now = perf_counter()
+        self.timings.append((stage, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self._start
+
+
+class NullStageTimer:
+    """
+    Stage timer that measures nothing, used if IPN timing is disabled.
+    """
+    __slots__ = ()
+    enabled = False
+    timings = ()
+    total = 0.0
+
+    @property
+    def payment_id(self):
+        return None
+
+    @payment_id.setter
+    def payment_id(self, value):
+        pass
+
+    def mark(self, stage: str):
+        pass
+
+
+null_timer = NullStageTimer()
+
+
+class MetricsRegistry:
+    """
+    In-process registry of the metrics collected by django-globee.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _get_or_create(self, metric_class, name: str, documentation: str, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, metric_class(name, documentation, *args))
+        return metric
+
+    def counter(self, name: str, documentation: str = '', labelnames: tuple = ()):
+        """
+        Returns the counter with the given name, it will be created if it doesn't exist.
+        :param name: metric name
+        :param documentation: help text
+        :param labelnames: label names
+        :return: counter
+        """
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str = '', labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Returns the histogram with the given name, it will be created if it doesn't exist.
+        :param name: metric name
+        :param documentation: help text
+        :param labelnames: label names
+        :param buckets: upper bounds of the buckets
+        :return: histogram
+        """
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def get_value(self, name: str):
+        """
+        Returns the current value of a metric or None if it doesn't exist.
+        :param name: metric name
+        :return: metric value
+        """
+        metric = self._metrics.get(name)
+        return metric.value if metric is not None else None
+
+    def reset(self):
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def render_prometheus(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        :return: text
+        """
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append('# HELP %s %s' % (name, metric.documentation.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for sample_name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample_name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+ipn_duplicates = registry.counter('globee_ipn_duplicates_total', 'IPN deliveries skipped because the payment did not change')
+ipn_seconds = registry.histogram('globee_ipn_seconds', 'IPN processing time in seconds')
+ipn_stage_seconds = registry.histogram('globee_ipn_stage_seconds', 'IPN processing time per stage in seconds', ('stage',))
+
+api_request_seconds = registry.histogram('globee_api_request_seconds', 'GloBee api request time in seconds', ('endpoint',))
+api_responses = registry.counter('globee_api_responses_total', 'GloBee api responses by status code', ('endpoint', 'status'))
+api_exceptions = registry.counter('globee_api_exceptions_total', 'GloBee api requests that raised an exception', ('endpoint', 'exception'))
+api_request_bytes = registry.counter('globee_api_request_bytes_total', 'Bytes sent to the GloBee api', ('endpoint',))
+api_response_bytes = registry.counter('globee_api_response_bytes_total', 'Bytes received from the GloBee api', ('endpoint',))
+api_new_connections = registry.counter('globee_api_new_connections_total', 'Connections opened to the GloBee api', ('endpoint',))
+api_retries = registry.counter('globee_api_retries_total', 'GloBee api requests retried by the connection pool', ('endpoint',))
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('globee', '0003_auto_20181117_2318'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GlobeeIPNInbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField(help_text='Raw IPN request body')),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Number of times a worker claimed this IPN')),
+                ('locked_until', models.DateTimeField(blank=True, help_text='A worker is processing this IPN until then', null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Globee IPN inbox',
+            },
+        ),
+    ]
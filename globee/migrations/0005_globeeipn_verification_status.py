@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('globee', '0004_globeeipninbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='globeeipn',
+            name='verification_status',
+            field=models.CharField(choices=[('skipped', 'saved without verification'), ('pending', 'waiting for verification'), ('verified', 'payment data fetched from GloBee'), ('failed', 'payment could not be fetched from GloBee')], default='skipped', help_text='GLOBEE_AUTO_VERIFY result', max_length=12),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('globee', '0005_globeeipn_verification_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='globeeipn',
+            name='payment_status',
+            field=models.CharField(choices=[('unpaid', 'unpaid - ready to receive payment'), ('paid', 'waiting for confirmations'), ('underpaid', 'user has paid less'), ('overpaid', 'user has mistakenly paid more'), ('paid_late', 'the payment was made outside of the quotation window'), ('confirmed', 'payment has been confirmed'), ('completed', 'payment-request is now completed'), ('expired', 'unpaid payment-request has expired')], default='unpaid', help_text='Globee payment status', max_length=12),
+        ),
+    ]
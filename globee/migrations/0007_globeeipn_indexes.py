@@ -0,0 +1,52 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:04
+
+from django.db import migrations, models
+
+
+class AddIndex(migrations.AddIndex):
+    """
+    Builds the index with CREATE INDEX CONCURRENTLY on PostgreSQL, so large tables stay writable.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('globee', '0006_globeeipn_expired_status'),
+    ]
+
+    operations = [
+        AddIndex(
+            model_name='globeeipn',
+            index=models.Index(fields=['-created_at'], name='globee_created_idx'),
+        ),
+        AddIndex(
+            model_name='globeeipn',
+            index=models.Index(fields=['payment_status', '-created_at'], name='globee_status_created_idx'),
+        ),
+        AddIndex(
+            model_name='globeeipn',
+            index=models.Index(fields=['customer_email', '-created_at'], name='globee_customer_created_idx'),
+        ),
+        AddIndex(
+            model_name='globeeipn',
+            index=models.Index(condition=models.Q(('payment_status__in', ('unpaid', 'paid', 'underpaid'))), fields=['expires_at', 'id'], name='globee_open_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('globee', '0007_globeeipn_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='globeeipn',
+            name='next_verification_at',
+            field=models.DateTimeField(blank=True, help_text='A failed deferred verification is retried after this time', null=True),
+        ),
+        migrations.AddField(
+            model_name='globeeipn',
+            name='verification_attempts',
+            field=models.PositiveIntegerField(default=0, help_text='Failed deferred verifications since the payment became pending'),
+        ),
+    ]
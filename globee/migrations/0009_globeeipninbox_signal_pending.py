@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('globee', '0008_globeeipn_verification_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='globeeipninbox',
+            name='signal_pending',
+            field=models.BooleanField(default=False, help_text='The payment was saved, globee_valid_ipn was not sent yet'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('globee', '0009_globeeipninbox_signal_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='globeeipn',
+            name='signal_pending',
+            field=models.BooleanField(default=False, help_text='Inserted by an unverified IPN, globee_valid_ipn is sent after the verification'),
+        ),
+    ]
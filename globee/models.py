@@ -1,6 +1,7 @@
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
 
-from globee.signals import globee_valid_ipn
+from globee.dispatch import send_signal
+from globee.signals import globee_duplicate_ipn, globee_expired_ipns, globee_valid_ipn
 
 PAYMENT_STATUS_GLOBEE_UNPAID = 'unpaid'
 PAYMENT_STATUS_GLOBEE_PAID = 'paid'
@@ -9,12 +10,233 @@ PAYMENT_STATUS_GLOBEE_OVERPAID = 'overpaid'
 PAYMENT_STATUS_GLOBEE_PAID_LATE = 'paid_late'
 PAYMENT_STATUS_GLOBEE_CONFIRMED = 'confirmed'
 PAYMENT_STATUS_GLOBEE_COMPLETED = 'completed'
+# set by expire_ipns(), not a GloBee payment status
+PAYMENT_STATUS_EXPIRED = 'expired'
+
+# payments that can still change without a new payment
+OPEN_PAYMENT_STATUSES = (PAYMENT_STATUS_GLOBEE_UNPAID, PAYMENT_STATUS_GLOBEE_PAID, PAYMENT_STATUS_GLOBEE_UNDERPAID)
+
+VERIFICATION_STATUS_SKIPPED = 'skipped'
+VERIFICATION_STATUS_PENDING = 'pending'
+VERIFICATION_STATUS_VERIFIED = 'verified'
+VERIFICATION_STATUS_FAILED = 'failed'
 
 SPEED_STATUS_GLOBEE_LOW = 'low'
 SPEED_STATUS_GLOBEE_MEDIUM = 'medium'
 SPEED_STATUS_GLOBEE_HIGH = 'high'
 
 
+class GlobeeIPNQuerySet(models.QuerySet):
+
+    def open(self):
+        """
+        Payments that can still change (unpaid, paid, underpaid). The filter matches the condition of the partial
+        index globee_open_expires_idx, backends that can't use it fall back to globee_status_created_idx.
+        """
+        return self.filter(payment_status__in=OPEN_PAYMENT_STATUSES)
+
+    def expiring_before(self, when):
+        """
+        Open payments that expire before when, see open().
+        :param when: datetime
+        """
+        return self.open().filter(expires_at__lt=when)
+
+    def for_customer(self, email: str):
+        """
+        Payments of a customer, newest first, uses the index globee_customer_created_idx.
+        :param email: customer email
+        """
+        return self.filter(customer_email=email).order_by('-created_at')
+
+
+class GlobeeIPNManager(models.Manager.from_queryset(GlobeeIPNQuerySet)):
+
+    def _get_upsert_sql(self, payment_id: str, defaults: dict):
+        """
+        Builds a single INSERT ... ON CONFLICT (payment_id) DO UPDATE statement.
+        Rows whose values would not change are left untouched and not returned.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        obj = self.model(payment_id=payment_id, **defaults)
+        fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+        update_columns = [qn(self.model._meta.get_field(name).column) for name in defaults]
+        table = qn(self.model._meta.db_table)
+
+        sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s WHERE (%s) IS DISTINCT FROM (%s) RETURNING *, (xmax = 0) AS inserted' % (
+            table,
+            ', '.join(qn(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+            qn(self.model._meta.get_field('payment_id').column),
+            ', '.join('%s = EXCLUDED.%s' % (column, column) for column in update_columns),
+            ', '.join('%s.%s' % (table, column) for column in update_columns),
+            ', '.join('EXCLUDED.%s' % column for column in update_columns),
+        )
+        params = [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields]
+        return sql, params
+
+    def _get_sqlite_upsert_sql(self, payment_id: str, defaults: dict):
+        """
+        Builds an INSERT ... ON CONFLICT (payment_id) DO NOTHING statement that only returns an inserted row
+        and an UPDATE statement that only returns a changed row. SQLite has no xmax to tell an insert from
+        an update of a single INSERT ... ON CONFLICT DO UPDATE statement.
+        :return: tuple of (insert sql, insert params, update sql, update params)
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        obj = self.model(payment_id=payment_id, **defaults)
+        fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+        update_fields = [self.model._meta.get_field(name) for name in defaults]
+        table = qn(self.model._meta.db_table)
+        payment_id_column = qn(self.model._meta.get_field('payment_id').column)
+
+        insert_sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO NOTHING RETURNING *' % (
+            table,
+            ', '.join(qn(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+            payment_id_column,
+        )
+        insert_params = [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields]
+        update_sql = 'UPDATE %s SET %s WHERE %s = %%s AND (%s) IS NOT (%s) RETURNING *' % (
+            table,
+            ', '.join('%s = %%s' % qn(field.column) for field in update_fields),
+            payment_id_column,
+            ', '.join(qn(field.column) for field in update_fields),
+            ', '.join(['%s'] * len(update_fields)),
+        )
+        values = [field.get_db_prep_save(getattr(obj, field.attname), connection) for field in update_fields]
+        return insert_sql, insert_params, update_sql, values + [payment_id] + values
+
+    def upsert(self, payment_id: str, defaults: dict):
+        """
+        Inserts or updates the payment with the given payment id.
+        On PostgreSQL this is a single INSERT ... ON CONFLICT statement, on SQLite 3.35+ an INSERT ... ON CONFLICT
+        DO NOTHING followed by an UPDATE if the payment exists, other backends lock the existing row.
+        Unchanged rows are not written.
+        :param payment_id: Globee payment ID
+        :param defaults: dict with field values
+        :return: tuple of (payment, created, changed)
+        """
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            rows = list(self.raw(*self._get_upsert_sql(payment_id, defaults)))
+            if rows:
+                return rows[0], rows[0].inserted, True
+            return self.get(payment_id=payment_id), False, False
+
+        if connection.vendor == 'sqlite' and connection.features.can_return_columns_from_insert:
+            insert_sql, insert_params, update_sql, update_params = self._get_sqlite_upsert_sql(payment_id, defaults)
+            rows = list(self.raw(insert_sql, insert_params))
+            if rows:
+                return rows[0], True, True
+            # each statement is atomic, a payment inserted concurrently is updated by the second one
+            rows = list(self.raw(update_sql, update_params))
+            if rows:
+                return rows[0], False, True
+            return self.get(payment_id=payment_id), False, False
+
+        with transaction.atomic(using=self.db):
+            try:
+                obj = self.select_for_update().get(payment_id=payment_id)
+            except self.model.DoesNotExist:
+                try:
+                    with transaction.atomic(using=self.db):
+                        return self.create(payment_id=payment_id, **defaults), True, True
+                except IntegrityError:
+                    obj = self.select_for_update().filter(payment_id=payment_id).first()
+                    if obj is None:
+                        raise
+
+            changed_fields = [name for name, value in defaults.items() if getattr(obj, name) != value]
+            for name in changed_fields:
+                setattr(obj, name, defaults[name])
+            if changed_fields:
+                obj.save(update_fields=changed_fields)
+            return obj, False, bool(changed_fields)
+
+    def bulk_upsert(self, payments: dict):
+        """
+        Inserts or updates many payments with one SELECT, one bulk_create and one bulk_update.
+        Raises IntegrityError if a payment was inserted concurrently, use upsert() per payment in that case.
+        :param payments: dict of payment id -> dict with field values
+        :return: list of (payment, created, changed) tuples
+        """
+        with transaction.atomic(using=self.db):
+            existing = self.select_for_update().in_bulk(list(payments), field_name='payment_id')
+            results = []
+            new_objs = []
+            update_objs = []
+            update_fields = set()
+            for payment_id, defaults in payments.items():
+                obj = existing.get(payment_id)
+                if obj is None:
+                    obj = self.model(payment_id=payment_id, **defaults)
+                    new_objs.append(obj)
+                    results.append((obj, True, True))
+                    continue
+                changed_fields = [name for name, value in defaults.items() if getattr(obj, name) != value]
+                for name in changed_fields:
+                    setattr(obj, name, defaults[name])
+                if changed_fields:
+                    update_objs.append(obj)
+                    update_fields.update(changed_fields)
+                results.append((obj, False, bool(changed_fields)))
+
+            self._bulk_create(new_objs)
+            if update_objs:
+                self.bulk_update(update_objs, sorted(update_fields))
+            return results
+
+    def bulk_save_pending(self, payments: dict):
+        """
+        Saves unverified payments for the deferred verification with one SELECT, one bulk_create and one UPDATE.
+        New payments are inserted as pending and signal pending, existing payments whose data differs are only marked
+        as pending, so verified data is never overwritten with unverified data. verify_pending_ipns() saves the fetched data.
+        Raises IntegrityError if a payment was inserted concurrently.
+        :param payments: dict of payment id -> dict with field values
+        :return: list of (payment, created, changed) tuples, changed means marked as pending
+        """
+        with transaction.atomic(using=self.db):
+            existing = self.select_for_update().in_bulk(list(payments), field_name='payment_id')
+            results = []
+            new_objs = []
+            pending = []
+            for payment_id, defaults in payments.items():
+                obj = existing.get(payment_id)
+                if obj is None:
+                    obj = self.model(payment_id=payment_id, verification_status=VERIFICATION_STATUS_PENDING, signal_pending=True, **defaults)
+                    new_objs.append(obj)
+                    results.append((obj, True, True))
+                    continue
+                changed = any(getattr(obj, name) != value for name, value in defaults.items())
+                if changed:
+                    obj.verification_status = VERIFICATION_STATUS_PENDING
+                    obj.verification_attempts = 0
+                    obj.next_verification_at = None
+                    pending.append(obj.pk)
+                results.append((obj, False, changed))
+
+            self._bulk_create(new_objs)
+            if pending:
+                self.filter(pk__in=pending).update(
+                    verification_status=VERIFICATION_STATUS_PENDING, verification_attempts=0, next_verification_at=None
+                )
+            return results
+
+    def _bulk_create(self, objs: list):
+        """
+        Inserts the objects and sets the primary keys on backends that don't return them.
+        """
+        if not objs:
+            return
+        self.bulk_create(objs)
+        if any(obj.pk is None for obj in objs):
+            pks = dict(self.filter(payment_id__in=[obj.payment_id for obj in objs]).values_list('payment_id', 'pk'))
+            for obj in objs:
+                obj.pk = pks[obj.payment_id]
+
+
 class GlobeeIPN(models.Model):
 
     PAYMENT_STATUS_CHOICES = (
@@ -25,6 +247,7 @@ class GlobeeIPN(models.Model):
         (PAYMENT_STATUS_GLOBEE_PAID_LATE, 'the payment was made outside of the quotation window'),
         (PAYMENT_STATUS_GLOBEE_CONFIRMED, 'payment has been confirmed'),
         (PAYMENT_STATUS_GLOBEE_COMPLETED, 'payment-request is now completed'),
+        (PAYMENT_STATUS_EXPIRED, 'unpaid payment-request has expired'),
     )
 
     SPEED_STATUS_CHOICES = (
@@ -33,6 +256,13 @@ class GlobeeIPN(models.Model):
         (SPEED_STATUS_GLOBEE_HIGH, 'high speed with / risk'),
     )
 
+    VERIFICATION_STATUS_CHOICES = (
+        (VERIFICATION_STATUS_SKIPPED, 'saved without verification'),
+        (VERIFICATION_STATUS_PENDING, 'waiting for verification'),
+        (VERIFICATION_STATUS_VERIFIED, 'payment data fetched from GloBee'),
+        (VERIFICATION_STATUS_FAILED, 'payment could not be fetched from GloBee'),
+    )
+
     payment_status = models.CharField(max_length=12, choices=PAYMENT_STATUS_CHOICES, default=PAYMENT_STATUS_GLOBEE_UNPAID, help_text='Globee payment status')
     payment_id = models.CharField(max_length=255, unique=True, help_text='Globee payment ID')
     total = models.FloatField(help_text='The amount in fiat or crypto-currency')
@@ -45,12 +275,53 @@ class GlobeeIPN(models.Model):
     confirmation_speed = models.CharField(max_length=50, choices=SPEED_STATUS_CHOICES, default=SPEED_STATUS_GLOBEE_MEDIUM)
     created_at = models.DateTimeField()
     expires_at = models.DateTimeField()
+    verification_status = models.CharField(max_length=12, choices=VERIFICATION_STATUS_CHOICES, default=VERIFICATION_STATUS_SKIPPED, help_text='GLOBEE_AUTO_VERIFY result')
+    verification_attempts = models.PositiveIntegerField(default=0, help_text='Failed deferred verifications since the payment became pending')
+    next_verification_at = models.DateTimeField(null=True, blank=True, help_text='A failed deferred verification is retried after this time')
+    signal_pending = models.BooleanField(default=False, help_text='Inserted by an unverified IPN, globee_valid_ipn is sent after the verification')
 
-    objects = models.Manager()
+    objects = GlobeeIPNManager()
+
+    class Meta:
+        indexes = [
+            # admin date hierarchy and list ordering, optionally filtered by status
+            models.Index(fields=['-created_at'], name='globee_created_idx'),
+            models.Index(fields=['payment_status', '-created_at'], name='globee_status_created_idx'),
+            models.Index(fields=['customer_email', '-created_at'], name='globee_customer_created_idx'),
+            # only the small share of open payments, ignored by backends without partial indexes (MySQL)
+            models.Index(
+                fields=['expires_at', 'id'], name='globee_open_expires_idx',
+                condition=models.Q(payment_status__in=OPEN_PAYMENT_STATUSES),
+            ),
+        ]
 
     def send_valid_signal(self):
-        globee_valid_ipn.send(sender=self)
+        send_signal(globee_valid_ipn, self)
+
+    def send_duplicate_signal(self):
+        send_signal(globee_duplicate_ipn, self)
+
+    @classmethod
+    def send_expired_signal(cls, payment_ids: list):
+        send_signal(globee_expired_ipns, cls, payment_ids=payment_ids)
 
     def __str__(self):
         return 'GloBee payment #%s: (%s), total: %.2f %s' % (self.payment_id, self.payment_status, self.total, self.currency)
 
+
+class GlobeeIPNInbox(models.Model):
+    """
+    Raw IPN bodies waiting for the globee_ipn_worker management command (GLOBEE_IPN_DEFERRED).
+    """
+    body = models.TextField(help_text='Raw IPN request body')
+    received_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0, help_text='Number of times a worker claimed this IPN')
+    locked_until = models.DateTimeField(null=True, blank=True, help_text='A worker is processing this IPN until then')
+    last_error = models.TextField(null=True, blank=True)
+    signal_pending = models.BooleanField(default=False, help_text='The payment was saved, globee_valid_ipn was not sent yet')
+
+    class Meta:
+        verbose_name_plural = 'Globee IPN inbox'
+
+    def __str__(self):
+        return 'GloBee IPN inbox #%s (attempts: %s)' % (self.pk, self.attempts)
@@ -0,0 +1,275 @@
+import heapq
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from time import sleep, time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from globee.core import GlobeePayment
+from globee.ipn import GLOBEE_FIELDS, get_ipn_defaults, refresh_payment_cache
+from globee.models import (
+    GlobeeIPN, PAYMENT_STATUS_GLOBEE_CONFIRMED, PAYMENT_STATUS_GLOBEE_OVERPAID, PAYMENT_STATUS_GLOBEE_PAID,
+    PAYMENT_STATUS_GLOBEE_PAID_LATE, PAYMENT_STATUS_GLOBEE_UNDERPAID, PAYMENT_STATUS_GLOBEE_UNPAID, VERIFICATION_STATUS_VERIFIED,
+)
+from globee.ratelimit import PRIORITY_BATCH
+
+
+logger = getLogger(__name__)
+
+# seconds between two checks of a payment, None stops polling
+DEFAULT_POLL_INTERVALS = {
+    'unpaid': 60,
+    'paid': 60,
+    'underpaid': 120,
+    'overpaid': 3600,
+    'paid_late': 3600,
+    'confirmed': 1800,
+    'completed': None,
+}
+
+# paid payments confirm faster with a higher confirmation speed
+SPEED_FACTORS = {
+    'high': 0.5,
+    'medium': 1,
+    'low': 4,
+}
+
+# polled until they expired
+UNPAID_STATUSES = (PAYMENT_STATUS_GLOBEE_UNPAID, PAYMENT_STATUS_GLOBEE_UNDERPAID)
+# polled until GLOBEE_POLL_MAX_AGE seconds after they expired
+PAID_STATUSES = (PAYMENT_STATUS_GLOBEE_PAID, PAYMENT_STATUS_GLOBEE_CONFIRMED, PAYMENT_STATUS_GLOBEE_OVERPAID, PAYMENT_STATUS_GLOBEE_PAID_LATE)
+
+# fields written for a polled payment
+SAVED_FIELDS = GLOBEE_FIELDS + ('verification_status', 'signal_pending')
+
+
+def get_poll_max_age():
+    """
+    :return: seconds after expires_at until paid, confirmed, overpaid and paid_late payments are no longer polled
+    """
+    return getattr(settings, 'GLOBEE_POLL_MAX_AGE', 24 * 3600)
+
+
+def get_poll_interval(payment_status: str, confirmation_speed: str, expires_at: float, now: float, unchanged: int = 0):
+    """
+    Returns the seconds until the next check of a payment.
+    Unpaid and underpaid payments are checked at a fixed interval and once more right after they expired, then polling stops.
+    Other payments are checked until GLOBEE_POLL_MAX_AGE seconds after they expired, every check that didn't change
+    the status doubles their interval up to GLOBEE_POLL_MAX_INTERVAL.
+    :param payment_status: GloBee payment status
+    :param confirmation_speed: low, medium or high
+    :param expires_at: expiry as timestamp
+    :param now: current timestamp
+    :param unchanged: number of previous checks that didn't change the status
+    :return: seconds or None to stop polling
+    """
+    intervals = dict(DEFAULT_POLL_INTERVALS, **getattr(settings, 'GLOBEE_POLL_INTERVALS', {}))
+    interval = intervals.get(payment_status)
+    if interval is None:
+        return None
+    max_interval = getattr(settings, 'GLOBEE_POLL_MAX_INTERVAL', 6 * 3600)
+    if payment_status in UNPAID_STATUSES:
+        remaining = expires_at - now
+        if remaining < 0:
+            return None
+        # the customer can pay any moment, the last check is made shortly after the payment expired
+        return min(interval, max_interval, remaining + 5)
+    if now > expires_at + get_poll_max_age():
+        return None
+    if payment_status == PAYMENT_STATUS_GLOBEE_PAID:
+        interval *= SPEED_FACTORS.get(confirmation_speed, 1)
+    return min(interval * 2 ** unchanged, max_interval)
+
+
+def _is_changed(row: GlobeeIPN, defaults: dict):
+    """
+    :return: True if the GloBee fields differ or the payment was inserted by an unverified IPN and not announced yet
+    """
+    return row.signal_pending or any(getattr(row, name) != defaults[name] for name in GLOBEE_FIELDS)
+
+
+class _PolledPayment:
+    __slots__ = ('payment_id', 'payment_status', 'confirmation_speed', 'expires_at', 'unchanged', 'version')
+
+    def __init__(self, payment_id: str, payment_status: str, confirmation_speed: str, expires_at: float):
+        self.payment_id = payment_id
+        self.payment_status = payment_status
+        self.confirmation_speed = confirmation_speed
+        self.expires_at = expires_at
+        self.unchanged = 0
+        self.version = 0
+
+
+class PollingScheduler:
+    """
+    Polls the GlobeeIPN payments that can still change. Every payment has its own interval, see get_poll_interval(),
+    the next due checks are kept in a heap. Payments whose GloBee data changed are saved as verified and send globee_valid_ipn,
+    the rows are locked with SELECT ... FOR UPDATE and payments whose status was changed by an IPN meanwhile are skipped.
+    """
+
+    def __init__(self, batch_size: int = 100, max_workers: int = None, clock=time):
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.clock = clock
+        self.payments = {}
+        self.checked = 0
+        self.changed = 0
+        self._heap = []
+        self._seq = 0
+        self.globee_payment = GlobeePayment(priority=PRIORITY_BATCH)
+
+    def __len__(self):
+        return len(self.payments)
+
+    def _schedule(self, payment: _PolledPayment, now: float, check_now: bool = False):
+        payment.version += 1
+        interval = get_poll_interval(payment.payment_status, payment.confirmation_speed, payment.expires_at, now, payment.unchanged)
+        if interval is None:
+            del self.payments[payment.payment_id]
+            return
+        if check_now:
+            interval = 0
+        self._seq += 1
+        heapq.heappush(self._heap, (now + interval, self._seq, payment.payment_id, payment.version))
+
+    def load(self, check_now: bool = False):
+        """
+        Adds new payments from the database and updates payments whose status changed in the meantime, e.g. by an IPN.
+        Payments that are no longer polled are removed, expired payments are filtered by the database.
+        :param check_now: new and updated payments are due immediately instead of after their first interval
+        :return: number of polled payments
+        """
+        now = self.clock()
+        expired = datetime.fromtimestamp(now, timezone.utc)
+        seen = set()
+        rows = GlobeeIPN.objects.filter(
+            Q(payment_status__in=UNPAID_STATUSES, expires_at__gte=expired) |
+            Q(payment_status__in=PAID_STATUSES, expires_at__gte=expired - timedelta(seconds=get_poll_max_age()))
+        ).values_list(
+            'payment_id', 'payment_status', 'confirmation_speed', 'expires_at'
+        )
+        for payment_id, payment_status, confirmation_speed, expires_at in rows.iterator():
+            seen.add(payment_id)
+            payment = self.payments.get(payment_id)
+            if payment is None:
+                payment = self.payments[payment_id] = _PolledPayment(payment_id, payment_status, confirmation_speed, expires_at.timestamp())
+            elif payment.payment_status == payment_status:
+                continue
+            else:
+                payment.payment_status = payment_status
+                payment.unchanged = 0
+            self._schedule(payment, now, check_now)
+        for payment_id in set(self.payments) - seen:
+            del self.payments[payment_id]
+        return len(self.payments)
+
+    def next_due(self):
+        """
+        :return: timestamp of the next check or None if no payment is polled
+        """
+        while self._heap:
+            due, seq, payment_id, version = self._heap[0]
+            payment = self.payments.get(payment_id)
+            if payment is not None and payment.version == version:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def poll(self):
+        """
+        Fetches up to batch_size due payments concurrently, saves the changed ones with one bulk_update and reschedules them.
+        :return: tuple of (checked, changed) counts
+        """
+        now = self.clock()
+        due = []
+        while len(due) < self.batch_size:
+            next_due = self.next_due()
+            if next_due is None or next_due > now:
+                break
+            due.append(self.payments[heapq.heappop(self._heap)[2]])
+        if not due:
+            return 0, 0
+
+        payments = {payment.payment_id: payment for payment in due}
+        # read before the fetch, so an IPN saved meanwhile is detected by its status
+        rows = GlobeeIPN.objects.in_bulk(list(payments), field_name='payment_id')
+        candidates = {}
+        for result in self.globee_payment.get_payments_by_ids(list(payments), max_workers=self.max_workers):
+            if result.error is None:
+                try:
+                    defaults = get_ipn_defaults(result.data)
+                except (KeyError, TypeError, ValueError) as e:
+                    result = result._replace(error=e)
+            if result.error is not None:
+                logger.error('Polling of payment %s failed: %r' % (result.payment_id, result.error))
+                continue
+            row = rows.get(result.payment_id)
+            # the verification status alone is no change, unverified payments are marked as verified silently
+            if row is not None and (_is_changed(row, defaults) or row.verification_status != VERIFICATION_STATUS_VERIFIED):
+                candidates[result.payment_id] = (defaults, result.data)
+
+        saved = []
+        if candidates:
+            with transaction.atomic():
+                locked = GlobeeIPN.objects.select_for_update().in_bulk(list(candidates), field_name='payment_id')
+                for payment_id, (defaults, payment_data) in candidates.items():
+                    row = locked.get(payment_id)
+                    if row is None:
+                        rows.pop(payment_id)
+                        continue
+                    # an IPN updated the payment since it was read, its data is at least as new as ours
+                    if row.payment_status != rows[payment_id].payment_status:
+                        rows[payment_id] = row
+                        continue
+                    data_changed = _is_changed(row, defaults)
+                    defaults.update(verification_status=VERIFICATION_STATUS_VERIFIED, signal_pending=False)
+                    for name, value in defaults.items():
+                        setattr(row, name, value)
+                    rows[payment_id] = row
+                    saved.append((row, payment_data, data_changed))
+                GlobeeIPN.objects.bulk_update([row for row, payment_data, data_changed in saved], SAVED_FIELDS)
+
+        changed = 0
+        for row, payment_data, data_changed in saved:
+            if data_changed:
+                refresh_payment_cache(payment_data, True)
+                row.send_valid_signal()
+                changed += 1
+        for payment_id, payment in payments.items():
+            row = rows.get(payment_id)
+            if row is not None and row.payment_status != payment.payment_status:
+                payment.payment_status = row.payment_status
+                payment.unchanged = 0
+            else:
+                payment.unchanged += 1
+            if row is not None:
+                payment.confirmation_speed = row.confirmation_speed
+                payment.expires_at = row.expires_at.timestamp()
+            self._schedule(payment, now)
+        self.checked += len(due)
+        self.changed += changed
+        return len(due), changed
+
+    def run(self, reload_interval: float = 60, once: bool = False, max_sleep: float = 5):
+        """
+        Polls the due payments until interrupted and reloads the payments from the database every reload_interval seconds.
+        :param reload_interval: seconds between two loads of the payments
+        :param once: check every payment once and stop
+        :param max_sleep: max seconds to sleep between two polls
+        :return: tuple of (checked, changed) counts
+        """
+        self.load(check_now=once)
+        reloaded = self.clock()
+        while True:
+            if self.poll()[0]:
+                continue
+            if once:
+                return self.checked, self.changed
+            now = self.clock()
+            if now - reloaded >= reload_interval:
+                self.load()
+                reloaded = now
+            next_due = self.next_due()
+            sleep(max(min(max_sleep, (next_due or now + max_sleep) - now, reloaded + reload_interval - now), 0.01))
@@ -0,0 +1,101 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from globee.models import GlobeeIPNInbox
+
+
+class DatabaseQueue:
+    """
+    IPN queue backend storing the raw bodies in the GlobeeIPNInbox table.
+    Claimed IPNs are leased to a worker. If the worker crashes the lease expires and the IPN is claimed again.
+    The signal state is stored in the same database as the payments, so it is saved in the same transaction.
+    """
+
+    def __init__(self, max_attempts: int = None):
+        self.max_attempts = max_attempts or getattr(settings, 'GLOBEE_IPN_MAX_ATTEMPTS', 5)
+
+    def enqueue(self, body: str):
+        """
+        Adds a raw IPN body to the queue.
+        :param body: raw IPN request body
+        """
+        GlobeeIPNInbox.objects.create(body=body)
+
+    def claim(self, batch_size: int, lease: int = 60):
+        """
+        Claims the oldest unclaimed IPNs.
+        :param batch_size: max number of IPNs
+        :param lease: seconds until the IPNs can be claimed by another worker
+        :return: list of (message id, body) tuples
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            ids = list(
+                GlobeeIPNInbox.objects
+                .select_for_update(skip_locked=True)
+                .filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now), attempts__lt=self.max_attempts)
+                .order_by('pk')
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            GlobeeIPNInbox.objects.filter(pk__in=ids).update(locked_until=now + timedelta(seconds=lease), attempts=F('attempts') + 1)
+        return list(GlobeeIPNInbox.objects.filter(pk__in=ids).order_by('pk').values_list('pk', 'body'))
+
+    def ack(self, message_ids):
+        """
+        Removes processed IPNs from the queue.
+        :param message_ids: list of message ids
+        """
+        GlobeeIPNInbox.objects.filter(pk__in=message_ids).delete()
+
+    def fail(self, message_id, error: str, retry: bool = True):
+        """
+        Releases an IPN that could not be processed, it can be claimed again after get_retry_delay().
+        :param message_id: message id
+        :param error: error message
+        :param retry: False if processing the IPN can never succeed
+        """
+        updates = {'last_error': error}
+        if retry:
+            attempts = GlobeeIPNInbox.objects.filter(pk=message_id).values_list('attempts', flat=True).first() or 1
+            updates['locked_until'] = timezone.now() + timedelta(seconds=self.get_retry_delay(attempts))
+        else:
+            updates['locked_until'] = None
+            updates['attempts'] = self.max_attempts
+        GlobeeIPNInbox.objects.filter(pk=message_id).update(**updates)
+
+    @staticmethod
+    def get_retry_delay(attempts: int):
+        """
+        :param attempts: number of times the IPN was claimed
+        :return: seconds until a failed IPN is claimed again, doubles with every attempt up to GLOBEE_IPN_RETRY_MAX_DELAY
+        """
+        delay = getattr(settings, 'GLOBEE_IPN_RETRY_DELAY', 5)
+        return min(delay * 2 ** (attempts - 1), getattr(settings, 'GLOBEE_IPN_RETRY_MAX_DELAY', 300))
+
+    def mark_signal_pending(self, message_ids):
+        """
+        Remembers that the payments of the IPNs were saved and their signals were not sent yet,
+        so a worker that claims them again after a crash still sends the signals.
+        :param message_ids: list of message ids
+        """
+        GlobeeIPNInbox.objects.filter(pk__in=message_ids).update(signal_pending=True)
+
+    def get_signal_pending(self, message_ids):
+        """
+        :param message_ids: list of message ids
+        :return: set of the message ids whose signals were not sent yet
+        """
+        return set(GlobeeIPNInbox.objects.filter(pk__in=message_ids, signal_pending=True).values_list('pk', flat=True))
+
+
+def get_ipn_queue():
+    """
+    Returns an instance of the queue backend set in GLOBEE_IPN_QUEUE_BACKEND.
+    :return: queue backend
+    """
+    return import_string(getattr(settings, 'GLOBEE_IPN_QUEUE_BACKEND', 'globee.queue.DatabaseQueue'))()
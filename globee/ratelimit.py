@@ -0,0 +1,139 @@
+import asyncio
+from time import monotonic, sleep, time
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import caches
+
+from globee.metrics import registry
+from globee.resilience import GlobeeUnavailableError
+
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BATCH = 'batch'
+
+DEFAULT_MAX_WAIT = {
+    PRIORITY_INTERACTIVE: 2,
+    PRIORITY_BATCH: 60,
+}
+
+rate_limit_wait = registry.histogram(
+    'globee_rate_limit_wait_seconds', 'Time GloBee api requests waited for the rate limiter', ('priority',)
+)
+rate_limit_rejections = registry.counter(
+    'globee_rate_limit_rejected_total', 'GloBee api requests rejected because the rate limit wait was too long', ('priority',)
+)
+
+
+class RateLimitExceeded(GlobeeUnavailableError):
+    """
+    Raised if a request would have to wait longer than the max wait of its priority.
+    """
+
+
+class RateLimiter:
+    """
+    Token bucket stored in a Django cache, shared by all processes and hosts using the cache.
+    The bucket refills with rate tokens per second up to burst tokens. Batch requests leave
+    the reserved share of the bucket to interactive requests.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float = None, reserved: float = 0.2, cache_alias: str = 'default',
+                 max_wait: dict = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.reserved = reserved
+        self.cache = caches[cache_alias]
+        self.max_wait = dict(DEFAULT_MAX_WAIT, **(max_wait or {}))
+        self.bucket_key = '%s:bucket' % name
+        self.lock_key = '%s:lock' % name
+
+    def _take(self, threshold: float):
+        """
+        Takes a token if the bucket holds at least threshold tokens.
+        :return: 0 if a token was taken, otherwise the seconds until enough tokens are available
+        """
+        deadline = monotonic() + 1
+        while not self.cache.add(self.lock_key, 1, timeout=1):
+            if monotonic() >= deadline:
+                # the lock holder died, its lock expires on its own
+                return 0.01
+            sleep(0.001)
+        try:
+            now = time()
+            tokens, updated = self.cache.get(self.bucket_key) or (self.burst, now)
+            tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+            if tokens >= threshold:
+                self.cache.set(self.bucket_key, (tokens - 1, now), timeout=None)
+                return 0
+            self.cache.set(self.bucket_key, (tokens, now), timeout=None)
+            return (threshold - tokens) / self.rate
+        finally:
+            self.cache.delete(self.lock_key)
+
+    def _get_threshold(self, priority: str):
+        return 1 if priority == PRIORITY_INTERACTIVE else max(1, min(1 + self.reserved * self.burst, self.burst))
+
+    def _check_wait(self, priority: str, waited: float, delay: float):
+        """
+        Records the wait of a request that got a token or raises RateLimitExceeded if it would wait too long.
+        :return: True if the request got a token
+        """
+        if not delay:
+            rate_limit_wait.observe(waited, priority=priority)
+            return True
+        if waited + delay > self.max_wait.get(priority, 0):
+            rate_limit_rejections.inc(priority=priority)
+            raise RateLimitExceeded('GloBee api rate limit exceeded, %s request would wait %.2fs' % (priority, waited + delay))
+        return False
+
+    def acquire(self, priority: str = PRIORITY_INTERACTIVE):
+        """
+        Waits until a token is available.
+        :param priority: PRIORITY_INTERACTIVE or PRIORITY_BATCH
+        :return: seconds waited
+        """
+        threshold = self._get_threshold(priority)
+        start = monotonic()
+        while True:
+            delay = self._take(threshold)
+            waited = monotonic() - start
+            if self._check_wait(priority, waited, delay):
+                return waited
+            sleep(delay)
+
+    async def aacquire(self, priority: str = PRIORITY_INTERACTIVE):
+        """
+        Async variant of acquire(), the cache is accessed in a worker thread and the event loop isn't blocked while waiting.
+        :param priority: PRIORITY_INTERACTIVE or PRIORITY_BATCH
+        :return: seconds waited
+        """
+        threshold = self._get_threshold(priority)
+        take = sync_to_async(self._take, thread_sensitive=False)
+        start = monotonic()
+        while True:
+            delay = await take(threshold)
+            waited = monotonic() - start
+            if self._check_wait(priority, waited, delay):
+                return waited
+            await asyncio.sleep(delay)
+
+
+def get_rate_limiter(key_prefix: str):
+    """
+    Returns the rate limiter for the key prefix of an auth key and api url or None if GLOBEE_RATE_LIMIT is not set.
+    :param key_prefix: see globee.cache.get_key_prefix()
+    :return: RateLimiter or None
+    """
+    rate = getattr(settings, 'GLOBEE_RATE_LIMIT', None)
+    if not rate:
+        return None
+    return RateLimiter(
+        '%s:ratelimit' % key_prefix,
+        rate,
+        burst=getattr(settings, 'GLOBEE_RATE_LIMIT_BURST', None),
+        reserved=getattr(settings, 'GLOBEE_RATE_LIMIT_RESERVED', 0.2),
+        cache_alias=getattr(settings, 'GLOBEE_RATE_LIMIT_CACHE', 'default'),
+        max_wait=getattr(settings, 'GLOBEE_RATE_LIMIT_MAX_WAIT', None),
+    )
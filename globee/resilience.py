@@ -0,0 +1,209 @@
+import random
+from hashlib import sha1
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep, time
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import caches
+
+from globee.metrics import registry
+
+
+DEFAULT_TIMEOUT = (5, 30)
+
+circuit_rejections = registry.counter('globee_circuit_open_total', 'GloBee api requests rejected by the open circuit breaker')
+bulkhead_rejections = registry.counter('globee_bulkhead_full_total', 'GloBee api requests rejected because all bulkhead slots were taken')
+
+_semaphores = {}
+_semaphores_lock = Lock()
+
+
+class GlobeeUnavailableError(Exception):
+    """
+    Base class of the errors raised instead of sending a request to GloBee.
+    Unlike a ValidationError it doesn't mean that GloBee rejected the request, it can be retried later.
+    """
+
+
+class CircuitOpenError(GlobeeUnavailableError):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+    """
+
+
+class BulkheadFullError(GlobeeUnavailableError):
+    """
+    Raised if no bulkhead slot became free within GLOBEE_BULKHEAD_WAIT.
+    """
+
+
+def get_timeout():
+    """
+    Returns the timeout set in GLOBEE_TIMEOUT.
+    :return: seconds or tuple of (connect, read) seconds
+    """
+    return getattr(settings, 'GLOBEE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def _get_key(api_url: str):
+    return 'globee:resilience:%s' % sha1(api_url.encode('utf-8')).hexdigest()[:16]
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker whose state is stored in a Django cache and therefore shared by all processes.
+
+    closed: requests are sent, consecutive failures are counted.
+    open: after failure_threshold consecutive failures requests fail fast with CircuitOpenError.
+    half-open: recovery_timeout seconds after opening one trial request is sent,
+    its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30, cache_alias: str = 'default'):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.cache = caches[cache_alias]
+        self.failures_key = '%s:failures' % name
+        self.opened_key = '%s:opened' % name
+        self.trial_key = '%s:trial' % name
+        self._had_failures = True
+
+    def before_request(self):
+        """
+        Raises CircuitOpenError if the circuit is open.
+        :return: True if the request is the half-open trial, False if the circuit is closed
+        """
+        state = self.cache.get_many([self.opened_key, self.failures_key])
+        opened_at = state.get(self.opened_key)
+        self._had_failures = bool(state.get(self.failures_key))
+        if opened_at is None:
+            return False
+        if time() - opened_at >= self.recovery_timeout and self.cache.add(self.trial_key, 1, timeout=self.recovery_timeout):
+            return True
+        circuit_rejections.inc()
+        raise CircuitOpenError('GloBee api unavailable, circuit breaker is open')
+
+    def record_success(self, trial: bool = False):
+        """
+        Closes the circuit after a successful trial and resets the failure count.
+        :param trial: True if the request was the half-open trial
+        """
+        if trial or self._had_failures:
+            self.cache.delete_many([self.failures_key, self.opened_key, self.trial_key])
+
+    def record_failure(self, trial: bool = False):
+        """
+        Counts a failure and opens the circuit when the threshold is reached or the trial failed.
+        The count doesn't expire, only a success resets it.
+        :param trial: True if the request was the half-open trial
+        """
+        if self.cache.add(self.failures_key, 1, timeout=None):
+            failures = 1
+        else:
+            try:
+                failures = self.cache.incr(self.failures_key)
+            except ValueError:
+                failures = 1
+        if trial or failures >= self.failure_threshold:
+            self.cache.set(self.opened_key, time(), timeout=None)
+            self.cache.delete(self.trial_key)
+
+    def reset(self):
+        self.cache.delete_many([self.failures_key, self.opened_key, self.trial_key])
+
+
+class Bulkhead:
+    """
+    Limits the number of concurrent requests. With a cache alias the slots are leases in the Django cache
+    and shared by all processes, slots of crashed processes are freed after the lease expires.
+    Use it as context manager, or as async context manager in coroutines.
+    """
+
+    def __init__(self, name: str, size: int, wait: float = 0, cache_alias: str = None, lease: float = 60):
+        self.name = name
+        self.size = size
+        self.wait = wait
+        self.lease = lease
+        self.cache = caches[cache_alias] if cache_alias else None
+        self._slot = None
+        if self.cache is None:
+            with _semaphores_lock:
+                self.semaphore = _semaphores.setdefault((name, size), BoundedSemaphore(size))
+
+    def __enter__(self):
+        if self.cache is None:
+            acquired = self.semaphore.acquire(timeout=self.wait) if self.wait else self.semaphore.acquire(blocking=False)
+        else:
+            acquired = self._acquire_shared()
+        if not acquired:
+            bulkhead_rejections.inc()
+            raise BulkheadFullError('GloBee api unavailable, all %s bulkhead slots are taken' % self.size)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.cache is None:
+            self.semaphore.release()
+        else:
+            self.cache.delete(self._slot)
+
+    async def __aenter__(self):
+        # waiting for a slot blocks, so it happens in a worker thread
+        return await sync_to_async(self.__enter__, thread_sensitive=False)()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.cache is None:
+            self.semaphore.release()
+        else:
+            await self.cache.adelete(self._slot)
+
+    def _acquire_shared(self):
+        deadline = monotonic() + self.wait
+        while True:
+            offset = random.randrange(self.size)
+            for i in range(self.size):
+                slot = '%s:slot:%s' % (self.name, (offset + i) % self.size)
+                if self.cache.add(slot, 1, timeout=self.lease):
+                    self._slot = slot
+                    return True
+            if monotonic() >= deadline:
+                return False
+            sleep(0.05)
+
+
+def get_circuit_breaker(api_url: str):
+    """
+    Returns the circuit breaker of the api url or None if GLOBEE_CIRCUIT_BREAKER is disabled.
+    :param api_url: the base url of the GloBee payment api
+    :return: CircuitBreaker or None
+    """
+    if not getattr(settings, 'GLOBEE_CIRCUIT_BREAKER', False):
+        return None
+    return CircuitBreaker(
+        _get_key(api_url),
+        failure_threshold=getattr(settings, 'GLOBEE_CIRCUIT_FAILURES', 5),
+        recovery_timeout=getattr(settings, 'GLOBEE_CIRCUIT_RECOVERY', 30),
+        cache_alias=getattr(settings, 'GLOBEE_CIRCUIT_CACHE', 'default'),
+    )
+
+
+def get_bulkhead(api_url: str):
+    """
+    Returns a new bulkhead for one request to the api url or None if GLOBEE_BULKHEAD_SIZE is not set.
+    :param api_url: the base url of the GloBee payment api
+    :return: Bulkhead or None
+    """
+    size = getattr(settings, 'GLOBEE_BULKHEAD_SIZE', None)
+    if not size:
+        return None
+    timeout = get_timeout()
+    timeout = sum(timeout) if isinstance(timeout, (tuple, list)) else timeout or 60
+    return Bulkhead(
+        _get_key(api_url),
+        size,
+        wait=getattr(settings, 'GLOBEE_BULKHEAD_WAIT', 0),
+        cache_alias=getattr(settings, 'GLOBEE_BULKHEAD_CACHE', None),
+        # a request holds its slot for all retries
+        lease=timeout * (getattr(settings, 'GLOBEE_MAX_RETRIES', 0) + 1) + 1,
+    )
@@ -1,3 +1,7 @@
 from django.dispatch import Signal
 
 globee_valid_ipn = Signal()
+globee_duplicate_ipn = Signal()
+globee_api_request = Signal()
+# sent once per chunk of expired payments with sender=GlobeeIPN and payment_ids
+globee_expired_ipns = Signal()
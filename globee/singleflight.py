@@ -0,0 +1,175 @@
+import asyncio
+from threading import Event, Lock
+from time import monotonic, sleep
+
+from django.core.cache import caches
+
+from globee.metrics import registry
+
+
+class _Call:
+
+    def __init__(self):
+        self.event = Event()
+        self.started = False
+        self.result = None
+        self.error = None
+
+
+class _AsyncCall:
+
+    def __init__(self):
+        self.task = None
+        self.started = False
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one call whose result is shared by all callers.
+    A caller only shares a call that starts after its request, if a call is already running the callers
+    that arrive meanwhile share the next call, which starts once the running call finished.
+    Optionally coordinates with other processes through a Django cache: only one process calls,
+    the others wait for its result in the cache.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = Lock()
+        self.hits = registry.counter('globee_%s_coalesced_total' % name, 'calls answered by an in-flight %s call' % name)
+        self.misses = registry.counter('globee_%s_calls_total' % name, '%s calls that were executed' % name)
+
+    def do(self, key: str, func, *args, cache_alias: str = None, timeout: float = 10):
+        """
+        Calls func(*args) unless a call with the same key that has not started yet is waiting, in that case
+        its result is returned.
+        :param key: identifies the call, e.g. the payment id
+        :param func: function to call
+        :param cache_alias: Django cache used to coalesce calls across processes
+        :param timeout: seconds to wait for another process before calling func
+        :return: result of func
+        """
+        with self._lock:
+            calls = self._calls.setdefault(key, [])
+            previous = calls[-1] if calls else None
+            leader = previous is None or previous.started
+            if leader:
+                call = _Call()
+                call.started = previous is None
+                calls.append(call)
+            else:
+                call = previous
+
+        if not leader:
+            call.event.wait()
+            self.hits.inc()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if not call.started:
+                # the running call started before our request, wait for it and call again
+                previous.event.wait()
+                with self._lock:
+                    call.started = True
+            if cache_alias:
+                call.result = self._do_shared(key, func, args, caches[cache_alias], timeout)
+            else:
+                self.misses.inc()
+                call.result = func(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                calls = self._calls[key]
+                calls.remove(call)
+                if not calls:
+                    del self._calls[key]
+            call.event.set()
+
+    @staticmethod
+    def _next_sequence(cache, key: str):
+        """
+        :return: next value of a counter shared by all processes using the cache
+        """
+        for attempt in range(2):
+            cache.add(key, 0, None)
+            try:
+                return cache.incr(key)
+            except ValueError:
+                # evicted between add and incr
+                pass
+        raise ValueError('Could not increment %s' % key)
+
+    def _do_shared(self, key: str, func, args, cache, timeout: float):
+        lock_key = 'globee:singleflight:%s:%s:lock' % (self.name, key)
+        result_key = 'globee:singleflight:%s:%s:result' % (self.name, key)
+        sequence_key = 'globee:singleflight:%s:%s:sequence' % (self.name, key)
+        # only results of calls that started after our request are fresh, the shared sequence orders
+        # the requests and calls of all processes without comparing their clocks
+        requested = self._next_sequence(cache, sequence_key)
+        deadline = monotonic() + timeout
+        while True:
+            shared = cache.get(result_key)
+            if shared is not None and shared[0] > requested:
+                self.hits.inc()
+                return shared[1]
+            if cache.add(lock_key, requested, timeout):
+                break
+            if monotonic() >= deadline:
+                self.misses.inc()
+                return func(*args)
+            sleep(0.02)
+
+        try:
+            shared = cache.get(result_key)
+            if shared is not None and shared[0] > requested:
+                self.hits.inc()
+                return shared[1]
+            started = self._next_sequence(cache, sequence_key)
+            self.misses.inc()
+            result = func(*args)
+            cache.set(result_key, (started, result), timeout)
+            return result
+        finally:
+            cache.delete(lock_key)
+
+    async def ado(self, key: str, coro_func, *args):
+        """
+        Awaits coro_func(*args) unless a call with the same key that has not started yet is waiting on this
+        event loop, in that case its result is returned.
+        :param key: identifies the call, e.g. the payment id
+        :param coro_func: coroutine function to call
+        :return: result of coro_func
+        """
+        loop_key = (asyncio.get_running_loop(), key)
+        calls = self._async_calls.setdefault(loop_key, [])
+        if calls and not calls[-1].started:
+            self.hits.inc()
+            return await asyncio.shield(calls[-1].task)
+
+        self.misses.inc()
+        call = _AsyncCall()
+        call.task = asyncio.ensure_future(self._run_async(call, calls[-1] if calls else None, coro_func, args))
+        call.task.add_done_callback(lambda task: self._remove_async_call(loop_key, call))
+        calls.append(call)
+        return await asyncio.shield(call.task)
+
+    @staticmethod
+    async def _run_async(call: _AsyncCall, previous: _AsyncCall, coro_func, args):
+        if previous is not None:
+            # the running call started before our request, wait for it and call again
+            await asyncio.wait([previous.task])
+        call.started = True
+        return await coro_func(*args)
+
+    def _remove_async_call(self, loop_key, call: _AsyncCall):
+        calls = self._async_calls.get(loop_key)
+        if calls is not None:
+            calls.remove(call)
+            if not calls:
+                del self._async_calls[loop_key]
@@ -0,0 +1,313 @@
+"""
+A fake GloBee payment api for tests, offline development and load tests.
+
+    api = FakeGlobeeAPI(auth_key='YOUR KEY', latency=0.05, error_rate=0.01)
+
+    # on localhost, set GLOBEE_API_URL to server.api_url
+    with FakeGlobeeServer(api) as server:
+        ...
+
+    # in-process with requests / httpx
+    session.mount(api_url, FakeGlobeeAdapter(api))
+    httpx.AsyncClient(transport=api.httpx_transport())
+"""
+import json
+import random
+import re
+import string
+import sys
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator, validate_email
+
+
+ACCOUNT_PAYMENT_METHODS = [
+    {'id': 'BTC', 'name': 'Bitcoin'},
+    {'id': 'LTC', 'name': 'Litecoin'},
+    {'id': 'XMR', 'name': 'Monero'},
+    {'id': 'ETH', 'name': 'Ethereum'},
+]
+
+UPDATABLE_FIELDS = ('custom_payment_id', 'custom_store_reference', 'callback_data', 'customer', 'notification_email')
+
+
+class FakeGlobeeAPI:
+    """
+    In-memory implementation of the GloBee payment api v1.
+    """
+
+    def __init__(self, auth_key: str, latency=0, error_rate: float = 0, error_status: int = 503,
+                 base_path: str = '/payment-api/v1', redirect_url: str = 'https://test.globee.com'):
+        """
+        :param auth_key: the only accepted X-AUTH-KEY
+        :param latency: seconds to wait before every response, or a (min, max) tuple
+        :param error_rate: share of requests answered with error_status
+        :param error_status: status code of injected errors
+        :param base_path: path prefix of the api
+        :param redirect_url: base url of the payment pages
+        """
+        self.auth_key = auth_key
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.base_path = base_path.rstrip('/')
+        self.redirect_url = redirect_url.rstrip('/')
+        self.payments = {}
+        self.request_count = 0
+        self._lock = Lock()
+        self._routes = [
+            ('GET', re.compile(r'^/ping$'), self.ping),
+            ('POST', re.compile(r'^/payment-request$'), self.create_payment),
+            ('GET', re.compile(r'^/payment-request/(?P<payment_id>[^/]+)$'), self.get_payment),
+            ('PUT', re.compile(r'^/payment-request/(?P<payment_id>[^/]+)$'), self.update_payment),
+            ('GET', re.compile(r'^/payment-request/(?P<payment_id>[^/]+)/payment-methods$'), self.get_payment_details),
+            ('GET', re.compile(r'^/payment-request/(?P<payment_id>[^/]+)/addresses/(?P<currency_id>[^/]+)(?:/(?P<address_id>[^/]+))?$'), self.get_address),
+            ('GET', re.compile(r'^/account/payment-methods$'), self.get_account_payment_methods),
+        ]
+
+    def handle(self, method: str, path: str, headers, body: bytes = None):
+        """
+        Answers a request.
+        :param method: http method
+        :param path: url path including the base path
+        :param headers: request headers
+        :param body: request body
+        :return: tuple of (status code, response dict)
+        """
+        with self._lock:
+            self.request_count += 1
+        latency = random.uniform(*self.latency) if isinstance(self.latency, (tuple, list)) else self.latency
+        if latency:
+            sleep(latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status, {'success': False, 'message': 'injected error'}
+        if headers.get('X-AUTH-KEY') != self.auth_key:
+            return 401, {'success': False, 'message': 'Unauthenticated.'}
+        if not path.startswith(self.base_path):
+            return 404, {'success': False, 'message': 'Not Found'}
+
+        path = path[len(self.base_path):]
+        for route_method, pattern, view in self._routes:
+            match = pattern.match(path)
+            if match and route_method == method:
+                try:
+                    data = json.loads(body.decode('utf-8')) if body else {}
+                except ValueError:
+                    return 400, {'success': False, 'message': 'invalid json'}
+                with self._lock:
+                    return view(data, **match.groupdict())
+        return 404, {'success': False, 'message': 'Not Found'}
+
+    @staticmethod
+    def _validation_errors(data: dict, required: bool = True):
+        errors = []
+        if required and not isinstance(data.get('total'), (int, float)):
+            errors.append({'field': 'total', 'message': 'The total field is required and must be a number.'})
+        customer = data.get('customer')
+        if required or customer is not None:
+            try:
+                validate_email((customer or {}).get('email'))
+            except ValidationError:
+                errors.append({'field': 'customer.email', 'message': 'The customer.email field must be a valid email address.'})
+        for field in ('success_url', 'cancel_url', 'ipn_url'):
+            if data.get(field):
+                try:
+                    URLValidator()(data[field])
+                except ValidationError:
+                    errors.append({'field': field, 'message': 'The %s format is invalid.' % field})
+        return errors
+
+    def _get_payment(self, payment_id: str):
+        payment = self.payments.get(payment_id)
+        if payment is None:
+            return 404, {'success': False, 'message': 'Payment request not found.'}
+        return 200, {'success': True, 'data': dict(payment)}
+
+    def ping(self, data):
+        return 200, {'success': True, 'result': {'name': 'Fake GloBee Merchant', 'url': 'https://example.com'}}
+
+    def create_payment(self, data):
+        errors = self._validation_errors(data)
+        if errors:
+            return 422, {'success': False, 'errors': errors}
+        payment_id = ''.join(random.choice(string.ascii_letters + string.digits) for i in range(22))
+        now = datetime.utcnow()
+        self.payments[payment_id] = {
+            'id': payment_id,
+            'status': 'unpaid',
+            'total': '%.2f' % data['total'],
+            'adjusted_total': '%.2f' % data['total'],
+            'currency': data.get('currency', 'USD'),
+            'custom_payment_id': data.get('custom_payment_id'),
+            'custom_store_reference': data.get('custom_store_reference'),
+            'callback_data': data.get('callback_data'),
+            'customer': {'name': data['customer'].get('name'), 'email': data['customer']['email']},
+            'payment_details': {'currency': None},
+            'redirect_url': '%s/payment-request/%s' % (self.redirect_url, payment_id),
+            'success_url': data.get('success_url'),
+            'cancel_url': data.get('cancel_url'),
+            'ipn_url': data.get('ipn_url'),
+            'notification_email': data.get('notification_email'),
+            'confirmation_speed': data.get('confirmation_speed', 'medium'),
+            'expires_at': (now + timedelta(minutes=15)).strftime('%Y-%m-%d %H:%M:%S'),
+            'created_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        return self._get_payment(payment_id)
+
+    def get_payment(self, data, payment_id):
+        return self._get_payment(payment_id)
+
+    def update_payment(self, data, payment_id):
+        if payment_id not in self.payments:
+            return self._get_payment(payment_id)
+        errors = self._validation_errors(data, required=False)
+        if errors:
+            return 422, {'success': False, 'errors': errors}
+        for field in UPDATABLE_FIELDS:
+            if field in data:
+                self.payments[payment_id][field] = data[field]
+        return self._get_payment(payment_id)
+
+    def get_payment_details(self, data, payment_id):
+        if payment_id not in self.payments:
+            return self._get_payment(payment_id)
+        return 200, {'success': True, 'data': [
+            {'currency_id': method['id'], 'address_id': 'default'} for method in ACCOUNT_PAYMENT_METHODS
+        ]}
+
+    def get_address(self, data, payment_id, currency_id, address_id=None):
+        if payment_id not in self.payments:
+            return self._get_payment(payment_id)
+        if currency_id not in [method['id'] for method in ACCOUNT_PAYMENT_METHODS]:
+            return 422, {'success': False, 'message': 'Currency not supported.'}
+        payment = self.payments[payment_id]
+        return 200, {'success': True, 'data': {
+            'id': payment_id,
+            'currency': currency_id,
+            'address_id': address_id or 'default',
+            'address': 'fake-%s-address-%s' % (currency_id.lower(), payment_id),
+            'amount': payment['total'],
+        }}
+
+    def get_account_payment_methods(self, data):
+        return 200, {'success': True, 'data': list(ACCOUNT_PAYMENT_METHODS)}
+
+    def set_status(self, payment_id: str, status: str):
+        """
+        Changes the status of a payment, e.g. to simulate a payment.
+        :param payment_id: the payment id that identifies the payment request
+        :param status: new payment status
+        :return: payment data
+        """
+        with self._lock:
+            self.payments[payment_id]['status'] = status
+            return dict(self.payments[payment_id])
+
+    def httpx_transport(self):
+        """
+        Returns an httpx transport answering the requests in-process.
+        """
+        import httpx
+
+        def handler(request):
+            status, response = self.handle(request.method, request.url.path, request.headers, request.content)
+            return httpx.Response(status, json=response)
+
+        return httpx.MockTransport(handler)
+
+
+class FakeGlobeeAdapter(BaseAdapter):
+    """
+    requests transport adapter answering the requests in-process.
+    """
+
+    def __init__(self, api: FakeGlobeeAPI):
+        super().__init__()
+        self.api = api
+
+    def send(self, request, **kwargs):
+        body = request.body.encode('utf-8') if isinstance(request.body, str) else request.body
+        status, data = self.api.handle(request.method, urlsplit(request.url).path, request.headers, body)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response._content = json.dumps(data).encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that time out close the connection before the (delayed) response is written
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _FakeGlobeeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        status, data = self.server.api.handle(self.command, urlsplit(self.path).path, self.headers, body)
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGlobeeServer:
+    """
+    Serves a FakeGlobeeAPI on localhost in a background thread.
+    """
+
+    def __init__(self, api: FakeGlobeeAPI, host: str = '127.0.0.1', port: int = 0):
+        self.api = api
+        self.httpd = _ThreadingHTTPServer((host, port), _FakeGlobeeHandler)
+        self.httpd.api = api
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%s%s' % (host, port, self.api.base_path)
+
+    def start(self):
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
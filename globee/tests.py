@@ -1,11 +1,98 @@
+import asyncio
 import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from time import sleep, time
+from io import StringIO
+from unittest import mock, skipIf
 
-from django.core.exceptions import ValidationError
-from django.test import TestCase, override_settings, Client
+import requests
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.conf import settings
+from django.contrib.admin import AdminSite
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings, Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+
+from globee import dispatch
+from globee.admin import LargeTableGlobeeIPNAdmin
+from globee.cache import get_key_prefix, get_payment_keys, get_status_ttl
+from globee.core import AsyncGlobeePayment, GlobeePayment, close_sessions
+from globee.ipn import (
+    VERIFY_DEFERRED, VERIFY_SYNC, expire_ipns, get_ipn_defaults, get_verification_retry_delay, process_ipn_queue, reconcile_ipns,
+    save_ipn, verify_pending_ipns,
+)
+from globee.management.commands.globee_replay_ipns import Command as ReplayCommand
+from globee.metrics import (
+    MetricsRegistry, api_new_connections, api_request_seconds, api_response_bytes, api_responses, api_retries, ipn_duplicates,
+    ipn_seconds, ipn_stage_seconds, percentile
+)
+from globee.models import GlobeeIPN, GlobeeIPNInbox, VERIFICATION_STATUS_FAILED, VERIFICATION_STATUS_PENDING, VERIFICATION_STATUS_VERIFIED
+from globee.polling import PollingScheduler, get_poll_interval
+from globee.queue import DatabaseQueue
+from globee.ratelimit import PRIORITY_BATCH, RateLimiter, RateLimitExceeded, rate_limit_rejections, rate_limit_wait
+from globee.resilience import BulkheadFullError, CircuitOpenError, GlobeeUnavailableError, get_bulkhead
+from globee.singleflight import SingleFlight
+from globee.testing import FakeGlobeeAdapter, FakeGlobeeAPI, FakeGlobeeServer
+from globee.signals import globee_api_request, globee_duplicate_ipn, globee_expired_ipns, globee_valid_ipn
+from globee.views import globee_ipn_async_view
+
+
+fake_server = None
+fake_settings = None
+
+
+def setUpModule():
+    global fake_server, fake_settings
+    if os.environ.get('GLOBEE_TEST_LIVE_API'):
+        return
+    fake_server = FakeGlobeeServer(FakeGlobeeAPI(auth_key=settings.GLOBEE_AUTH_KEY)).start()
+    fake_settings = override_settings(GLOBEE_API_URL=fake_server.api_url)
+    fake_settings.enable()
+
+
+def tearDownModule():
+    if fake_server is not None:
+        fake_settings.disable()
+        fake_server.stop()
+        close_sessions()
+
 
-from globee.core import GlobeePayment
-from globee.models import GlobeeIPN
+IPN_PAYMENT_DATA = {
+    "id": "a1B2c3D4e5F6g7H8i9J0kL",
+    "status": "paid",
+    "total": "123.45",
+    "currency": "USD",
+    "custom_payment_id": "742",
+    "callback_data": "example data",
+    "customer": {
+        "name": "John Smit",
+        "email": "john.smit@example.com"
+    },
+    "redirect_url": "http:\/\/globee.com\/invoice\/a1B2c3D4e5F6g7H8i9J0kL",
+    "success_url": "https:\/\/www.example.com/success",
+    "cancel_url": "https:\/\/www.example.com/cancel",
+    "ipn_url": "https:\/\/www.example.com/globee/ipn-callback",
+    "notification_email": None,
+    "confirmation_speed": "medium",
+    "expires_at": "2018-01-25 12:31:04",
+    "created_at": "2018-01-25 12:16:04"
+}
 
 
 class GlobeeInitTestCase(TestCase):
@@ -30,6 +117,490 @@ class GlobeeInitTestCase(TestCase):
             globee_payment = GlobeePayment()
 
 
+@override_settings(GLOBEE_AUTH_KEY='SESSION_KEY')
+class GlobeeSessionTestCase(TestCase):
+
+    def tearDown(self):
+        close_sessions()
+
+    def test_session_is_shared(self):
+        self.assertIs(GlobeePayment().session, GlobeePayment().session)
+
+    def test_session_per_auth_key(self):
+        session = GlobeePayment().session
+        with self.settings(GLOBEE_AUTH_KEY='OTHER_KEY'):
+            self.assertIsNot(session, GlobeePayment().session)
+        with self.settings(GLOBEE_API_URL='http://localhost/payment-api/v1'):
+            self.assertIsNot(session, GlobeePayment().session)
+
+    @override_settings(GLOBEE_POOL_MAXSIZE=3, GLOBEE_MAX_RETRIES=2)
+    def test_session_adapter_settings(self):
+        adapter = GlobeePayment().session.get_adapter('https://test.globee.com/')
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter.max_retries.total, 2)
+
+
+@override_settings(GLOBEE_AUTH_KEY='METRICS_KEY')
+class GlobeeApiMetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.api_requests = []
+        globee_api_request.connect(self.on_api_request)
+        self.server = FakeGlobeeServer(FakeGlobeeAPI(auth_key='METRICS_KEY')).start()
+        self.settings_override = override_settings(GLOBEE_API_URL=self.server.api_url)
+        self.settings_override.enable()
+        for metric in (api_request_seconds, api_responses, api_response_bytes, api_new_connections, api_retries):
+            metric.reset()
+
+    def tearDown(self):
+        globee_api_request.disconnect(self.on_api_request)
+        self.settings_override.disable()
+        self.server.stop()
+        close_sessions()
+
+    def on_api_request(self, sender, api_request, **kwargs):
+        self.api_requests.append(api_request)
+
+    @override_settings(GLOBEE_API_METRICS=True)
+    def test_api_metrics_registry(self):
+        globee_payment = GlobeePayment()
+        self.assertTrue(globee_payment.ping())
+        self.assertTrue(globee_payment.ping())
+        self.assertEqual(2, api_request_seconds.get(endpoint='ping')[0])
+        self.assertEqual(2, api_responses.get(endpoint='ping', status=200))
+        self.assertEqual(1, api_new_connections.get(endpoint='ping'))
+        self.assertGreater(api_response_bytes.get(endpoint='ping'), 0)
+        self.assertEqual([1, 0], [api_request.new_connections for api_request in self.api_requests])
+
+    def test_api_request_signal(self):
+        globee_payment = GlobeePayment(payment_data={'total': 13.37, 'customer': {'email': 'foobar@example.com'}})
+        globee_payment.create_request()
+        api_request = self.api_requests[0]
+        self.assertEqual(('POST', 'create_request', 200, 0, None), (
+            api_request.method, api_request.endpoint, api_request.status_code, api_request.retries, api_request.exception
+        ))
+        self.assertGreater(api_request.request_bytes, 0)
+        self.assertEqual(0, api_responses.value)
+
+    def test_api_request_failing_receiver(self):
+        def receiver(sender, api_request, **kwargs):
+            raise RuntimeError('receiver failed')
+
+        globee_api_request.connect(receiver)
+        try:
+            with self.assertLogs('globee.core', 'ERROR'):
+                self.assertTrue(GlobeePayment().ping())
+        finally:
+            globee_api_request.disconnect(receiver)
+        self.assertEqual(1, len(self.api_requests))
+
+    @override_settings(GLOBEE_MAX_RETRIES=2, GLOBEE_RETRY_BACKOFF=0)
+    def test_api_request_retries_and_exceptions(self):
+        self.server.api.error_rate = 1
+        with self.assertRaises(ValidationError):
+            GlobeePayment().get_payment_methods()
+        self.assertEqual((503, 2), (self.api_requests[0].status_code, self.api_requests[0].retries))
+        with self.settings(GLOBEE_API_URL='http://127.0.0.1:1/payment-api/v1'):
+            with self.assertRaises(requests.ConnectionError):
+                GlobeePayment().ping()
+        self.assertEqual('ConnectionError', self.api_requests[1].exception)
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_api_request_signal(self):
+        api = FakeGlobeeAPI(auth_key='METRICS_KEY')
+
+        def client(auth_key, api_url):
+            return httpx.AsyncClient(transport=api.httpx_transport())
+
+        with mock.patch('globee.core.get_async_client', client):
+            await AsyncGlobeePayment().get_payment_methods()
+        self.assertEqual(('GET', 'get_payment_methods', 200, None), (
+            self.api_requests[0].method, self.api_requests[0].endpoint, self.api_requests[0].status_code, self.api_requests[0].new_connections
+        ))
+
+
+@override_settings(GLOBEE_AUTH_KEY='RESILIENCE_KEY')
+class GlobeeResilienceTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.api = FakeGlobeeAPI(auth_key='RESILIENCE_KEY')
+        self.server = FakeGlobeeServer(self.api).start()
+        self.settings_override = override_settings(GLOBEE_API_URL=self.server.api_url)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.stop()
+        close_sessions()
+
+    @override_settings(GLOBEE_TIMEOUT=(1, 0.05))
+    def test_timeout(self):
+        self.api.latency = 0.5
+        with self.assertRaises(requests.Timeout):
+            GlobeePayment().ping()
+
+    @override_settings(GLOBEE_CIRCUIT_BREAKER=True, GLOBEE_CIRCUIT_FAILURES=2, GLOBEE_CIRCUIT_RECOVERY=0.1)
+    def test_circuit_breaker(self):
+        self.api.error_rate = 1
+        for i in range(2):
+            with self.assertRaises(ValidationError):
+                GlobeePayment().get_payment_methods()
+        with self.assertRaises(CircuitOpenError):
+            GlobeePayment().get_payment_methods()
+        self.assertEqual(2, self.api.request_count)
+
+        # the half-open trial fails and opens the circuit again
+        sleep(0.1)
+        with self.assertRaises(ValidationError):
+            GlobeePayment().get_payment_methods()
+        with self.assertRaises(CircuitOpenError):
+            GlobeePayment().get_payment_methods()
+        self.assertEqual(3, self.api.request_count)
+
+        # the half-open trial succeeds and closes the circuit
+        sleep(0.1)
+        self.api.error_rate = 0
+        self.assertIsInstance(GlobeePayment().get_payment_methods(), list)
+        self.assertIsInstance(GlobeePayment().get_payment_methods(), list)
+        self.assertEqual(5, self.api.request_count)
+
+    @override_settings(GLOBEE_CIRCUIT_BREAKER=True, GLOBEE_CIRCUIT_FAILURES=2, GLOBEE_CIRCUIT_RECOVERY=0.05)
+    def test_circuit_breaker_consecutive_failures(self):
+        # failures further apart than the recovery timeout are still consecutive
+        self.api.error_rate = 1
+        with self.assertRaises(ValidationError):
+            GlobeePayment().get_payment_methods()
+        sleep(0.1)
+        with self.assertRaises(ValidationError):
+            GlobeePayment().get_payment_methods()
+        with self.assertRaises(CircuitOpenError):
+            GlobeePayment().get_payment_methods()
+
+        # a success resets the count
+        sleep(0.1)
+        self.api.error_rate = 0
+        self.assertIsInstance(GlobeePayment().get_payment_methods(), list)
+        self.api.error_rate = 1
+        with self.assertRaises(ValidationError):
+            GlobeePayment().get_payment_methods()
+        with self.assertRaises(ValidationError):
+            GlobeePayment().get_payment_methods()
+        self.assertEqual(5, self.api.request_count)
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    @override_settings(GLOBEE_CIRCUIT_BREAKER=True, GLOBEE_CIRCUIT_FAILURES=2, GLOBEE_BULKHEAD_SIZE=1)
+    async def test_async_circuit_breaker(self):
+        self.api.error_rate = 1
+        for i in range(2):
+            with self.assertRaises(ValidationError):
+                await AsyncGlobeePayment().get_payment_methods()
+        with self.assertRaises(CircuitOpenError):
+            await AsyncGlobeePayment().get_payment_methods()
+        self.assertEqual(2, self.api.request_count)
+
+    @override_settings(GLOBEE_BULKHEAD_SIZE=1)
+    def test_bulkhead(self):
+        with get_bulkhead(self.server.api_url):
+            with self.assertRaises(BulkheadFullError) as cm:
+                GlobeePayment().ping()
+        # the request wasn't sent, GloBee didn't reject it
+        self.assertIsInstance(cm.exception, GlobeeUnavailableError)
+        self.assertNotIsInstance(cm.exception, ValidationError)
+        self.assertTrue(GlobeePayment().ping())
+
+    @override_settings(GLOBEE_BULKHEAD_SIZE=1, GLOBEE_BULKHEAD_CACHE='default', GLOBEE_BULKHEAD_WAIT=0.1)
+    def test_shared_bulkhead(self):
+        with get_bulkhead(self.server.api_url):
+            with self.assertRaises(BulkheadFullError):
+                GlobeePayment().ping()
+        self.assertTrue(GlobeePayment().ping())
+
+
+class GlobeeRateLimitTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        rate_limit_wait.reset()
+        rate_limit_rejections.reset()
+
+    def test_token_bucket(self):
+        limiter = RateLimiter('test', rate=20, burst=2, reserved=0.5, max_wait={PRIORITY_BATCH: 0})
+        self.assertLess(limiter.acquire(PRIORITY_BATCH), 0.01)
+        # the last token is reserved for interactive requests
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(PRIORITY_BATCH)
+        limiter.acquire()
+        self.assertGreater(limiter.acquire(), 0.02)
+        self.assertEqual(2, rate_limit_wait.get(priority='interactive')[0])
+        self.assertEqual(1, rate_limit_rejections.get(priority=PRIORITY_BATCH))
+
+    def test_rate_limited_payment(self):
+        api = FakeGlobeeAPI(auth_key=settings.GLOBEE_AUTH_KEY)
+        with FakeGlobeeServer(api) as server, self.settings(GLOBEE_API_URL=server.api_url, GLOBEE_RATE_LIMIT=1000):
+            self.assertTrue(GlobeePayment(priority=PRIORITY_BATCH).ping())
+        close_sessions()
+        self.assertEqual(1, rate_limit_wait.get(priority=PRIORITY_BATCH)[0])
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_rate_limited_payment(self):
+        api = FakeGlobeeAPI(auth_key=settings.GLOBEE_AUTH_KEY)
+
+        def client(auth_key, api_url):
+            return httpx.AsyncClient(transport=api.httpx_transport())
+
+        with mock.patch('globee.core.get_async_client', client), \
+                self.settings(GLOBEE_RATE_LIMIT=1, GLOBEE_RATE_LIMIT_MAX_WAIT={PRIORITY_BATCH: 0}):
+            globee_payment = AsyncGlobeePayment(priority=PRIORITY_BATCH)
+            self.assertTrue(await globee_payment.ping())
+            with self.assertRaises(RateLimitExceeded):
+                await globee_payment.ping()
+        self.assertEqual(1, api.request_count)
+        self.assertEqual(1, rate_limit_rejections.get(priority=PRIORITY_BATCH))
+
+
+@override_settings(GLOBEE_AUTH_KEY='ASYNC_KEY')
+class GlobeeAsyncPaymentTestCase(TestCase):
+
+    def setUp(self):
+        self.requests = []
+
+    def handler(self, request):
+        self.requests.append(request)
+        if request.headers['X-AUTH-KEY'] != 'ASYNC_KEY':
+            return httpx.Response(401, json={'success': False, 'message': 'invalid key'})
+        if request.url.path.endswith('/ping'):
+            return httpx.Response(200, json={'success': True, 'data': {'name': 'foobar'}})
+        if request.method == 'POST':
+            return httpx.Response(200, json={'success': True, 'data': {'id': 'PAYMENT_ID', 'redirect_url': 'https://test.globee.com/x'}})
+        if request.url.path.endswith('/INVALID_KEY'):
+            return httpx.Response(404, json={'success': False, 'errors': []})
+        return httpx.Response(200, json={'success': True, 'data': {'path': request.url.path}})
+
+    def mock_client(self, auth_key, api_url):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_ping_and_create(self):
+        with mock.patch('globee.core.get_async_client', self.mock_client):
+            globee_payment = AsyncGlobeePayment(payment_data={'total': 13.37, 'customer': {'email': 'foobar@example.com'}})
+            self.assertTrue(await globee_payment.ping())
+            self.assertTrue(globee_payment.check_required_fields())
+            self.assertIn("https://test.globee.com/", await globee_payment.create_request())
+            self.assertEqual(globee_payment.payment_id, 'PAYMENT_ID')
+            response = await globee_payment.get_payment_currency_details('BTC', address_id='default')
+            self.assertTrue(response['path'].endswith('/payment-request/PAYMENT_ID/addresses/BTC/default'))
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_errors(self):
+        with mock.patch('globee.core.get_async_client', self.mock_client):
+            globee_payment = AsyncGlobeePayment()
+            with self.assertRaises(ValidationError):
+                await globee_payment.get_payment_by_id()
+            with self.assertRaises(ValidationError):
+                await globee_payment.get_payment_by_id('INVALID_KEY')
+            with self.assertRaises(ValidationError):
+                await globee_payment.update_payment_request('PAYMENT_ID', {'customer': {}})
+            self.assertEqual(len(self.requests), 1)
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_payment_cache(self):
+        with mock.patch('globee.core.get_async_client', self.mock_client), self.settings(GLOBEE_CACHE='default', GLOBEE_CACHE_PAYMENTS=True):
+            await cache.aclear()
+            globee_payment = AsyncGlobeePayment()
+            self.assertEqual(await globee_payment.get_payment_by_id('PAYMENT_ID'), await globee_payment.get_payment_by_id('PAYMENT_ID'))
+            self.assertEqual(len(self.requests), 1)
+            await globee_payment.get_payment_by_id('PAYMENT_ID', cached=False)
+            self.assertEqual(len(self.requests), 2)
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_checkout_cache(self):
+        with mock.patch('globee.core.get_async_client', self.mock_client), self.settings(GLOBEE_CACHE='default'):
+            await cache.aclear()
+            globee_payment = AsyncGlobeePayment(payment_id='PAYMENT_ID')
+            self.assertEqual(await globee_payment.get_payment_methods(), await globee_payment.get_payment_methods())
+            self.assertEqual(await globee_payment.get_payment_details(), await globee_payment.get_payment_details())
+            self.assertEqual(
+                await globee_payment.get_payment_currency_details('BTC'), await globee_payment.get_payment_currency_details('BTC')
+            )
+            self.assertEqual(len(self.requests), 3)
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_update_invalidates_cache(self):
+        with mock.patch('globee.core.get_async_client', self.mock_client), self.settings(GLOBEE_CACHE='default'):
+            globee_payment = AsyncGlobeePayment(payment_data={'total': 13.37, 'customer': {'email': 'foobar@example.com'}})
+            prefix = get_key_prefix(globee_payment.auth_key, globee_payment.api_url)
+            key, version_key = get_payment_keys(prefix, 'payment_details', 'PAYMENT_ID')
+            await cache.aset(version_key, 1)
+            await globee_payment.update_payment_request('PAYMENT_ID')
+            self.assertEqual(2, await cache.aget(version_key))
+
+    @mock.patch('globee.core.httpx', None)
+    def test_async_requires_httpx(self):
+        with self.assertRaises(ImproperlyConfigured):
+            AsyncGlobeePayment()
+
+
+@override_settings(GLOBEE_AUTH_KEY='BULK_KEY')
+class GlobeeBulkPaymentTestCase(TestCase):
+
+    @staticmethod
+    def get_payment_by_id(payment_id=None, cached=True):
+        if payment_id.startswith('INVALID'):
+            raise ValidationError('status code: 404')
+        return {'id': payment_id}
+
+    def test_get_payments_by_ids(self):
+        consumed = []
+
+        def payment_ids():
+            for i in range(100):
+                consumed.append(i)
+                yield 'INVALID_%s' % i if i % 10 == 0 else 'ID_%s' % i
+
+        globee_payment = GlobeePayment()
+        with mock.patch.object(globee_payment, 'get_payment_by_id', side_effect=self.get_payment_by_id):
+            results = globee_payment.get_payments_by_ids(payment_ids(), max_workers=4)
+            first = next(results)
+            self.assertLessEqual(len(consumed), 8)
+            results = [first] + list(results)
+
+        self.assertEqual(len(results), 100)
+        failed = [result for result in results if result.error]
+        self.assertEqual(len(failed), 10)
+        self.assertTrue(all(result.payment_id.startswith('INVALID') and result.data is None for result in failed))
+        self.assertTrue(all(result.data == {'id': result.payment_id} for result in results if not result.error))
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_get_payments_by_ids(self):
+        async def get_payment_by_id(payment_id=None, cached=True):
+            return self.get_payment_by_id(payment_id)
+
+        globee_payment = AsyncGlobeePayment()
+        with mock.patch.object(globee_payment, 'get_payment_by_id', side_effect=get_payment_by_id):
+            results = [result async for result in globee_payment.get_payments_by_ids(['ID_1', 'INVALID_2', 'ID_3'], max_workers=2)]
+        self.assertEqual(sorted(result.payment_id for result in results if not result.error), ['ID_1', 'ID_3'])
+        self.assertEqual([result.payment_id for result in results if result.error], ['INVALID_2'])
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_get_payments_by_ids_aclose(self):
+        started, cancelled = [], []
+
+        async def get_payment_by_id(payment_id=None, cached=True):
+            started.append(payment_id)
+            if payment_id != 'ID_0':
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(payment_id)
+                    raise
+            return {'id': payment_id}
+
+        globee_payment = AsyncGlobeePayment()
+        with mock.patch.object(globee_payment, 'get_payment_by_id', side_effect=get_payment_by_id):
+            async with globee_payment.get_payments_by_ids(('ID_%s' % i for i in range(100)), max_workers=3) as results:
+                async for result in results:
+                    self.assertEqual(result.payment_id, 'ID_0')
+                    break
+            self.assertEqual(sorted(cancelled), ['ID_1', 'ID_2'])
+            self.assertEqual(len(started), 3)
+            self.assertEqual([result async for result in results], [])
+
+    @staticmethod
+    def get_payments_data():
+        payments_data = [
+            {'total': 10 + i, 'custom_payment_id': 'INVOICE_%s' % i, 'customer': {'name': 'foobar', 'email': 'foobar@example.com'}}
+            for i in range(5)
+        ]
+        payments_data.insert(2, {'total': '10', 'customer': {'email': 'foobar@example.com'}})
+        payments_data.insert(4, {'total': 10})
+        return payments_data
+
+    def check_created_payments(self, results, api):
+        self.assertEqual(7, len(results))
+        self.assertEqual([2, 4], [result.index for result in results if result.error])
+        self.assertTrue(all(isinstance(result.error, ValidationError) for result in results if result.error))
+        created = [result for result in results if not result.error]
+        self.assertEqual(5, len(api.payments))
+        self.assertEqual(sorted(api.payments), sorted(result.payment_id for result in created))
+        self.assertTrue(all(result.redirect_url and result.data['id'] == result.payment_id for result in created))
+
+    def test_create_requests(self):
+        api = FakeGlobeeAPI(auth_key='BULK_KEY')
+        with FakeGlobeeServer(api) as server, self.settings(GLOBEE_API_URL=server.api_url):
+            results = GlobeePayment().create_requests(self.get_payments_data(), max_workers=3, create_ipns=True)
+        close_sessions()
+        self.check_created_payments(results, api)
+        self.assertEqual(5, GlobeeIPN.objects.count())
+        self.assertEqual('INVOICE_3', GlobeeIPN.objects.get(payment_id=results[5].payment_id).custom_payment_id)
+        # existing payments are skipped
+        GlobeePayment._create_ipns(results)
+        self.assertEqual(5, GlobeeIPN.objects.count())
+
+    def test_create_requests_incomplete_response(self):
+        globee_payment = GlobeePayment()
+        with mock.patch.object(globee_payment, '_request'), \
+                mock.patch.object(globee_payment, '_get_response_data', return_value={'id': 'PAYMENT_ID'}):
+            results = globee_payment.create_requests(self.get_payments_data()[:2])
+        self.assertEqual([None, None], [result.payment_id for result in results])
+        self.assertTrue(all(isinstance(result.error, KeyError) for result in results))
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_async_create_requests(self):
+        api = FakeGlobeeAPI(auth_key='BULK_KEY')
+
+        def client(auth_key, api_url):
+            return httpx.AsyncClient(transport=api.httpx_transport())
+
+        with mock.patch('globee.core.get_async_client', client):
+            results = await AsyncGlobeePayment().create_requests(self.get_payments_data(), max_workers=3)
+        self.check_created_payments(results, api)
+
+
+class GlobeeFakeAPITestCase(TestCase):
+
+    def test_fake_api_adapter(self):
+        api = FakeGlobeeAPI(auth_key='ADAPTER_KEY')
+        with self.settings(GLOBEE_AUTH_KEY='ADAPTER_KEY', GLOBEE_API_URL='http://fake-globee/payment-api/v1'):
+            globee_payment = GlobeePayment(payment_data={'total': 13.37, 'customer': {'email': 'foobar@example.com'}})
+            globee_payment.session.mount('http://fake-globee/', FakeGlobeeAdapter(api))
+            self.assertTrue(globee_payment.ping())
+            globee_payment.create_request()
+            api.set_status(globee_payment.payment_id, 'paid')
+            self.assertEqual(globee_payment.get_payment_by_id()['status'], 'paid')
+        close_sessions()
+
+    @override_settings(GLOBEE_AUTO_VERIFY=True, ROOT_URLCONF='globee.urls')
+    def test_ipn_view_auto_verify(self):
+        globee_payment = GlobeePayment(payment_data={'total': 13.37, 'customer': {'email': 'foobar@example.com'}})
+        globee_payment.create_request()
+        if fake_server is not None:
+            fake_server.api.set_status(globee_payment.payment_id, 'paid')
+        payment_data = dict(IPN_PAYMENT_DATA, id=globee_payment.payment_id, status='confirmed')
+        response = Client().generic('POST', reverse('globee-ipn'), bytes(json.dumps(payment_data), 'utf-8'))
+        self.assertEqual(response.status_code, 200)
+        payment = GlobeeIPN.objects.get(payment_id=globee_payment.payment_id)
+        self.assertNotEqual(payment.payment_status, 'confirmed')
+        self.assertEqual(payment.verification_status, VERIFICATION_STATUS_VERIFIED)
+
+    def test_fake_api_error_injection(self):
+        api = FakeGlobeeAPI(auth_key='KEY', error_rate=1, error_status=503)
+        status, response = api.handle('GET', '/payment-api/v1/ping', {'X-AUTH-KEY': 'KEY'})
+        self.assertEqual(status, 503)
+        self.assertEqual(api.request_count, 1)
+
+    @skipIf(httpx is None, 'httpx is not installed')
+    async def test_fake_api_httpx_transport(self):
+        api = FakeGlobeeAPI(auth_key=settings.GLOBEE_AUTH_KEY)
+
+        def client(auth_key, api_url):
+            return httpx.AsyncClient(transport=api.httpx_transport())
+
+        with mock.patch('globee.core.get_async_client', client):
+            globee_payment = AsyncGlobeePayment()
+            self.assertIsInstance(await globee_payment.get_payment_methods(), list)
+
+
 class GlobeePingTestCase(TestCase):
 
     def test_ping_valid(self):
@@ -290,6 +861,1023 @@ class GlobeePaymentIPNTestCase(TestCase):
         self.assertEqual(count_before, GlobeeIPN.objects.all().count())
 
 
+class GlobeeIPNUpsertTestCase(TestCase):
+
+    def test_upsert(self):
+        defaults = get_ipn_defaults(IPN_PAYMENT_DATA)
+        with CaptureQueriesContext(connection) as queries:
+            payment, created, changed = GlobeeIPN.objects.upsert(IPN_PAYMENT_DATA['id'], defaults)
+        self.assertTrue(created)
+        self.assertTrue(changed)
+        self.assertIsNotNone(payment.pk)
+        if connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert:
+            self.assertEqual(1, len(queries))
+            self.assertIn('ON CONFLICT', queries[0]['sql'])
+
+        payment, created, changed = GlobeeIPN.objects.upsert(IPN_PAYMENT_DATA['id'], dict(defaults))
+        self.assertFalse(created)
+        self.assertFalse(changed)
+
+        with CaptureQueriesContext(connection) as queries:
+            payment, created, changed = GlobeeIPN.objects.upsert(IPN_PAYMENT_DATA['id'], dict(defaults, payment_status='confirmed'))
+        self.assertFalse(created)
+        self.assertTrue(changed)
+        self.assertEqual('confirmed', payment.payment_status)
+        self.assertEqual(1, GlobeeIPN.objects.count())
+        self.assertEqual('confirmed', GlobeeIPN.objects.get().payment_status)
+        if connection.vendor == 'sqlite' and connection.features.can_return_columns_from_insert:
+            self.assertEqual(2, len(queries))
+
+    def test_bulk_save_pending(self):
+        defaults = get_ipn_defaults(IPN_PAYMENT_DATA)
+        GlobeeIPN.objects.upsert(IPN_PAYMENT_DATA['id'], dict(defaults, verification_status=VERIFICATION_STATUS_VERIFIED))
+        results = GlobeeIPN.objects.bulk_save_pending({
+            IPN_PAYMENT_DATA['id']: dict(defaults, payment_status='confirmed'),
+            'OTHER_ID': dict(defaults, custom_payment_id='743'),
+        })
+        self.assertEqual([(False, True), (True, True)], [(created, changed) for payment, created, changed in results])
+        payment = GlobeeIPN.objects.get(payment_id=IPN_PAYMENT_DATA['id'])
+        self.assertEqual((VERIFICATION_STATUS_PENDING, 'paid'), (payment.verification_status, payment.payment_status))
+        self.assertEqual(VERIFICATION_STATUS_PENDING, GlobeeIPN.objects.get(payment_id='OTHER_ID').verification_status)
+
+        # unchanged payments keep their verification status
+        GlobeeIPN.objects.update(verification_status=VERIFICATION_STATUS_VERIFIED)
+        results = GlobeeIPN.objects.bulk_save_pending({IPN_PAYMENT_DATA['id']: defaults})
+        self.assertEqual([(False, False)], [(created, changed) for payment, created, changed in results])
+        self.assertEqual(VERIFICATION_STATUS_VERIFIED, GlobeeIPN.objects.get(payment_id=IPN_PAYMENT_DATA['id']).verification_status)
+
+    def test_upsert_sql(self):
+        sql, params = GlobeeIPN.objects._get_upsert_sql(IPN_PAYMENT_DATA['id'], get_ipn_defaults(IPN_PAYMENT_DATA))
+        self.assertIn('ON CONFLICT ("payment_id") DO UPDATE SET "payment_status" = EXCLUDED."payment_status"', sql)
+        self.assertIn('IS DISTINCT FROM', sql)
+        self.assertEqual(sql.count('%s'), len(params))
+        self.assertIn(IPN_PAYMENT_DATA['id'], params)
+
+    def test_sqlite_upsert_sql(self):
+        insert_sql, insert_params, update_sql, update_params = GlobeeIPN.objects._get_sqlite_upsert_sql(
+            IPN_PAYMENT_DATA['id'], get_ipn_defaults(IPN_PAYMENT_DATA)
+        )
+        self.assertIn('ON CONFLICT ("payment_id") DO NOTHING RETURNING *', insert_sql)
+        self.assertIn('WHERE "payment_id" = %s AND ("payment_status"', update_sql)
+        self.assertEqual(insert_sql.count('%s'), len(insert_params))
+        self.assertEqual(update_sql.count('%s'), len(update_params))
+
+
+class GlobeeMetricsTestCase(TestCase):
+
+    def test_percentile(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertIsNone(percentile([], 50))
+
+    def test_render_prometheus(self):
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Requests').inc(3)
+        histogram = registry.histogram('latency_seconds', 'Latency', ('stage',), buckets=(0.1, 1))
+        histogram.observe(0.05, stage='json')
+        histogram.observe(0.5, stage='json')
+        histogram.observe(5, stage='json')
+        self.assertEqual((3, 5.55), histogram.get(stage='json'))
+        self.assertEqual(registry.render_prometheus(), '\n'.join([
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{stage="json",le="0.1"} 1',
+            'latency_seconds_bucket{stage="json",le="1.0"} 2',
+            'latency_seconds_bucket{stage="json",le="+Inf"} 3',
+            'latency_seconds_sum{stage="json"} 5.55',
+            'latency_seconds_count{stage="json"} 3',
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total 3',
+        ]) + '\n')
+
+
+TIMINGS = []
+
+
+def timing_hook(timings, payment_id):
+    TIMINGS.append((payment_id, [stage for stage, seconds in timings]))
+
+
+@override_settings(GLOBEE_PARANOID_MODE=False)
+@override_settings(GLOBEE_AUTO_VERIFY=False)
+@override_settings(ROOT_URLCONF='globee.urls')
+class GlobeeIPNTimingTestCase(TestCase):
+
+    def setUp(self):
+        ipn_seconds.reset()
+        ipn_stage_seconds.reset()
+        del TIMINGS[:]
+
+    def post(self, payment_data):
+        return Client().generic('POST', reverse('globee-ipn'), bytes(json.dumps(payment_data), 'utf-8'))
+
+    def test_timing_disabled(self):
+        self.post(IPN_PAYMENT_DATA)
+        self.assertEqual(0, ipn_seconds.value)
+
+    @override_settings(GLOBEE_IPN_TIMING=True)
+    def test_timing_registry(self):
+        self.post(IPN_PAYMENT_DATA)
+        self.assertEqual(1, ipn_seconds.value)
+        for stage in ('decode', 'json', 'upsert', 'signals'):
+            self.assertEqual(1, ipn_stage_seconds.get(stage=stage)[0])
+        self.assertEqual(0, ipn_stage_seconds.get(stage='verify')[0])
+
+    @override_settings(GLOBEE_IPN_TIMING='globee.tests.timing_hook')
+    def test_timing_hook(self):
+        self.post(IPN_PAYMENT_DATA)
+        self.assertEqual(400, self.post({'id': 'INVALID'}).status_code)
+        self.assertEqual(TIMINGS, [
+            (IPN_PAYMENT_DATA['id'], ['decode', 'json', 'upsert', 'cache', 'signals']),
+            ('INVALID', ['decode', 'json']),
+        ])
+        self.assertEqual(0, ipn_seconds.value)
+
+    @override_settings(GLOBEE_IPN_TIMING='globee.tests.missing_hook')
+    def test_timing_hook_import_error(self):
+        with self.assertLogs('globee.ipn', 'ERROR') as logs:
+            self.assertEqual(200, self.post(IPN_PAYMENT_DATA).status_code)
+        self.assertIn('IPN timing hook', logs.output[0])
+        self.assertTrue(GlobeeIPN.objects.filter(payment_id=IPN_PAYMENT_DATA['id']).exists())
+
+    @override_settings(GLOBEE_IPN_SLOW_THRESHOLD=0)
+    def test_slow_ipn_log(self):
+        with self.assertLogs('globee.ipn', 'WARNING') as logs:
+            self.post(IPN_PAYMENT_DATA)
+        self.assertIn('Slow IPN %s' % IPN_PAYMENT_DATA['id'], logs.output[0])
+        self.assertIn('upsert', logs.output[0])
+
+
+@override_settings(GLOBEE_PARANOID_MODE=False)
+@override_settings(GLOBEE_AUTO_VERIFY=False)
+@override_settings(ROOT_URLCONF='globee.urls')
+class GlobeeDuplicateIPNTestCase(TestCase):
+
+    def setUp(self):
+        self.valid = []
+        self.duplicates = []
+        globee_valid_ipn.connect(self.on_valid)
+        globee_duplicate_ipn.connect(self.on_duplicate)
+        ipn_duplicates.reset()
+
+    def tearDown(self):
+        globee_valid_ipn.disconnect(self.on_valid)
+        globee_duplicate_ipn.disconnect(self.on_duplicate)
+
+    def on_valid(self, sender, **kwargs):
+        self.valid.append(sender)
+
+    def on_duplicate(self, sender, **kwargs):
+        self.duplicates.append(sender)
+
+    def post(self, payment_data):
+        response = Client().generic('POST', reverse('globee-ipn'), bytes(json.dumps(payment_data), 'utf-8'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_duplicate_ipn_is_skipped(self):
+        self.post(IPN_PAYMENT_DATA)
+        self.post(IPN_PAYMENT_DATA)
+        self.assertEqual(len(self.valid), 1)
+        self.assertEqual(len(self.duplicates), 0)
+        self.assertEqual(ipn_duplicates.value, 1)
+
+        self.post(dict(IPN_PAYMENT_DATA, status='confirmed'))
+        self.assertEqual(len(self.valid), 2)
+        self.assertEqual(ipn_duplicates.value, 1)
+
+    @override_settings(GLOBEE_DUPLICATE_SIGNAL=True)
+    def test_duplicate_ipn_signal(self):
+        self.post(IPN_PAYMENT_DATA)
+        self.post(IPN_PAYMENT_DATA)
+        self.assertEqual(len(self.valid), 1)
+        self.assertEqual(len(self.duplicates), 1)
+
+    @override_settings(GLOBEE_SKIP_DUPLICATE_IPN=False)
+    def test_duplicate_ipn_not_skipped(self):
+        self.post(IPN_PAYMENT_DATA)
+        self.post(IPN_PAYMENT_DATA)
+        self.assertEqual(len(self.valid), 2)
+        self.assertEqual(ipn_duplicates.value, 0)
+
+
+@override_settings(GLOBEE_AUTH_KEY='VERIFY_KEY')
+@override_settings(GLOBEE_AUTO_VERIFY='deferred')
+@override_settings(GLOBEE_PARANOID_MODE=False)
+@override_settings(ROOT_URLCONF='globee.urls')
+class GlobeeDeferredVerificationTestCase(TestCase):
+
+    @staticmethod
+    def get_payment_by_id(payment_id=None, cached=True):
+        if payment_id == 'INVALID':
+            raise ValidationError('status code: 404', code=404)
+        return dict(IPN_PAYMENT_DATA, id=payment_id, custom_payment_id=payment_id, status='confirmed')
+
+    def test_deferred_verification(self):
+        valid = []
+        receiver = lambda sender, **kwargs: valid.append(sender)
+        globee_valid_ipn.connect(receiver)
+        client = Client()
+        for payment_id in ('ID_1', 'ID_2', 'INVALID'):
+            payment_data = dict(IPN_PAYMENT_DATA, id=payment_id, custom_payment_id=payment_id)
+            response = client.generic('POST', reverse('globee-ipn'), bytes(json.dumps(payment_data), 'utf-8'))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(3, GlobeeIPN.objects.filter(verification_status=VERIFICATION_STATUS_PENDING).count())
+        self.assertEqual(valid, [])
+
+        with mock.patch.object(GlobeePayment, 'get_payment_by_id', side_effect=self.get_payment_by_id):
+            call_command('globee_verify_ipns', once=True, stdout=open(os.devnull, 'w'))
+        globee_valid_ipn.disconnect(receiver)
+
+        self.assertEqual(sorted(payment.payment_id for payment in valid), ['ID_1', 'ID_2'])
+        self.assertEqual(2, GlobeeIPN.objects.filter(verification_status=VERIFICATION_STATUS_VERIFIED, payment_status='confirmed').count())
+        self.assertEqual(VERIFICATION_STATUS_FAILED, GlobeeIPN.objects.get(payment_id='INVALID').verification_status)
+
+        # an unchanged re-delivery is not verified again
+        payment_data = dict(IPN_PAYMENT_DATA, id='ID_1', custom_payment_id='ID_1', status='confirmed')
+        client.generic('POST', reverse('globee-ipn'), bytes(json.dumps(payment_data), 'utf-8'))
+        self.assertEqual(VERIFICATION_STATUS_VERIFIED, GlobeeIPN.objects.get(payment_id='ID_1').verification_status)
+
+        # a changed IPN marks the payment as pending without overwriting the verified data
+        payment_data = dict(IPN_PAYMENT_DATA, id='ID_1', custom_payment_id='ID_1', status='paid', total='1.00')
+        client.generic('POST', reverse('globee-ipn'), bytes(json.dumps(payment_data), 'utf-8'))
+        payment = GlobeeIPN.objects.get(payment_id='ID_1')
+        self.assertEqual(VERIFICATION_STATUS_PENDING, payment.verification_status)
+        self.assertEqual(('confirmed', 123.45), (payment.payment_status, payment.total))
+
+    def test_deferred_verification_retry(self):
+        for payment_id in ('ID_1', 'ID_2'):
+            save_ipn(dict(IPN_PAYMENT_DATA, id=payment_id, custom_payment_id=payment_id), VERIFY_DEFERRED)
+
+        def get_payment_by_id(payment_id=None, cached=True):
+            if payment_id == 'ID_1':
+                raise requests.ConnectionError('connection refused')
+            return self.get_payment_by_id(payment_id)
+
+        with mock.patch.object(GlobeePayment, 'get_payment_by_id', side_effect=get_payment_by_id), \
+                self.settings(GLOBEE_VERIFY_RETRY_DELAY=60):
+            self.assertEqual((0, 0), verify_pending_ipns(batch_size=1))
+            payment = GlobeeIPN.objects.get(payment_id='ID_1')
+            self.assertEqual(VERIFICATION_STATUS_PENDING, payment.verification_status)
+            self.assertEqual(1, payment.verification_attempts)
+            self.assertGreater(payment.next_verification_at, timezone.now() + timedelta(seconds=50))
+            # the payment that could not be fetched doesn't block the next batch
+            self.assertEqual((1, 0), verify_pending_ipns(batch_size=1))
+            self.assertEqual((0, 0), verify_pending_ipns(batch_size=1))
+
+            GlobeeIPN.objects.filter(payment_id='ID_1').update(next_verification_at=timezone.now())
+            verify_pending_ipns()
+            payment = GlobeeIPN.objects.get(payment_id='ID_1')
+            self.assertEqual(2, payment.verification_attempts)
+            self.assertGreater(payment.next_verification_at, timezone.now() + timedelta(seconds=110))
+        self.assertEqual(get_verification_retry_delay(10), 3600)
+
+    def test_deferred_verification_unchanged(self):
+        valid = []
+        receiver = lambda sender, **kwargs: valid.append(sender.payment_id)
+        globee_valid_ipn.connect(receiver)
+        payment_data = dict(IPN_PAYMENT_DATA, id='ID_1', custom_payment_id='ID_1', status='confirmed')
+        save_ipn(payment_data, VERIFY_DEFERRED)
+        self.assertTrue(GlobeeIPN.objects.get(payment_id='ID_1').signal_pending)
+        with mock.patch.object(GlobeePayment, 'get_payment_by_id', side_effect=self.get_payment_by_id):
+            # the IPN data equals the GloBee data, but the new payment wasn't announced yet
+            self.assertEqual((1, 0), verify_pending_ipns())
+            self.assertEqual(['ID_1'], valid)
+            self.assertFalse(GlobeeIPN.objects.get(payment_id='ID_1').signal_pending)
+
+            # a spurious IPN marks the payment as pending, GloBee's data didn't change
+            save_ipn(dict(payment_data, status='paid'), VERIFY_DEFERRED)
+            self.assertEqual(VERIFICATION_STATUS_PENDING, GlobeeIPN.objects.get(payment_id='ID_1').verification_status)
+            self.assertEqual((1, 0), verify_pending_ipns())
+        globee_valid_ipn.disconnect(receiver)
+        self.assertEqual(VERIFICATION_STATUS_VERIFIED, GlobeeIPN.objects.get(payment_id='ID_1').verification_status)
+        self.assertEqual(['ID_1'], valid)
+
+    def test_deferred_verification_server_error(self):
+        api = FakeGlobeeAPI(auth_key='VERIFY_KEY')
+        payment_data = api.create_payment({'total': 10, 'customer': {'email': 'foobar@example.com'}})[1]['data']
+        save_ipn(payment_data, VERIFY_DEFERRED)
+        with FakeGlobeeServer(api) as server, self.settings(GLOBEE_API_URL=server.api_url):
+            api.error_rate = 1
+            self.assertEqual((0, 0), verify_pending_ipns())
+            payment = GlobeeIPN.objects.get(payment_id=payment_data['id'])
+            self.assertEqual((VERIFICATION_STATUS_PENDING, 1), (payment.verification_status, payment.verification_attempts))
+
+            # the payment is verified once GloBee recovered
+            api.error_rate = 0
+            GlobeeIPN.objects.update(next_verification_at=timezone.now())
+            self.assertEqual((1, 0), verify_pending_ipns())
+            self.assertEqual(VERIFICATION_STATUS_VERIFIED, GlobeeIPN.objects.get(payment_id=payment_data['id']).verification_status)
+        close_sessions()
+
+
+@override_settings(GLOBEE_AUTH_KEY='CACHE_KEY', GLOBEE_CACHE='default')
+class GlobeeCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(url)
+        return mock.Mock(status_code=200, json=lambda: {'success': True, 'data': [url]})
+
+    def test_payment_methods_cache(self):
+        globee_payment = GlobeePayment()
+        with mock.patch.object(globee_payment, '_request', side_effect=self.request):
+            self.assertEqual(globee_payment.get_payment_methods(), globee_payment.get_payment_methods())
+            self.assertEqual(len(self.calls), 1)
+            globee_payment.invalidate_payment_methods_cache()
+            globee_payment.get_payment_methods()
+            self.assertEqual(len(self.calls), 2)
+
+    def test_payment_details_cache(self):
+        globee_payment = GlobeePayment(payment_id='PAYMENT_ID')
+        with mock.patch.object(globee_payment, '_request', side_effect=self.request):
+            globee_payment.get_payment_details()
+            # a hit needs no database query and one cache lookup
+            with self.assertNumQueries(0), mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+                globee_payment.get_payment_details()
+            self.assertEqual(1, get_many.call_count)
+            self.assertEqual(globee_payment.get_payment_currency_details('BTC'), globee_payment.get_payment_currency_details('BTC'))
+            self.assertNotEqual(globee_payment.get_payment_currency_details('BTC'), globee_payment.get_payment_currency_details('LTC'))
+            self.assertEqual(len(self.calls), 3)
+            globee_payment.invalidate_payment_cache()
+            globee_payment.get_payment_details()
+            globee_payment.get_payment_currency_details('BTC')
+            self.assertEqual(len(self.calls), 5)
+
+    def test_payment_details_cache_expired_payment(self):
+        GlobeeIPN.objects.upsert('PAYMENT_ID', get_ipn_defaults(IPN_PAYMENT_DATA))
+        globee_payment = GlobeePayment(payment_id='PAYMENT_ID')
+        with mock.patch.object(globee_payment, '_request', side_effect=self.request):
+            globee_payment.get_payment_details()
+            globee_payment.get_payment_details()
+            self.assertEqual(len(self.calls), 2)
+
+    @override_settings(GLOBEE_CACHE_PAYMENTS=True, GLOBEE_CACHE_STATUS_TTLS={'paid': 60, 'completed': 0})
+    def test_payment_cache(self):
+        globee_payment = GlobeePayment()
+
+        def request(method, url, **kwargs):
+            self.calls.append(url)
+            return mock.Mock(status_code=200, json=lambda: {'success': True, 'data': dict(IPN_PAYMENT_DATA, status=self.status)})
+
+        # partial settings are merged with the defaults
+        self.assertEqual(0, get_status_ttl({'status': 'completed'}))
+        self.assertEqual(60, get_status_ttl({'status': 'underpaid'}))
+
+        self.status = 'paid'
+        with mock.patch.object(GlobeePayment, '_request', side_effect=request):
+            payment_id = IPN_PAYMENT_DATA['id']
+            globee_payment.get_payment_by_id(payment_id)
+            globee_payment.get_payment_by_id(payment_id)
+            self.assertEqual(len(self.calls), 1)
+            globee_payment.get_payment_by_id(payment_id, cached=False)
+            self.assertEqual(len(self.calls), 2)
+
+            # an unverified IPN invalidates the cached payment
+            save_ipn(IPN_PAYMENT_DATA)
+            globee_payment.get_payment_by_id(payment_id)
+            self.assertEqual(len(self.calls), 3)
+
+            # a verified IPN updates the cached payment
+            save_ipn(dict(IPN_PAYMENT_DATA, status='confirmed'), VERIFY_SYNC)
+            self.assertEqual(globee_payment.get_payment_by_id(payment_id)['status'], 'confirmed')
+            self.assertEqual(len(self.calls), 3)
+
+            # status-aware timeouts
+            globee_payment.invalidate_payment_cache(payment_id)
+            self.status = 'completed'
+            globee_payment.get_payment_by_id(payment_id)
+            globee_payment.get_payment_by_id(payment_id)
+            self.assertEqual(len(self.calls), 5)
+
+    @override_settings(GLOBEE_CACHE=None)
+    def test_cache_disabled(self):
+        globee_payment = GlobeePayment()
+        with mock.patch.object(globee_payment, '_request', side_effect=self.request):
+            globee_payment.get_payment_methods()
+            globee_payment.get_payment_methods()
+            self.assertEqual(len(self.calls), 2)
+
+
+class GlobeeSingleFlightTestCase(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def fetch(self, payment_id):
+        self.calls.append(payment_id)
+        self.started.set()
+        self.release.wait(5)
+        return {'id': payment_id}
+
+    def run_concurrently(self, flights, **kwargs):
+        results = []
+        threads = [threading.Thread(target=lambda flight=flight: results.append(flight.do('ID', self.fetch, 'ID', **kwargs))) for flight in flights]
+        threads[0].start()
+        self.assertTrue(self.started.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+        threading.Timer(0.2, self.release.set).start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_single_flight(self):
+        flight = SingleFlight('test_local')
+        results = self.run_concurrently([flight] * 5)
+        self.assertEqual(results, [{'id': 'ID'}] * 5)
+        # the callers that arrived after the first call started share the next call
+        self.assertEqual(self.calls, ['ID', 'ID'])
+        self.assertEqual(flight.misses.value, 2)
+        self.assertEqual(flight.hits.value, 3)
+        self.assertEqual(flight._calls, {})
+
+    def test_single_flight_shared_cache(self):
+        # separate instances act like separate processes
+        flights = [SingleFlight('test_shared') for i in range(3)]
+        results = self.run_concurrently(flights, cache_alias='default')
+        self.assertEqual(results, [{'id': 'ID'}] * 3)
+        self.assertEqual(self.calls, ['ID', 'ID'])
+        # a result of a call that finished before the request is not shared
+        self.release.set()
+        self.assertEqual(flights[0].do('ID', self.fetch, 'ID', cache_alias='default'), {'id': 'ID'})
+        self.assertEqual(self.calls, ['ID', 'ID', 'ID'])
+
+    def test_single_flight_error(self):
+        flight = SingleFlight('test_error')
+        with self.assertRaises(ValidationError):
+            flight.do('ID', mock.Mock(side_effect=ValidationError('error')))
+        self.assertEqual(flight.do('ID', lambda: 1), 1)
+
+    async def test_async_single_flight(self):
+        flight = SingleFlight('test_async')
+        calls = []
+
+        async def fetch(payment_id):
+            calls.append(payment_id)
+            await asyncio.sleep(0.05)
+            return {'id': payment_id}
+
+        results = await asyncio.gather(*[flight.ado('ID', fetch, 'ID') for i in range(5)])
+        self.assertEqual(results, [{'id': 'ID'}] * 5)
+        self.assertEqual(calls, ['ID'])
+
+        async def call_later():
+            await asyncio.sleep(0.01)
+            return await flight.ado('ID', fetch, 'ID')
+
+        # the late callers don't share the running call but the next one
+        results = await asyncio.gather(flight.ado('ID', fetch, 'ID'), call_later(), call_later())
+        self.assertEqual(results, [{'id': 'ID'}] * 3)
+        self.assertEqual(calls, ['ID'] * 3)
+        self.assertEqual(flight._async_calls, {})
+
+
+@override_settings(GLOBEE_SIGNAL_DISPATCH='deferred', GLOBEE_SIGNAL_TIMEOUT=0.5)
+class GlobeeSignalDispatchTestCase(TestCase):
+
+    def tearDown(self):
+        dispatch.shutdown()
+
+    def test_deferred_dispatch(self):
+        called = threading.Event()
+        release = threading.Event()
+
+        def slow_receiver(sender, **kwargs):
+            release.wait(5)
+
+        def failing_receiver(sender, **kwargs):
+            raise ValueError('receiver failed')
+
+        def receiver(sender, **kwargs):
+            called.set()
+
+        # every receiver runs as its own task, the slow one doesn't delay the others
+        for r in (slow_receiver, failing_receiver, receiver):
+            globee_valid_ipn.connect(r)
+        try:
+            payment, created, changed = GlobeeIPN.objects.upsert(IPN_PAYMENT_DATA['id'], get_ipn_defaults(IPN_PAYMENT_DATA))
+            with self.assertLogs('globee.dispatch') as logs:
+                with self.captureOnCommitCallbacks() as callbacks:
+                    payment.send_valid_signal()
+                    self.assertFalse(called.is_set())
+                self.assertEqual(len(callbacks), 1)
+                callbacks[0]()
+                self.assertTrue(called.wait(0.4))
+                dispatch._executors.pop('dispatch').shutdown()
+                release.set()
+                dispatch.shutdown()
+        finally:
+            release.set()
+            for r in (slow_receiver, failing_receiver, receiver):
+                globee_valid_ipn.disconnect(r)
+        output = '\n'.join(logs.output)
+        self.assertIn('receiver failed', output)
+        # only the slow receiver exceeded the timeout
+        self.assertEqual(1, output.count('did not finish within 0.5s'))
+        self.assertIn('slow_receiver', output)
+
+    @override_settings(GLOBEE_SIGNAL_QUEUE_SIZE=1)
+    def test_deferred_dispatch_queue_full(self):
+        release = threading.Event()
+        threads = []
+
+        def receiver(sender, **kwargs):
+            threads.append(threading.current_thread())
+            release.wait(5)
+
+        dispatch.signals_dropped.reset()
+        globee_valid_ipn.connect(receiver)
+        try:
+            payment, created, changed = GlobeeIPN.objects.upsert(IPN_PAYMENT_DATA['id'], get_ipn_defaults(IPN_PAYMENT_DATA))
+            with self.assertLogs('globee.dispatch', 'ERROR') as logs:
+                with self.captureOnCommitCallbacks(execute=True):
+                    payment.send_valid_signal()
+                    payment.send_valid_signal()
+            # the committing thread doesn't run the receivers of the dropped signal
+            self.assertIn('Signal queue is full', logs.output[0])
+            self.assertEqual(1, dispatch.signals_dropped.value)
+            release.set()
+            dispatch.shutdown()
+            self.assertEqual(1, len(threads))
+            self.assertIsNot(threading.main_thread(), threads[0])
+        finally:
+            release.set()
+            globee_valid_ipn.disconnect(receiver)
+
+    @override_settings(GLOBEE_SIGNAL_DISPATCH='globee.tests.record_signal')
+    def test_custom_dispatch(self):
+        dispatched.clear()
+        payment = GlobeeIPN(payment_id='PAYMENT_ID')
+        with self.captureOnCommitCallbacks(execute=True):
+            payment.send_valid_signal()
+        self.assertEqual(dispatched, [(globee_valid_ipn, payment)])
+
+
+dispatched = []
+
+
+def record_signal(signal, sender):
+    dispatched.append((signal, sender))
+
+
+@override_settings(GLOBEE_IPN_DEFERRED=True)
+@override_settings(GLOBEE_AUTO_VERIFY=False)
+@override_settings(ROOT_URLCONF='globee.urls')
+class GlobeeDeferredIPNTestCase(TestCase):
+
+    def post(self, payment_data):
+        response = Client().generic('POST', reverse('globee-ipn'), bytes(json.dumps(payment_data), 'utf-8'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_deferred_ipn(self):
+        valid = []
+        receiver = lambda sender, **kwargs: valid.append(sender)
+        globee_valid_ipn.connect(receiver)
+        self.post(IPN_PAYMENT_DATA)
+        self.post(dict(IPN_PAYMENT_DATA, status='confirmed'))
+        self.post(dict(IPN_PAYMENT_DATA, id='OTHER_ID', custom_payment_id='743'))
+        self.post({'id': 'INVALID'})
+        self.assertEqual(0, GlobeeIPN.objects.count())
+        self.assertEqual(4, GlobeeIPNInbox.objects.count())
+
+        call_command('globee_ipn_worker', once=True, batch_size=2, stdout=open(os.devnull, 'w'))
+        globee_valid_ipn.disconnect(receiver)
+        self.assertEqual('confirmed', GlobeeIPN.objects.get(payment_id=IPN_PAYMENT_DATA['id']).payment_status)
+        self.assertTrue(GlobeeIPN.objects.filter(payment_id='OTHER_ID').exists())
+        # both IPNs of the first payment are in the same batch, only the latest one is saved
+        self.assertEqual(len(valid), 2)
+        inbox = GlobeeIPNInbox.objects.get()
+        self.assertIn('KeyError', inbox.last_error)
+        self.assertEqual(inbox.attempts, DatabaseQueue().max_attempts)
+
+    def test_deferred_ipn_crash_before_ack(self):
+        valid = []
+        receiver = lambda sender, **kwargs: valid.append(sender.payment_id)
+        globee_valid_ipn.connect(receiver)
+        self.post(IPN_PAYMENT_DATA)
+        queue = DatabaseQueue()
+        # the worker dies after saving the payment, before the signal was sent
+        with mock.patch('globee.ipn.send_ipn_signal', side_effect=KeyboardInterrupt), self.assertRaises(KeyboardInterrupt):
+            process_ipn_queue(queue, lease=-1)
+        self.assertTrue(GlobeeIPN.objects.filter(payment_id=IPN_PAYMENT_DATA['id']).exists())
+        self.assertTrue(GlobeeIPNInbox.objects.get().signal_pending)
+
+        # the unchanged payment still gets its signal when the IPN is claimed again
+        self.assertEqual(1, process_ipn_queue(queue))
+        globee_valid_ipn.disconnect(receiver)
+        self.assertEqual(valid, [IPN_PAYMENT_DATA['id']])
+        self.assertEqual(0, GlobeeIPNInbox.objects.count())
+
+    def test_deferred_ipn_conflict(self):
+        valid = []
+        receiver = lambda sender, **kwargs: valid.append(sender.payment_id)
+        globee_valid_ipn.connect(receiver)
+        GlobeeIPN.objects.upsert('EXISTING_ID', dict(get_ipn_defaults(IPN_PAYMENT_DATA), custom_payment_id='743'))
+        # the custom payment id of the first payment is taken, the batch is saved per payment
+        self.post(dict(IPN_PAYMENT_DATA, custom_payment_id='743'))
+        self.post(dict(IPN_PAYMENT_DATA, id='OTHER_ID', custom_payment_id='744'))
+        self.assertEqual(2, process_ipn_queue(DatabaseQueue()))
+        globee_valid_ipn.disconnect(receiver)
+        self.assertEqual(valid, ['OTHER_ID'])
+        self.assertFalse(GlobeeIPN.objects.filter(payment_id=IPN_PAYMENT_DATA['id']).exists())
+        self.assertIn('IntegrityError', GlobeeIPNInbox.objects.get().last_error)
+
+    @override_settings(GLOBEE_IPN_RETRY_DELAY=10, GLOBEE_IPN_RETRY_MAX_DELAY=30)
+    def test_queue_lease(self):
+        queue = DatabaseQueue()
+        queue.enqueue('{}')
+        message_id, body = queue.claim(10)[0]
+        self.assertEqual(queue.claim(10), [])
+        queue.fail(message_id, 'error')
+        # failed IPNs are retried after a backoff
+        self.assertEqual(queue.claim(10), [])
+        locked_until = GlobeeIPNInbox.objects.get().locked_until
+        self.assertGreater(locked_until, timezone.now() + timedelta(seconds=5))
+        GlobeeIPNInbox.objects.update(locked_until=None)
+        self.assertEqual(queue.claim(10, lease=-1), [(message_id, '{}')])
+        self.assertEqual(queue.claim(10), [(message_id, '{}')])
+        queue.ack([message_id])
+        self.assertEqual(0, GlobeeIPNInbox.objects.count())
+        self.assertEqual([10, 20, 30], [queue.get_retry_delay(attempts) for attempts in (1, 2, 3)])
+
+
+@override_settings(GLOBEE_AUTH_KEY='RECONCILE_KEY')
+class GlobeeReconcileTestCase(TestCase):
+
+    def setUp(self):
+        self.valid = []
+        globee_valid_ipn.connect(self.on_valid)
+        self.api = FakeGlobeeAPI(auth_key='RECONCILE_KEY')
+        self.server = FakeGlobeeServer(self.api).start()
+        self.settings_override = override_settings(GLOBEE_API_URL=self.server.api_url)
+        self.settings_override.enable()
+        payments_data = [{'total': 10 + i, 'customer': {'name': 'foobar', 'email': 'foobar@example.com'}} for i in range(6)]
+        self.payment_ids = [result.payment_id for result in GlobeePayment().create_requests(payments_data, create_ipns=True)]
+
+    def tearDown(self):
+        globee_valid_ipn.disconnect(self.on_valid)
+        self.settings_override.disable()
+        self.server.stop()
+        close_sessions()
+
+    def on_valid(self, sender, **kwargs):
+        self.valid.append(sender.payment_id)
+
+    def test_reconcile_ipns(self):
+        GlobeeIPN.objects.filter(payment_id=self.payment_ids[0]).update(payment_status='confirmed')
+        GlobeeIPN.objects.filter(payment_id=self.payment_ids[1]).update(total=1)
+        self.api.set_status(self.payment_ids[2], 'paid')
+        self.api.set_status(self.payment_ids[3], 'confirmed')
+        del self.api.payments[self.payment_ids[4]]
+
+        checkpoints = []
+        self.assertEqual((5, 3, 1), reconcile_ipns(chunk_size=2, on_chunk=checkpoints.append))
+        self.assertEqual(3, len(checkpoints))
+        self.assertEqual(sorted(self.valid), sorted(self.payment_ids[2:4]))
+        payments = {payment.payment_id: payment for payment in GlobeeIPN.objects.all()}
+        self.assertEqual('confirmed', payments[self.payment_ids[0]].payment_status)
+        self.assertEqual(11, payments[self.payment_ids[1]].total)
+        self.assertEqual('paid', payments[self.payment_ids[2]].payment_status)
+        self.assertEqual('confirmed', payments[self.payment_ids[3]].payment_status)
+        self.assertEqual('verified', payments[self.payment_ids[3]].verification_status)
+        self.assertEqual('unpaid', payments[self.payment_ids[4]].payment_status)
+
+    def test_reconcile_concurrent_ipn(self):
+        self.api.set_status(self.payment_ids[0], 'paid')
+        self.api.set_status(self.payment_ids[1], 'paid')
+        get_payments_by_ids = GlobeePayment.get_payments_by_ids
+
+        def fetch_during_ipn(globee_payment, payment_ids, max_workers=None):
+            # an IPN confirms the first payment while it is fetched from GloBee
+            GlobeeIPN.objects.filter(payment_id=self.payment_ids[0]).update(payment_status='confirmed')
+            return get_payments_by_ids(globee_payment, payment_ids, max_workers)
+
+        with mock.patch.object(GlobeePayment, 'get_payments_by_ids', fetch_during_ipn):
+            self.assertEqual((6, 1, 0), reconcile_ipns())
+        self.assertEqual(self.valid, [self.payment_ids[1]])
+        self.assertEqual('confirmed', GlobeeIPN.objects.get(payment_id=self.payment_ids[0]).payment_status)
+        self.assertEqual('paid', GlobeeIPN.objects.get(payment_id=self.payment_ids[1]).payment_status)
+
+    def test_reconcile_command_checkpoint(self):
+        from globee.management.commands.globee_reconcile_ipns import Command
+
+        payments = list(GlobeeIPN.objects.order_by('expires_at', 'id'))
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        Command.write_checkpoint(checkpoint, (payments[3].expires_at, payments[3].id))
+        for payment in payments:
+            self.api.set_status(payment.payment_id, 'paid')
+        stdout = StringIO()
+        call_command('globee_reconcile_ipns', checkpoint=checkpoint, chunk_size=1, stdout=stdout)
+        self.assertIn('checked 2 payments, 2 updated, 0 failed', stdout.getvalue())
+        self.assertEqual(sorted(self.valid), sorted(payment.payment_id for payment in payments[4:]))
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+class GlobeeIPNQuerySetTestCase(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.now = now
+        GlobeeIPN.objects.bulk_create([
+            GlobeeIPN(payment_id='PAYMENT_%s' % i, payment_status=status, total=10, customer_email='%s@example.com' % email,
+                      created_at=now - timedelta(hours=i), expires_at=now + timedelta(hours=hours))
+            for i, (status, email, hours) in enumerate([
+                ('unpaid', 'foo', -1), ('unpaid', 'bar', 1), ('paid', 'foo', -2), ('completed', 'foo', -3), ('expired', 'bar', -4),
+            ])
+        ])
+
+    def test_queryset(self):
+        self.assertEqual(['PAYMENT_0', 'PAYMENT_1', 'PAYMENT_2'], sorted(GlobeeIPN.objects.open().values_list('payment_id', flat=True)))
+        self.assertEqual(['PAYMENT_0', 'PAYMENT_2'], sorted(GlobeeIPN.objects.expiring_before(self.now).values_list('payment_id', flat=True)))
+        self.assertEqual(['PAYMENT_0', 'PAYMENT_2', 'PAYMENT_3'], list(GlobeeIPN.objects.for_customer('foo@example.com').values_list('payment_id', flat=True)))
+
+    def test_indexes(self):
+        plans = {
+            'globee_customer_created_idx': GlobeeIPN.objects.for_customer('foo@example.com'),
+            'globee_status_created_idx': GlobeeIPN.objects.filter(payment_status='completed').order_by('-created_at'),
+        }
+        if connection.vendor == 'postgresql':
+            # SQLite can't match the partial index condition with bound parameters
+            plans['globee_open_expires_idx'] = GlobeeIPN.objects.expiring_before(self.now).order_by('expires_at', 'id')
+        for name, queryset in plans.items():
+            self.assertIn(name, queryset.explain())
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, GlobeeIPN._meta.db_table)
+        self.assertEqual(['expires_at', 'id'], constraints['globee_open_expires_idx']['columns'])
+
+
+class GlobeeLargeTableAdminTestCase(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        GlobeeIPN.objects.bulk_create([
+            GlobeeIPN(payment_id='PAYMENT_%s' % i, custom_payment_id='CUSTOM_%s' % i, payment_status='paid' if i % 2 else 'unpaid',
+                      total=10, customer_email='foobar@example.com', created_at=now - timedelta(minutes=i // 2), expires_at=now)
+            for i in range(5)
+        ])
+        self.model_admin = LargeTableGlobeeIPNAdmin(GlobeeIPN, AdminSite())
+        self.model_admin.list_per_page = 2
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def get_changelist(self, query_string=''):
+        request = RequestFactory().get('/admin/globee/globeeipn/%s' % query_string)
+        request.user = self.user
+        return self.model_admin.get_changelist_instance(request)
+
+    def test_keyset_pagination(self):
+        pages = []
+        query_string = ''
+        while query_string is not None:
+            cl = self.get_changelist(query_string)
+            self.assertEqual(5, cl.result_count)
+            self.assertIsNone(cl.full_result_count)
+            pages.append([payment.payment_id for payment in cl.result_list])
+            query_string = cl.next_url
+        self.assertEqual([['PAYMENT_1', 'PAYMENT_0'], ['PAYMENT_3', 'PAYMENT_2'], ['PAYMENT_4']], pages)
+        self.assertEqual('?', cl.first_url)
+        self.assertIn('First page', render_to_string('admin/globee/globeeipn/pagination.html', {'cl': cl}))
+        cl = self.get_changelist('?payment_status__exact=paid')
+        self.assertEqual(['PAYMENT_1', 'PAYMENT_3'], [payment.payment_id for payment in cl.result_list])
+        self.assertIsNone(cl.next_url)
+        with self.assertRaises(IncorrectLookupParameters):
+            self.get_changelist('?after=invalid')
+
+    def test_search(self):
+        cl = self.get_changelist('?q=PAYMENT_2')
+        self.assertEqual(['PAYMENT_2'], [payment.payment_id for payment in cl.result_list])
+        cl = self.get_changelist('?q=CUSTOM_')
+        self.assertEqual(2, len(cl.result_list))
+        self.assertEqual(5, cl.result_count)
+        cl = self.get_changelist('?q=AYMENT')
+        self.assertEqual([], cl.result_list)
+
+
+class GlobeeExpireTestCase(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        statuses = ['unpaid'] * 5 + ['paid', 'underpaid']
+        GlobeeIPN.objects.bulk_create([
+            GlobeeIPN(payment_id='EXPIRED_%s' % i, payment_status=status, total=10, customer_email='foobar@example.com',
+                      created_at=now - timedelta(hours=2), expires_at=now - timedelta(hours=1))
+            for i, status in enumerate(statuses)
+        ])
+        GlobeeIPN.objects.create(payment_id='OPEN', total=10, customer_email='foobar@example.com', created_at=now,
+                                 expires_at=now + timedelta(hours=1))
+        self.chunks = []
+        globee_expired_ipns.connect(self.on_expired)
+
+    def tearDown(self):
+        globee_expired_ipns.disconnect(self.on_expired)
+
+    def on_expired(self, sender, payment_ids, **kwargs):
+        self.chunks.append(payment_ids)
+
+    def test_expire_ipns(self):
+        expired, elapsed = expire_ipns(chunk_size=2)
+        self.assertEqual(5, expired)
+        self.assertGreaterEqual(elapsed, 0)
+        self.assertEqual([2, 2, 1], [len(chunk) for chunk in self.chunks])
+        self.assertEqual(['EXPIRED_%s' % i for i in range(5)], sorted(sum(self.chunks, [])))
+        self.assertEqual(5, GlobeeIPN.objects.filter(payment_status='expired').count())
+        self.assertEqual('unpaid', GlobeeIPN.objects.get(payment_id='OPEN').payment_status)
+        self.assertEqual('paid', GlobeeIPN.objects.get(payment_id='EXPIRED_5').payment_status)
+        self.assertEqual((0, 0), (expire_ipns()[0], len(self.chunks) - 3))
+
+    def test_expire_command(self):
+        out = StringIO()
+        call_command('globee_expire_ipns', '--chunk-size', '10', stdout=out)
+        self.assertIn('expired 5 payments in', out.getvalue())
+        self.assertEqual(1, len(self.chunks))
+
+
+class GlobeePollingTestCase(TestCase):
+
+    def test_poll_interval(self):
+        self.assertEqual(60, get_poll_interval('unpaid', 'medium', 1000, 0))
+        self.assertEqual(60, get_poll_interval('unpaid', 'medium', 1000, 0, unchanged=3))
+        self.assertEqual(15, get_poll_interval('unpaid', 'medium', 1000, 990, unchanged=3))
+        self.assertIsNone(get_poll_interval('unpaid', 'medium', 1000, 1001))
+        self.assertEqual(30, get_poll_interval('paid', 'high', 1000, 1001))
+        self.assertEqual(240, get_poll_interval('paid', 'low', 1000, 1001))
+        self.assertEqual(6 * 3600, get_poll_interval('confirmed', 'low', 1000, 1001, unchanged=10))
+        self.assertIsNone(get_poll_interval('confirmed', 'low', 1000, 1001 + 24 * 3600))
+        self.assertIsNone(get_poll_interval('completed', 'low', 1000, 1001))
+        with self.settings(GLOBEE_POLL_INTERVALS={'completed': 10}, GLOBEE_POLL_MAX_INTERVAL=100):
+            self.assertEqual(10, get_poll_interval('completed', 'low', 1000, 1001))
+            self.assertEqual(100, get_poll_interval('confirmed', 'low', 1000, 1001))
+
+    @override_settings(GLOBEE_AUTH_KEY='POLLING_KEY', GLOBEE_SKIP_DUPLICATE_IPN=False)
+    def test_polling_scheduler(self):
+        valid = []
+        receiver = lambda sender, **kwargs: valid.append(sender.payment_id)
+        globee_valid_ipn.connect(receiver)
+        api = FakeGlobeeAPI(auth_key='POLLING_KEY')
+        now = [time()]
+        with FakeGlobeeServer(api) as server, self.settings(GLOBEE_API_URL=server.api_url):
+            payments_data = [{'total': 10 + i, 'customer': {'name': 'foobar', 'email': 'foobar@example.com'}} for i in range(3)]
+            payments_data[0]['confirmation_speed'] = 'high'
+            payment_ids = [result.payment_id for result in GlobeePayment().create_requests(payments_data, create_ipns=True)]
+            self.assertEqual('high', GlobeeIPN.objects.get(payment_id=payment_ids[0]).confirmation_speed)
+            # expired payments are not loaded
+            expired = timezone.now() - timedelta(days=2)
+            for status in ('unpaid', 'confirmed'):
+                GlobeeIPN.objects.create(payment_id='EXPIRED_%s' % status, payment_status=status, total=10,
+                                         customer_email='foobar@example.com', created_at=expired, expires_at=expired)
+            scheduler = PollingScheduler(clock=lambda: now[0])
+            self.assertEqual(3, scheduler.load())
+            self.assertEqual((0, 0), scheduler.poll())
+            now[0] += 60
+            # unchanged payments are marked as verified without a signal
+            self.assertEqual((3, 0), scheduler.poll())
+            self.assertEqual([], valid)
+            self.assertEqual(3, GlobeeIPN.objects.filter(verification_status=VERIFICATION_STATUS_VERIFIED).count())
+            now[0] += 60
+            self.assertEqual((3, 0), scheduler.poll())
+            self.assertEqual([], valid)
+            # unpaid payments are checked every minute
+            api.set_status(payment_ids[0], 'paid')
+            now[0] += 60
+            self.assertEqual((3, 1), scheduler.poll())
+            self.assertEqual('paid', GlobeeIPN.objects.get(payment_id=payment_ids[0]).payment_status)
+            # paid payments with a high confirmation speed are checked every 30 seconds
+            now[0] += 30
+            self.assertEqual((1, 0), scheduler.poll())
+            # the unchanged check doubled the interval
+            api.set_status(payment_ids[0], 'completed')
+            now[0] += 60
+            self.assertEqual((3, 1), scheduler.poll())
+            self.assertEqual(2, len(scheduler))
+            # an IPN changed the status in the meantime
+            GlobeeIPN.objects.filter(payment_id=payment_ids[1]).update(payment_status='completed')
+            self.assertEqual(1, scheduler.load())
+            out = StringIO()
+            call_command('globee_poll_payments', '--once', stdout=out)
+            self.assertIn('checked 1 payments, 0 changed', out.getvalue())
+        globee_valid_ipn.disconnect(receiver)
+        close_sessions()
+        self.assertEqual([payment_ids[0]] * 2, valid)
+
+
+    @override_settings(GLOBEE_AUTH_KEY='POLLING_KEY')
+    def test_polling_concurrent_ipn(self):
+        valid = []
+        receiver = lambda sender, **kwargs: valid.append(sender.payment_id)
+        globee_valid_ipn.connect(receiver)
+        api = FakeGlobeeAPI(auth_key='POLLING_KEY')
+        with FakeGlobeeServer(api) as server, self.settings(GLOBEE_API_URL=server.api_url):
+            payments_data = [{'total': 10 + i, 'customer': {'name': 'foobar', 'email': 'foobar@example.com'}} for i in range(2)]
+            payment_ids = [result.payment_id for result in GlobeePayment().create_requests(payments_data, create_ipns=True)]
+            for payment_id in payment_ids:
+                api.set_status(payment_id, 'paid')
+            scheduler = PollingScheduler()
+            scheduler.load(check_now=True)
+            get_payments_by_ids = GlobeePayment.get_payments_by_ids
+
+            def fetch_during_ipn(globee_payment, payment_ids_, max_workers=None):
+                # an IPN confirms the first payment while it is fetched from GloBee
+                GlobeeIPN.objects.filter(payment_id=payment_ids[0]).update(payment_status='confirmed')
+                return get_payments_by_ids(globee_payment, payment_ids_, max_workers)
+
+            with mock.patch.object(GlobeePayment, 'get_payments_by_ids', fetch_during_ipn):
+                self.assertEqual((2, 1), scheduler.poll())
+        globee_valid_ipn.disconnect(receiver)
+        close_sessions()
+        self.assertEqual([payment_ids[1]], valid)
+        self.assertEqual('confirmed', GlobeeIPN.objects.get(payment_id=payment_ids[0]).payment_status)
+        self.assertEqual('confirmed', scheduler.payments[payment_ids[0]].payment_status)
+        self.assertEqual('paid', GlobeeIPN.objects.get(payment_id=payment_ids[1]).payment_status)
+
+@override_settings(GLOBEE_PARANOID_MODE=False)
+@override_settings(GLOBEE_AUTO_VERIFY=False)
+@override_settings(ROOT_URLCONF='globee.urls')
+class GlobeeReplayIPNTestCase(TestCase):
+
+    def replay(self, lines, **options):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+            f.write('\n'.join(lines))
+        self.addCleanup(os.remove, f.name)
+        stdout = StringIO()
+        call_command('globee_replay_ipns', f.name, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_replay(self):
+        lines = [
+            json.dumps(IPN_PAYMENT_DATA),
+            '',
+            json.dumps(dict(IPN_PAYMENT_DATA, id='OTHER_ID', custom_payment_id='743')),
+            json.dumps({'id': 'INVALID'}),
+            'not json',
+        ]
+        report = json.loads(self.replay(lines, shuffle=True, seed=1, json=True))
+        self.assertEqual(report['requests'], 4)
+        self.assertEqual(report['status_codes'], {'200': 2, '400': 1, '500': 1})
+        self.assertEqual(report['failures'], 2)
+        self.assertIsNotNone(report['p99_ms'])
+        self.assertEqual(2, GlobeeIPN.objects.count())
+
+    def test_replay_rate(self):
+        output = self.replay([json.dumps({'id': 'INVALID'})] * 3, rate=20)
+        self.assertIn('replayed 3 IPNs', output)
+        self.assertIn('400: 3', output)
+        self.assertIn('failures: 3', output)
+        self.assertIn('p99', output)
+
+    def test_replay_sender_error(self):
+        def send(body):
+            raise ValueError(body)
+
+        with mock.patch.object(ReplayCommand, 'get_sender', return_value=send):
+            report = json.loads(self.replay([json.dumps(IPN_PAYMENT_DATA)] * 2, concurrency=2, json=True))
+        self.assertEqual(report['status_codes'], {'ValueError': 2})
+        self.assertEqual(report['failures'], 2)
+
+
+@override_settings(GLOBEE_PARANOID_MODE=False)
+@override_settings(GLOBEE_AUTO_VERIFY=False)
+class GlobeePaymentAsyncIPNTestCase(TestCase):
+
+    def post(self, payment_data):
+        request = AsyncRequestFactory().generic('POST', '/globee-ipn/', bytes(json.dumps(payment_data), 'utf-8'))
+        return globee_ipn_async_view(request)
+
+    async def test_async_ipn_view_valid(self):
+        response = await self.post(IPN_PAYMENT_DATA)
+        self.assertEqual(response.status_code, 200)
+        payment = await GlobeeIPN.objects.aget(payment_id=IPN_PAYMENT_DATA['id'])
+        self.assertEqual(payment.payment_status, 'paid')
+
+        response = await self.post(dict(IPN_PAYMENT_DATA, status='confirmed'))
+        self.assertEqual(response.status_code, 200)
+        payment = await GlobeeIPN.objects.aget(payment_id=IPN_PAYMENT_DATA['id'])
+        self.assertEqual(payment.payment_status, 'confirmed')
+
+    async def test_async_ipn_view_invalid(self):
+        response = await self.post({"id": "a1B2c3D4e5F6g7H8i9J0kL"})
+        self.assertEqual(response.status_code, 400)
+        response = await self.post(dict(IPN_PAYMENT_DATA, total='ERROR'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(0, await GlobeeIPN.objects.acount())
+
+    @override_settings(GLOBEE_PARANOID_MODE=True)
+    async def test_async_ipn_view_invalid_paranoid(self):
+        response = await self.post({"id": "a1B2c3D4e5F6g7H8i9J0kL"})
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_ipn_view_get_not_allowed(self):
+        response = await globee_ipn_async_view(AsyncRequestFactory().get('/globee-ipn/'))
+        self.assertEqual(response.status_code, 405)
+
+
 @override_settings(GLOBEE_TESTNET=True)
 class GlobeeUpdatePaymentTestCase(TestCase):
 
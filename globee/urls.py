@@ -1,7 +1,10 @@
+from django.conf import settings
 from django.urls import path
 
 from globee import views
 
+ipn_view = views.globee_ipn_async_view if getattr(settings, 'GLOBEE_ASYNC_IPN', False) else views.globee_ipn_view
+
 urlpatterns = [
-    path('globee-ipn/', views.globee_ipn_view, name='globee-ipn'),
+    path('globee-ipn/', ipn_view, name='globee-ipn'),
 ]
@@ -1,17 +1,19 @@
-from datetime import datetime
 from logging import getLogger
 from json import loads as json_loads, dumps as json_dumps
 
+from asgiref.sync import sync_to_async
+
 from django.core.exceptions import ValidationError
-from pytz import utc as pytz_utc
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotAllowed
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
-from globee.core import GlobeePayment
-from globee.models import GlobeeIPN
+from globee.ipn import (
+    VERIFY_SYNC, aget_verified_payment_data, get_ipn_timer, get_verified_payment_data, get_verify_mode, record_ipn_timings, save_ipn
+)
+from globee.queue import get_ipn_queue
 
 
 logger = getLogger(__name__)
@@ -20,37 +22,33 @@ logger = getLogger(__name__)
 @require_POST
 @csrf_exempt
 def globee_ipn_view(request):
+    timer = get_ipn_timer()
+    try:
+        return _process_ipn(request, timer)
+    finally:
+        record_ipn_timings(timer)
+
+
+def _process_ipn(request, timer):
     paranoid = getattr(settings, 'GLOBEE_PARANOID_MODE', False)
-    auto_validate = getattr(settings, 'GLOBEE_AUTO_VERIFY', False)
+    verify_mode = get_verify_mode()
     payment_response = request.body.decode("utf-8")
+    timer.mark('decode')
+    if getattr(settings, 'GLOBEE_IPN_DEFERRED', False):
+        get_ipn_queue().enqueue(payment_response)
+        timer.mark('enqueue')
+        return HttpResponse(status=200)
     payment_data = json_loads(payment_response)
-    if auto_validate:
-        globee_payment = GlobeePayment()
-        payment_data = globee_payment.get_payment_by_id(payment_data['id'])
+    timer.payment_id = payment_data.get('id') if isinstance(payment_data, dict) else None
+    timer.mark('json')
+    if verify_mode == VERIFY_SYNC:
+        payment_data = get_verified_payment_data(payment_data['id'])
+        timer.mark('verify')
     pretty_data = json_dumps(payment_data, indent=4, sort_keys=True)
     logger.debug('Globee POST data: %s' % pretty_data)
 
     try:
-        created_at = datetime.strptime(payment_data['created_at'], '%Y-%m-%d %H:%M:%S')
-        expires_at = datetime.strptime(payment_data['expires_at'], '%Y-%m-%d %H:%M:%S')
-
-        defaults = {
-            'payment_status': payment_data['status'],
-            'total': float(payment_data['total']),
-            'currency': payment_data['currency'],
-            'custom_payment_id': payment_data['custom_payment_id'],
-            'callback_data': payment_data['callback_data'],
-            'customer_email': payment_data['customer']['email'],
-            'customer_name': payment_data['customer']['name'],
-            'created_at': pytz_utc.localize(created_at),
-            'expires_at': pytz_utc.localize(expires_at),
-        }
-
-        payment, created = GlobeeIPN.objects.update_or_create(
-            payment_id=payment_data['id'],
-            defaults=defaults
-        )
-        payment.send_valid_signal()
+        save_ipn(payment_data, verify_mode, timer)
     except KeyError as e:
         logger.error('Key %s not found in payment data.' % e)
         status = 200 if paranoid else 400
@@ -60,3 +58,52 @@ def globee_ipn_view(request):
         status = 200 if paranoid else 400
         return HttpResponse(status=status)
     return HttpResponse(status=200)
+
+
+async def globee_ipn_async_view(request):
+    """
+    Async variant of globee_ipn_view for ASGI deployments.
+    The verification fetch and the database upsert don't block a worker thread.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    timer = get_ipn_timer()
+    try:
+        return await _aprocess_ipn(request, timer)
+    finally:
+        record_ipn_timings(timer)
+
+
+async def _aprocess_ipn(request, timer):
+    paranoid = getattr(settings, 'GLOBEE_PARANOID_MODE', False)
+    verify_mode = get_verify_mode()
+    payment_response = request.body.decode("utf-8")
+    timer.mark('decode')
+    if getattr(settings, 'GLOBEE_IPN_DEFERRED', False):
+        await sync_to_async(get_ipn_queue().enqueue)(payment_response)
+        timer.mark('enqueue')
+        return HttpResponse(status=200)
+    payment_data = json_loads(payment_response)
+    timer.payment_id = payment_data.get('id') if isinstance(payment_data, dict) else None
+    timer.mark('json')
+    if verify_mode == VERIFY_SYNC:
+        payment_data = await aget_verified_payment_data(payment_data['id'])
+        timer.mark('verify')
+    pretty_data = json_dumps(payment_data, indent=4, sort_keys=True)
+    logger.debug('Globee POST data: %s' % pretty_data)
+
+    try:
+        # the upsert is raw SQL (INSERT ... ON CONFLICT) without an async ORM equivalent, so save_ipn runs in a thread
+        await sync_to_async(save_ipn)(payment_data, verify_mode, timer)
+    except KeyError as e:
+        logger.error('Key %s not found in payment data.' % e)
+        status = 200 if paranoid else 400
+        return HttpResponse(status=status)
+    except (ValueError, ValidationError) as e:
+        logger.error(e)
+        status = 200 if paranoid else 400
+        return HttpResponse(status=status)
+    return HttpResponse(status=200)
+
+
+globee_ipn_async_view.csrf_exempt = True
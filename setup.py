@@ -17,27 +17,31 @@ setup(
     long_description=README,
     long_description_content_type='text/markdown',
     url='https://github.com/lovvskillz/django-globee',
+    python_requires='>=3.8',
     install_requires=[
-            'Django>=2.0',
+            'Django>=4.1',
             'six>=1.4.1',
             'requests>=2.19.1',
             'pytz>=2018.5',
     ],
+    extras_require={
+        'async': ['httpx>=0.18'],
+    },
     author='Vadim Zifra',
     author_email='vadim@minehub.de',
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',
-        'Framework :: Django :: 2.0',
-        'Framework :: Django :: 2.1',
-        'Framework :: Django :: 2.2',
+        'Framework :: Django :: 4.1',
+        'Framework :: Django :: 4.2',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
     ],
@@ -3,7 +3,32 @@ import os
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 SECRET_KEY = 'SOMEVAL'
-INSTALLED_APPS = ['globee', ]
+INSTALLED_APPS = [
+    'django.contrib.admin',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.messages',
+    'django.contrib.sessions',
+    'globee',
+]
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+]
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    },
+]
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
 USE_I18N = True
@@ -16,6 +41,7 @@ DATABASES = {
     }
 }
 
-GLOBEE_AUTH_KEY = os.environ.get('GLOBEE_AUTH_KEY')
+# the tests use globee.testing.FakeGlobeeAPI unless GLOBEE_TEST_LIVE_API is set
+GLOBEE_AUTH_KEY = os.environ.get('GLOBEE_AUTH_KEY', 'FAKE_AUTH_KEY')
 GLOBEE_PARANOID_MODE = bool(os.environ.get('GLOBEE_PARANOID_MODE'))
 